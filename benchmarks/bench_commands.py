@@ -0,0 +1,275 @@
+"""drive lain commands end to end, offline. kubectl, helm and legacy_lain are
+fake executables under LAIN_EXBIN_PREFIX, with configurable latency and
+output size, the apiserver and the registry are local fakes, see
+tests/fake_apiserver.py and tests/fake_registry.py.
+
+every command runs in a fresh process, like it does for real, with warm
+caches (best of a few rounds), its wall time, subprocess count and peak RSS
+are compared against benchmarks/baseline_commands.json:
+
+    python benchmarks/bench_commands.py [--latency 0.05] [--output-size 1024] [--rounds 3]
+    python benchmarks/bench_commands.py --update-baseline
+
+exits with 1 if any command is slower or fatter than the baseline allows, or
+spawns more subprocesses
+"""
+import argparse
+import json
+import os
+import resource
+import stat
+import subprocess
+import sys
+import time
+from os.path import abspath, dirname, join
+from tempfile import TemporaryDirectory
+
+BENCH_DIR = dirname(abspath(__file__))
+ROOT = dirname(BENCH_DIR)
+sys.path.insert(0, ROOT)
+
+BASELINE_FILE = join(BENCH_DIR, 'baseline_commands.json')
+APPNAME = 'dummy'
+CLUSTER = 'future'
+# {name: lain arguments}
+COMMANDS = {
+    'init': ['init'],
+    'deploy': ['deploy'],
+    'status': ['status'],
+    'env add': ['env', 'add', 'FOO=BAR'],
+    'secret show': ['secret', 'show'],
+    'update-image': ['update-image', 'web'],
+}
+# wall time and RSS may grow this much before it counts as a regression,
+# subprocess count may not grow at all
+TOLERANCE = 1.25
+WALL_SLACK_MS = 20
+# every fake sleeps LAIN_BENCH_LATENCY, then prints LAIN_BENCH_OUTPUT_SIZE
+# bytes, except for the calls lain needs a real answer from
+FAKE_PREAMBLE = '''#!/bin/sh
+sleep "$LAIN_BENCH_LATENCY"
+'''
+FAKE_EPILOGUE = '''
+head -c "$LAIN_BENCH_OUTPUT_SIZE" /dev/zero | tr '\\0' x
+'''
+FAKE_BINARIES = {
+    'kubectl': '''case " $* " in
+  *" version "*) echo "Client Version: v1.17.0"; exit 0;;
+esac''',
+    'helm': '''case " $* " in
+  *" version "*) echo "v3.0.2+g19e47ee"; exit 0;;
+  *" status "*) echo "Error: release: not found" >&2; exit 1;;
+  *" history "*) echo "[]"; exit 0;;
+esac''',
+    'legacy_lain': '',
+}
+
+
+def install_fake_binaries(prefix):
+    for name, script in FAKE_BINARIES.items():
+        path = join(prefix, name)
+        with open(path, 'w') as f:
+            f.write(FAKE_PREAMBLE + script + FAKE_EPILOGUE)
+
+        os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+
+
+def prepare_workspace(workspace, apiserver, registry):
+    """a HOME with ~/.kube/config pointing to the fake apiserver, and an app
+    with its chart initialized, committed, and its image in the registry"""
+    from click.testing import CliRunner
+
+    from future_lain_cli import utils
+    from future_lain_cli.lain import lain
+    from tests.fake_apiserver import make_deployment, make_pod
+    kube_dir = join(workspace, 'home', '.kube')
+    os.makedirs(kube_dir)
+    kubeconfig = join(kube_dir, f'kubeconfig-{CLUSTER}')
+    utils.yadu(apiserver.kubeconfig(), kubeconfig)
+    os.symlink(kubeconfig, join(kube_dir, 'config'))
+    app_dir = join(workspace, APPNAME)
+    os.makedirs(app_dir)
+    os.chdir(app_dir)
+    res = CliRunner().invoke(lain, ['init'], obj={})
+    assert res.exit_code == 0, res.output
+    # ingresses would be probed by lain status, which is not offline
+    values_file = join(app_dir, utils.CHART_DIR_NAME, 'values.yaml')
+    with open(values_file) as f:
+        values = utils.yalo(f)
+
+    values.pop('ingresses', None)
+    values.pop('externalIngresses', None)
+    utils.yadu(values, values_file)
+    labels = {'app.kubernetes.io/name': APPNAME}
+    for deploy in values['deployments']:
+        apiserver.add('deployments', make_deployment(f'{APPNAME}-{deploy}', replicas=2, labels=labels))
+        for i in range(2):
+            apiserver.add('pods', make_pod(f'{APPNAME}-{deploy}-7557696ddf-{i}', labels=labels))
+
+    apiserver.add_secret(f'{APPNAME}-secret', {'topsecret.txt': 'I\nAM\nBATMAN'})
+    git = ['git', '-c', 'user.name=lain', '-c', 'user.email=lain@ein.plus']
+    subprocess.run([*git, 'init', '-q'], check=True)
+    subprocess.run([*git, 'add', '.'], check=True)
+    subprocess.run([*git, 'commit', '-q', '-m', 'init'], check=True)
+    registry.tags = [f'release-{utils.tell_meta_version()}']
+    return app_dir
+
+
+def render_status_once():
+    """stand-in for the full screen lain status: build it, and render every
+    pane once everything is loaded"""
+    from prompt_toolkit.application import create_app_session
+    from prompt_toolkit.input import DummyInput
+    from prompt_toolkit.layout.controls import FormattedTextControl
+    from prompt_toolkit.output import DummyOutput
+
+    from future_lain_cli.app_status import build
+    with create_app_session(input=DummyInput(), output=DummyOutput()):
+        app = build()
+
+    controls = [c for c in app.layout.find_all_controls() if isinstance(c, FormattedTextControl)]
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        texts = [c.text() if callable(c.text) else c.text for c in controls]
+        if not any(text == 'loading...' for text in texts):
+            break
+        time.sleep(0.01)
+
+
+def run_command(name, result_file):
+    """runs in the child process, one command, measured"""
+    from bench_toolchain import SpawnCounter
+    from click.testing import CliRunner
+
+    from future_lain_cli import app_status, utils
+    from future_lain_cli.lain import lain
+    cluster_info = {**utils.FUTURE_CLUSTERS[CLUSTER], 'registry': os.environ['LAIN_BENCH_REGISTRY']}
+    utils.FUTURE_CLUSTERS = {**utils.FUTURE_CLUSTERS, CLUSTER: cluster_info}
+    app_status.display_app_status = render_status_once
+    with SpawnCounter() as counter:
+        start = time.perf_counter()
+        res = CliRunner().invoke(lain, COMMANDS[name], obj={})
+        wall = time.perf_counter() - start
+
+    if res.exit_code:
+        print(res.output, file=sys.stderr)
+        raise SystemExit(f'lain {" ".join(COMMANDS[name])} failed with {res.exit_code}')
+    # kilobytes on linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    rss_mb = rss / 1024 / 1024 if sys.platform == 'darwin' else rss / 1024
+    with open(result_file, 'w') as f:
+        json.dump({'wall_ms': wall * 1000, 'spawns': counter.count, 'rss_mb': rss_mb}, f)
+
+
+def measure(name, app_dir, rounds):
+    """best of rounds, each in a fresh process"""
+    results = []
+    for i in range(rounds):
+        cwd = app_dir
+        if name == 'init':
+            # a fresh app each time, or there's nothing to do
+            cwd = join(dirname(app_dir), f'init-{i}')
+            os.makedirs(cwd)
+        result_file = join(dirname(app_dir), 'result.json')
+        res = subprocess.run(
+            [sys.executable, abspath(__file__), '--run', name, '--result', result_file],
+            cwd=cwd, capture_output=True,
+        )
+        if res.returncode:
+            print(res.stderr.decode('utf-8'), file=sys.stderr)
+            raise SystemExit(f'benchmark of {name} failed')
+        with open(result_file) as f:
+            results.append(json.load(f))
+
+    return {
+        'wall_ms': round(min(r['wall_ms'] for r in results), 1),
+        'spawns': min(r['spawns'] for r in results),
+        'rss_mb': round(min(r['rss_mb'] for r in results), 1),
+    }
+
+
+def compare(report, baseline):
+    """print the report against the baseline, return regressions"""
+    regressions = []
+    print(f'{"":<16}{"WALL":>12}{"SPAWNS":>10}{"PEAK RSS":>12}{"BASELINE WALL":>16}')
+    for name, r in report.items():
+        b = baseline.get(name)
+        print(
+            f'{name:<16}{r["wall_ms"]:>10.0f}ms{r["spawns"]:>10}{r["rss_mb"]:>10.1f}MB'
+            + (f'{b["wall_ms"]:>14.0f}ms' if b else f'{"-":>16}')
+        )
+        if not b:
+            continue
+        if r['wall_ms'] > b['wall_ms'] * TOLERANCE + WALL_SLACK_MS:
+            regressions.append(f'{name} took {r["wall_ms"]:.0f}ms, baseline {b["wall_ms"]:.0f}ms')
+        if r['spawns'] > b['spawns']:
+            regressions.append(f'{name} spawned {r["spawns"]} subprocesses, baseline {b["spawns"]}')
+        if r['rss_mb'] > b['rss_mb'] * TOLERANCE:
+            regressions.append(f'{name} peaked at {r["rss_mb"]:.1f}MB, baseline {b["rss_mb"]:.1f}MB')
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds every fake executable takes')
+    parser.add_argument('--output-size', type=int, default=1024, help='bytes every fake executable prints')
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--update-baseline', action='store_true')
+    parser.add_argument('--run', choices=COMMANDS, help=argparse.SUPPRESS)
+    parser.add_argument('--result', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run:
+        run_command(args.run, args.result)
+        return
+
+    with TemporaryDirectory() as workspace:
+        prefix = join(workspace, 'bin')
+        os.makedirs(prefix)
+        install_fake_binaries(prefix)
+        # must be in place before lain is imported, here and in children
+        os.environ.update({
+            'HOME': join(workspace, 'home'),
+            'LAIN_EXBIN_PREFIX': prefix,
+            'LAIN_CACHE_DIR': join(workspace, 'cache'),
+            'LAIN_BENCH_LATENCY': '0',
+            'LAIN_BENCH_OUTPUT_SIZE': '0',
+        })
+        from tests.fake_apiserver import FakeApiserver
+        from tests.fake_registry import FakeRegistry
+        registry = FakeRegistry([])
+        os.environ['LAIN_BENCH_REGISTRY'] = registry.host
+        with FakeApiserver(auto_rollout=True) as apiserver:
+            app_dir = prepare_workspace(workspace, apiserver, registry)
+            os.environ['LAIN_BENCH_LATENCY'] = str(args.latency)
+            os.environ['LAIN_BENCH_OUTPUT_SIZE'] = str(args.output_size)
+            report = {name: measure(name, app_dir, args.rounds) for name in COMMANDS}
+
+    params = {'latency': args.latency, 'output_size': args.output_size}
+    if args.update_baseline:
+        with open(BASELINE_FILE, 'w') as f:
+            json.dump({'params': params, 'commands': report}, f, indent=2)
+            f.write('\n')
+
+        print(f'baseline written to {BASELINE_FILE}')
+    try:
+        with open(BASELINE_FILE) as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        baseline = {'params': params, 'commands': {}}
+
+    if baseline['params'] != params:
+        print(f'baseline was taken with {baseline["params"]}, wall times are not comparable')
+        for r in baseline['commands'].values():
+            r['wall_ms'] = float('inf')
+
+    print(f'fake kubectl / helm / legacy_lain take {args.latency * 1000:.0f}ms and print {args.output_size} bytes each')
+    regressions = compare(report, baseline['commands'])
+    for regression in regressions:
+        print(f'regression: {regression}')
+
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
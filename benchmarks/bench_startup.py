@@ -0,0 +1,67 @@
+"""measure how long it takes to import lain, which is what you pay on every
+invocation, including `lain version` and shell completion.
+
+    python benchmarks/bench_startup.py [budget in ms]
+
+exits with 1 if startup exceeds the budget, or if any of the heavy modules
+are imported eagerly, they should only be imported by the commands that use
+them
+"""
+import subprocess
+import sys
+from os.path import abspath, dirname
+
+ROOT = dirname(dirname(abspath(__file__)))
+# baseline was ~340ms, most of which was prompt_toolkit
+DEFAULT_BUDGET_MS = 150
+HEAVY_MODULES = ('prompt_toolkit', 'jinja2', 'requests', 'yaml', 'humanfriendly')
+
+
+def importtime(module='future_lain_cli.lain'):
+    """returns {module: cumulative microseconds}, for module and everything
+    imported because of it"""
+    res = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=ROOT, capture_output=True, text=True, check=True,
+    )
+    report = {}
+    for line in res.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        report[name.strip()] = int(cumulative)
+        # imports are logged children first, a top level entry closes a tree
+        if not name[1:].startswith(' '):
+            if name.strip() == module:
+                return report
+            report = {}
+
+    return report
+
+
+def main():
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_BUDGET_MS
+    # take the best of a few runs, the first one pays for bytecode compilation
+    runs = [importtime() for _ in range(5)]
+    report = min(runs, key=lambda r: r['future_lain_cli.lain'])
+    total = report['future_lain_cli.lain'] / 1000
+    print(f'import future_lain_cli.lain: {total:.1f}ms (budget {budget:.0f}ms)')
+    print('top offenders (cumulative):')
+    for name, us in sorted(report.items(), key=lambda kv: kv[1], reverse=True)[1:11]:
+        print(f'    {name:<40}{us / 1000:.1f}ms')
+
+    failed = False
+    eager = [m for m in HEAVY_MODULES if m in report]
+    if eager:
+        print(f'heavy modules imported at startup: {", ".join(eager)}')
+        failed = True
+
+    if total > budget:
+        print(f'startup is over budget by {total - budget:.1f}ms')
+        failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
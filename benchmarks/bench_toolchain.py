@@ -0,0 +1,101 @@
+"""count subprocess spawns per kubectl / helm invocation.
+
+before the toolchain cache, every kubectl() / helm() call spawned a version
+probe before the actual command, that's 2 processes per call. run this script
+to see how many are spawned now:
+
+    python benchmarks/bench_toolchain.py
+"""
+import os
+import stat
+import subprocess
+import sys
+from contextlib import redirect_stderr
+from io import StringIO
+from os.path import abspath, dirname, join
+from tempfile import TemporaryDirectory
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+FAKE_BINARIES = {
+    'kubectl': '''#!/bin/sh
+[ "$2" = "version" ] && echo "Client Version: v1.17.0" && exit 0
+[ "$1" = "version" ] && echo "Client Version: v1.17.0" && exit 0
+exit 0
+''',
+    'helm': '''#!/bin/sh
+[ "$1" = "version" ] && echo "v3.0.2+g19e47ee" && exit 0
+exit 0
+''',
+}
+
+
+def install_fake_binaries(prefix):
+    for name, script in FAKE_BINARIES.items():
+        path = join(prefix, name)
+        with open(path, 'w') as f:
+            f.write(script)
+
+        os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+
+
+class SpawnCounter:
+
+    def __init__(self):
+        self.count = 0
+        self.original_popen = subprocess.Popen
+
+    def __enter__(self):
+        counter = self
+
+        class CountingPopen(self.original_popen):
+
+            def __init__(self, *args, **kwargs):
+                counter.count += 1
+                super().__init__(*args, **kwargs)
+
+        subprocess.Popen = CountingPopen
+        return self
+
+    def __exit__(self, *exc):
+        subprocess.Popen = self.original_popen
+
+
+def measure(calls=20):
+    from future_lain_cli import utils
+    report = {}
+    for label, reset_memo in [('cold cache', True), ('warm disk cache, new process', True), ('warm in-process cache', False)]:
+        if reset_memo:
+            utils.toolchain_memo.clear()
+
+        with SpawnCounter() as counter:
+            utils.kubectl('get', 'po', capture_output=True)
+            utils.helm('status', 'dummy', capture_output=True)
+
+        report[label] = counter.count / 2
+
+    with SpawnCounter() as counter:
+        for _ in range(calls):
+            utils.kubectl('get', 'po', capture_output=True)
+            utils.helm('status', 'dummy', capture_output=True)
+
+    report[f'{calls * 2} consecutive calls'] = counter.count / (calls * 2)
+    return report
+
+
+def main():
+    with TemporaryDirectory() as prefix, TemporaryDirectory() as cache_dir:
+        install_fake_binaries(prefix)
+        os.environ['LAIN_EXBIN_PREFIX'] = prefix
+        os.environ['LAIN_CACHE_DIR'] = cache_dir
+        # excall prints every command to stderr, that's just noise here
+        with redirect_stderr(StringIO()):
+            report = measure()
+
+    print('subprocess spawns per kubectl / helm call (was 2.0 before the toolchain cache):')
+    for label, spawns in report.items():
+        print(f'    {label:<35}{spawns:.2f}')
+
+
+if __name__ == '__main__':
+    main()
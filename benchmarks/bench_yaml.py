@@ -0,0 +1,95 @@
+"""compare yalo / yadu on the libyaml loader and dumper against pure python
+PyYAML, using a large values.yaml and a large secret:
+
+    python benchmarks/bench_yaml.py
+"""
+import sys
+import time
+from os.path import abspath, dirname
+from tempfile import NamedTemporaryFile
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from future_lain_cli import utils  # noqa: E402
+
+
+def make_values(deployments=50, env=200):
+    return {
+        'appname': 'dummy',
+        'env': {f'ENV_{i}': f'value-{i}' for i in range(env)},
+        'deployments': {
+            f'deploy{i}': {
+                'replicaCount': 2,
+                'memory': '256Mi',
+                'command': ['/lain/app/run.sh', '--port', str(8000 + i)],
+                'env': {f'DEPLOY_ENV_{n}': f'value-{n}' for n in range(20)},
+            }
+            for i in range(deployments)
+        },
+    }
+
+
+def make_secret(keys=300, lines=30):
+    return {
+        'apiVersion': 'v1',
+        'kind': 'Secret',
+        'metadata': {'name': 'dummy-secret'},
+        'data': {
+            f'config-{i}.py': utils.literal(''.join(f'SETTING_{n} = "{"x" * 40}"\n' for n in range(lines)))
+            for i in range(keys)
+        },
+    }
+
+
+def measure(dic, rounds=5):
+    """seconds per yadu and per yalo, best of rounds"""
+    dump, load = [], []
+    for _ in range(rounds):
+        with NamedTemporaryFile(suffix='.yaml') as f:
+            start = time.perf_counter()
+            utils.yadu(dic, f)
+            dump.append(time.perf_counter() - start)
+            f.flush()
+            start = time.perf_counter()
+            utils.yalo(f)
+            load.append(time.perf_counter() - start)
+
+    return min(dump), min(load)
+
+
+def main():
+    yaml = utils.tell_yaml()
+    if not hasattr(yaml, 'CDumper'):
+        print('PyYAML is built without libyaml here, nothing to compare')
+        return
+    docs = {'values.yaml': make_values(), 'secret': make_secret()}
+    pure = {
+        'tell_yaml_loader': lambda: yaml.FullLoader,
+        'tell_yaml_dumper': lambda: yaml.Dumper,
+    }
+    accelerated = {name: getattr(utils, name) for name in pure}
+    report = {}
+    for label, funcs in [('pure python', pure), ('libyaml', accelerated)]:
+        for name, func in funcs.items():
+            setattr(utils, name, func)
+
+        report[label] = {doc_name: measure(dic) for doc_name, dic in docs.items()}
+
+    for name, func in accelerated.items():
+        setattr(utils, name, func)
+
+    size = {doc_name: len(utils.yadu(dic)) // 1024 for doc_name, dic in docs.items()}
+    print(f'{"":<36}{"yadu":>10}{"yalo":>10}')
+    for doc_name in docs:
+        for label in report:
+            dump, load = report[label][doc_name]
+            row = f'{doc_name} ({size[doc_name]}KiB), {label}'
+            print(f'{row:<36}{dump * 1000:>8.1f}ms{load * 1000:>8.1f}ms')
+
+        dump_speedup = report['pure python'][doc_name][0] / report['libyaml'][doc_name][0]
+        load_speedup = report['pure python'][doc_name][1] / report['libyaml'][doc_name][1]
+        print(f'{"speedup":<36}{dump_speedup:>9.1f}x{load_speedup:>9.1f}x')
+
+
+if __name__ == '__main__':
+    main()
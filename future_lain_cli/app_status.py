@@ -1,97 +1,94 @@
-from concurrent.futures import ThreadPoolExecutor
-from functools import partial
+import threading
+from functools import lru_cache, partial
 
-import requests
 from prompt_toolkit.application import Application
 from prompt_toolkit.key_binding import KeyBindings
 from prompt_toolkit.layout.containers import HSplit, Window
 from prompt_toolkit.layout.controls import FormattedTextControl
 from prompt_toolkit.layout.layout import Layout
 
-from future_lain_cli.utils import (context, ensure_str, kubectl, pick_pod,
-                                   template_env)
-
-
-def events_text():
+from future_lain_cli.kube import (Event, Informer, KubeError, Pod,
+                                  events_table, pods_table, tell_kube_client)
+from future_lain_cli.probe import IngressProber
+from future_lain_cli.utils import (context, error, tell_kubeconfig,
+                                   tell_template_env)
+
+
+class PodEvents:
+    """events of the one pod that events_text is showing. the watch is
+    scoped on the server with involvedObject.name, and only moves when
+    another pod needs attention, so lain status never watches every event
+    in a shared namespace"""
+
+    def __init__(self, client, on_change=None):
+        self.client = client
+        self.on_change = on_change
+        self.pod_name = None
+        self.informer = None
+        self.lock = threading.Lock()
+
+    def informer_for(self, pod_name):
+        with self.lock:
+            if pod_name != self.pod_name:
+                self.stop()
+                self.pod_name = pod_name
+                self.informer = Informer(
+                    self.client, 'events', Event.from_manifest,
+                    field_selector=f'involvedObject.kind=Pod,involvedObject.name={pod_name}',
+                    on_change=self.on_change,
+                ).start()
+
+            return self.informer
+
+    def stop(self):
+        if self.informer:
+            self.informer.stop()
+
+
+def events_text(pod_informer, pod_events, read_log):
     """display events for pending pods"""
-    pod_name = pick_pod(phase='Pending')
-    if pod_name:
-        events = kubectl('get', 'event', '--field-selector', f'involvedObject.name={pod_name}', capture_output=True)
-        return ensure_str(events.stdout)
-    pod_name = pick_pod(phase='Failed')
-    if pod_name:
-        events = kubectl('get', 'pod', f'{pod_name}', '-ojsonpath={.status.containerStatuses..message}', capture_output=True)
-        res = ensure_str(events.stdout)
-        if res:
-            return res
-        logs = kubectl('logs', '--tail=50', f'{pod_name}', capture_output=True)
-        return ensure_str(logs.stdout)
+    if pod_informer.error:
+        return pod_informer.error
+    pods = sorted(pod_informer.items(), key=lambda p: p.name)
+    pending = [p for p in pods if p.phase == 'Pending']
+    if pending:
+        event_informer = pod_events.informer_for(pending[-1].name)
+        if event_informer.error:
+            return event_informer.error
+        if not event_informer.synced.is_set():
+            return 'loading...'
+        return events_table(event_informer.items())
+    failed = [p for p in pods if p.phase == 'Failed']
+    if failed:
+        pod = failed[-1]
+        if pod.container_messages:
+            return ' '.join(pod.container_messages)
+        return read_log(pod.name)
     return 'everything under control'
 
 
-def pod_text():
-    ctx = context()
-    appname = ctx.obj['appname']
-    res = kubectl(
-        'get', 'po', '-o=wide',
-        # add this sort so that abnormal pods appear on top
-        '--sort-by={.status.phase}',
-        '--field-selector=status.phase!=Succeeded',
-        '-l', f'app.kubernetes.io/name={appname}',
-        capture_output=True)
-    return ensure_str(res.stdout)
-
-
-def test_url(url):
-    try:
-        res = requests.get(url, timeout=1)
-    except Exception as e:
-        return e
-    return res
+def pod_text(pod_informer):
+    if pod_informer.error:
+        return pod_informer.error
+    if not pod_informer.synced.is_set():
+        return 'loading...'
+    # add this sort so that abnormal pods appear on top
+    pods = sorted(pod_informer.items(), key=lambda p: (p.phase, p.name))
+    return pods_table(pods, wide=True)
 
 
 ingress_text_str = '''{%- for res in results %}
-{{ res.url }}   {{ res.status }}   {{ res.text | brief }}
+{%- if res.count %}
+{{ res.url }}   {{ res.status }}   p50 {{ '%.0f' | format(res.p50) }}ms   p95 {{ '%.0f' | format(res.p95) }}ms   p99 {{ '%.0f' | format(res.p99) }}ms   err {{ '%.0f' | format(res.error_rate) }}% of {{ res.count }}   {{ res.text | brief }}
+{%- else %}
+{{ res.url }}   {{ res.status }}
+{%- endif %}
 {%- endfor %}
 '''
-ingress_text_template = template_env.from_string(ingress_text_str)
 
 
-def ingress_text():
-    ctx = context()
-    urls = ctx.obj['urls']
-    rl = []
-    # why use ThreadPoolExecutor?
-    # because we can't use loop.run_until_complete in the main thread
-    # and why is that?
-    # because prompt_toolkit application itself runs in a asyncio eventloop
-    # you can't tell the current eventloop to run something for you if the
-    # invoker itself lives in that eventloop
-    # ref: https://bugs.python.org/issue22239
-    with ThreadPoolExecutor(max_workers=len(urls)) as e:
-        for url in urls:
-            rl.append(e.submit(test_url, url))
-
-    def tidy_report(re):
-        report = {'url': re.request.url}
-        if isinstance(re, requests.Response):
-            report.update({
-                'status': re.status_code,
-                'text': re.text,
-            })
-        elif isinstance(re, requests.exceptions.RequestException):
-            report.update({
-                'status': re.__class__.__name__,
-                'text': str(re),
-            })
-        else:
-            raise ValueError(f'never seen this request result: {re}')
-        return report
-
-    results = [tidy_report(future.result()) for future in rl]
-    render_ctx = {'results': results}
-    res = ingress_text_template.render(**render_ctx)
-    return res
+def ingress_text(template, prober):
+    return template.render(results=prober.reports())
 
 
 # prompt_toolkit window without cursor"""
@@ -99,11 +96,42 @@ Win = partial(Window, always_hide_cursor=True, wrap_lines=True)
 Title = partial(FormattedTextControl, style='fg:GreenYellow')
 
 
-def build(refresh_interval=2):
+def build():
     ctx = context()
     appname = ctx.obj['appname']
+    urls = ctx.obj['urls']
+    try:
+        client = tell_kube_client(tell_kubeconfig())
+    except KubeError as e:
+        error(e, exit=1)
+
+    app = None
+
+    def redraw():
+        if app:
+            app.invalidate()
+
+    # pods and events are watched rather than polled, the screen is redrawn
+    # only when something actually changed
+    pod_informer = Informer(
+        client, 'pods', Pod.from_manifest,
+        label_selector=f'app.kubernetes.io/name={appname}',
+        field_selector='status.phase!=Succeeded',
+        on_change=redraw,
+    ).start()
+    pod_events = PodEvents(client, on_change=redraw)
+    ctx.call_on_close(pod_informer.stop)
+    ctx.call_on_close(pod_events.stop)
+
+    @lru_cache(maxsize=16)
+    def read_log(pod_name):
+        try:
+            return client.read_pod_log(pod_name, tail_lines=50)
+        except KubeError as e:
+            return str(e)
+
     # building kube container
-    pod_text_control = FormattedTextControl(text=pod_text)
+    pod_text_control = FormattedTextControl(text=partial(pod_text, pod_informer))
     pod_win = Win(content=pod_text_control)
     pod_container = HSplit([
         Win(
@@ -113,7 +141,7 @@ def build(refresh_interval=2):
         pod_win,
     ])
     # building events container
-    events_text_control = FormattedTextControl(text=events_text)
+    events_text_control = FormattedTextControl(text=partial(events_text, pod_informer, pod_events, read_log))
     events_window = Win(content=events_text_control)
     events_container = HSplit([
         Win(
@@ -124,9 +152,12 @@ def build(refresh_interval=2):
     ])
     parts = [pod_container, events_container]
     # building ingress container
-    urls = ctx.obj['urls']
     if urls:
-        ingress_text_control = FormattedTextControl(text=ingress_text)
+        # urls are probed in the background, on their own schedule
+        prober = IngressProber(urls, on_change=redraw).start()
+        ctx.call_on_close(prober.stop)
+        ingress_text_template = tell_template_env().from_string(ingress_text_str)
+        ingress_text_control = FormattedTextControl(text=partial(ingress_text, ingress_text_template, prober))
         ingress_window = Win(content=ingress_text_control, height=len(urls) + 3, always_hide_cursor=True)
         ingress_container = HSplit([
             Win(height=1, content=Title(f'url requests')),
@@ -144,7 +175,6 @@ def build(refresh_interval=2):
         event.app.exit()
 
     app = Application(
-        refresh_interval=refresh_interval,
         key_bindings=kb,
         layout=Layout(root_container),
         full_screen=True,
@@ -0,0 +1,252 @@
+"""build images with BuildKit, through a local `docker buildx`, rather than
+legacy_lain:
+
+    lain build --buildkit
+    lain build --buildkit --push
+
+the build and release clauses in chart/values.yaml are turned into a single
+multi-stage Dockerfile:
+
+    prepare  FROM build.base, runs build.prepare.script, keeps build.prepare.keep,
+             with --push, pushed as prepare-[VERSION], and just like
+             legacy_lain, only rebuilt when build.prepare.version changes
+    build    FROM the prepare image, or the prepare stage when the image isn't
+             in the registry and nothing is pushed, with the source copied
+             in, runs build.script
+    release  the build stage, or FROM release.dest_base with release.copy
+    meta     FROM scratch, with chart/values.yaml as /lain.yaml
+
+release and meta don't depend on each other, and are built concurrently. build
+cache is kept in the cluster registry (buildcache-[TARGET] tags), pushed with
+mode=max on every --push, so CI runners share layers even when they've never
+built the app before. without --push, nothing at all is written to the
+registry, images are loaded into the local docker. the cluster registries are
+plain http, the buildx builder must be told so, see insecure registries in
+buildkitd.toml"""
+import re
+import shlex
+import time
+from os.path import isabs, join
+from tempfile import NamedTemporaryFile
+
+import requests
+
+from future_lain_cli.kube import format_table
+from future_lain_cli.utils import (CHART_DIR_NAME, Registry, context, echo,
+                                   error, goodjob, run_concurrently,
+                                   subprocess_run, tell_cluster_info,
+                                   tell_meta_version)
+
+DOCKER = 'docker'
+APP_DIR = '/lain/app'
+# buildkit --progress=plain output, a step is announced by its header, and
+# later concluded by its result, other lines of the same step are its output
+STEP_HEADER = re.compile(r'^#(\d+) \[([\w.-]+) \d+/\d+\] ')
+STEP_RESULT = re.compile(r'^#(\d+) (?:(CACHED)|DONE ([\d.]+)s)')
+
+
+def tell_app_path(path):
+    return path if isabs(path) else join(APP_DIR, path)
+
+
+def tell_script(script):
+    """one RUN per script line, so that each of them is a cached layer"""
+    return [f'RUN {line}' for line in script or ()]
+
+
+def tell_dockerfile(values, prepare_image=None):
+    """
+    >>> values = {
+    ...     'build': {
+    ...         'base': 'python:3.7',
+    ...         'prepare': {'version': 1, 'script': ['pip install -r requirements.txt'], 'keep': ['src']},
+    ...         'script': ['make'],
+    ...     },
+    ...     'release': {'dest_base': 'python:3.7-slim', 'copy': [{'src': 'dist', 'dest': '/usr/lib/dummy'}, 'run.py']},
+    ... }
+    >>> print(tell_dockerfile(values, prepare_image='registry.lain.ein.plus/dummy:prepare-1'))
+    FROM python:3.7 AS prepare
+    WORKDIR /lain/app
+    COPY . /lain/app/
+    RUN pip install -r requirements.txt
+    RUN find /lain/app -mindepth 1 -maxdepth 1 ! -name src -exec rm -rf {} +
+    <BLANKLINE>
+    FROM registry.lain.ein.plus/dummy:prepare-1 AS build
+    WORKDIR /lain/app
+    COPY . /lain/app/
+    RUN make
+    <BLANKLINE>
+    FROM python:3.7-slim AS release
+    WORKDIR /lain/app
+    COPY --from=build /lain/app/dist /usr/lib/dummy
+    COPY --from=build /lain/app/run.py /lain/app/run.py
+    <BLANKLINE>
+    FROM scratch AS meta
+    COPY chart/values.yaml /lain.yaml
+    """
+    build = values['build']
+    prepare = build.get('prepare')
+    lines = []
+    if prepare:
+        keep = {path.strip('/').split('/', 1)[0] for path in prepare.get('keep') or ()}
+        not_kept = ''.join(f'! -name {shlex.quote(name)} ' for name in sorted(keep))
+        lines.extend([
+            f'FROM {build["base"]} AS prepare',
+            f'WORKDIR {APP_DIR}',
+            f'COPY . {APP_DIR}/',
+            *tell_script(prepare.get('script')),
+            f'RUN find {APP_DIR} -mindepth 1 -maxdepth 1 {not_kept}-exec rm -rf {{}} +',
+            '',
+        ])
+
+    lines.extend([
+        f'FROM {prepare_image or build["base"]} AS build',
+        f'WORKDIR {APP_DIR}',
+        f'COPY . {APP_DIR}/',
+        *tell_script(build.get('script')),
+        '',
+    ])
+    release = values.get('release') or {}
+    if release.get('dest_base'):
+        lines.extend([f'FROM {release["dest_base"]} AS release', f'WORKDIR {APP_DIR}'])
+        for copy in release.get('copy') or ():
+            src, dest = (copy, copy) if isinstance(copy, str) else (copy['src'], copy.get('dest') or copy['src'])
+            lines.append(f'COPY --from=build {tell_app_path(src)} {tell_app_path(dest)}')
+    else:
+        lines.append('FROM build AS release')
+
+    lines.extend(['', 'FROM scratch AS meta', f'COPY {CHART_DIR_NAME}/values.yaml /lain.yaml'])
+    return '\n'.join(lines)
+
+
+def parse_buildkit_progress(lines):
+    """{stage: {'steps': n, 'cached': n, 'seconds': n}} out of buildkit
+    output, steps that don't belong to a stage (loading context, exporting)
+    are left out
+    >>> lines = [
+    ...     '#5 [build 1/2] FROM docker.io/library/python:3.7',
+    ...     '#6 [build 2/2] RUN make',
+    ...     '#5 CACHED',
+    ...     '#6 0.312 cc -o dummy dummy.c',
+    ...     '#6 DONE 2.5s',
+    ...     '#7 exporting to image',
+    ...     '#7 DONE 0.1s',
+    ... ]
+    >>> parse_buildkit_progress(lines)
+    {'build': {'steps': 2, 'cached': 1, 'seconds': 2.5}}
+    """
+    stage_of = {}
+    stats = {}
+    for line in lines:
+        m = STEP_HEADER.match(line)
+        if m:
+            stage_of[m.group(1)] = m.group(2)
+            stats.setdefault(m.group(2), {'steps': 0, 'cached': 0, 'seconds': 0})
+            continue
+        m = STEP_RESULT.match(line)
+        if not m or m.group(1) not in stage_of:
+            continue
+        stage = stats[stage_of.pop(m.group(1))]
+        stage['steps'] += 1
+        if m.group(2):
+            stage['cached'] += 1
+        else:
+            stage['seconds'] = round(stage['seconds'] + float(m.group(3)), 2)
+
+    return stats
+
+
+def ensure_buildx():
+    res = subprocess_run([DOCKER, 'buildx', 'version'], capture_output=True)
+    if res.returncode:
+        error(f'docker buildx is required for --buildkit, {res.stderr.decode("utf-8").strip()}', exit=1)
+
+
+def buildx_cmd(dockerfile, target, image, cache_image, push=False):
+    """cache is always read from the registry, but only written by builds
+    that push, which have access to it anyway"""
+    cmd = [
+        DOCKER, 'buildx', 'build', '--progress=plain', '-f', dockerfile, '--target', target, '-t', image,
+        '--cache-from', f'type=registry,ref={cache_image}',
+    ]
+    if push:
+        cmd.extend(['--cache-to', f'type=registry,ref={cache_image},mode=max', '--push'])
+    else:
+        cmd.append('--load')
+
+    cmd.append('.')
+    return cmd
+
+
+def build_images(push=False):
+    """build release and meta images for chart/values.yaml, print what each
+    stage took and how much of it was cached, return {target: image}"""
+    ctx = context()
+    appname = ctx.obj['appname']
+    values = ctx.obj['values']
+    if 'build' not in values:
+        error(f'no build clause in {CHART_DIR_NAME}/values.yaml, nothing to build', exit=1)
+    ensure_buildx()
+    registry = Registry(tell_cluster_info()['registry'])
+    meta_version = tell_meta_version()
+    images = {target: registry.make_image(f'{target}-{meta_version}') for target in ('release', 'meta')}
+    prepare = values['build'].get('prepare')
+    prepare_tag = prepare and f'prepare-{prepare.get("version", 0)}'
+    prepare_image = prepare_tag and registry.make_image(prepare_tag)
+    try:
+        prepare_exists = bool(prepare_image) and registry.has_tag(appname, prepare_tag)
+    except requests.exceptions.RequestException as e:
+        error(f'cannot tell if {prepare_image} exists: {e}', exit=1)
+
+    if prepare_exists:
+        echo(f'{prepare_image} already exists, bump build.prepare.version to rebuild it', err=True)
+    elif prepare_image and not push:
+        # nothing may be pushed, so the build stage is FROM the prepare stage
+        # within the same build, rather than an image in the registry
+        prepare_image = 'prepare'
+
+    outputs, results = {}, {}
+    start = time.perf_counter()
+    with NamedTemporaryFile('w', suffix='.Dockerfile') as dockerfile:
+        dockerfile.write(tell_dockerfile(values, prepare_image=prepare_image))
+        dockerfile.flush()
+
+        def build(targets, push):
+            cmds = {
+                target: buildx_cmd(dockerfile.name, target, image, registry.make_image(f'buildcache-{target}'), push=push)
+                for target, image in targets.items()
+            }
+            results.update(run_concurrently(cmds, outputs=outputs))
+            for target, (returncode, _) in results.items():
+                if returncode:
+                    error(f'{target} build failed', exit=returncode)
+
+        if prepare_image and push and not prepare_exists:
+            # build stage is FROM the prepare image, which must be pushed
+            # for the builder to see it
+            build({'prepare': prepare_image}, push=True)
+
+        build(images, push=push)
+
+    wall = time.perf_counter() - start
+    rows = []
+    hits = total = 0
+    for target, (_, seconds) in results.items():
+        stages = parse_buildkit_progress(outputs[target])
+        for stage, stats in stages.items():
+            rows.append([target, stage, f'{stats["cached"]}/{stats["steps"]}', f'{stats["seconds"]:.2f}s'])
+
+        target_hits = sum(stats['cached'] for stats in stages.values())
+        target_steps = sum(stats['steps'] for stats in stages.values())
+        rows.append([target, '(total)', f'{target_hits}/{target_steps}', f'{seconds:.2f}s'])
+        hits += target_hits
+        total += target_steps
+
+    echo(format_table(['TARGET', 'STAGE', 'CACHED', 'DURATION'], rows), err=True)
+    echo(
+        f'cache hit ratio {hits}/{total} ({hits / (total or 1):.0%}), '
+        f'build took {wall:.2f}s, {sum(seconds for _, seconds in results.values()):.2f}s if run one by one',
+        err=True,
+    )
+    goodjob(f'built {", ".join(images.values())}' + (', and pushed' if push else ''))
+    return images
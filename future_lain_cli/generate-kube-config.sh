@@ -25,6 +25,7 @@ rules:
   verbs:
   - list
   - get
+  - watch
 - apiGroups:
   - ""
   - "apps"
@@ -45,6 +46,7 @@ rules:
   verbs:
   - list
   - get
+  - watch
   - create
   - patch
   - update
@@ -0,0 +1,629 @@
+"""a small in-process Kubernetes API client for the read paths.
+
+every kubectl call costs a fork/exec plus a fresh TLS handshake, this client
+keeps one pooled keep-alive session to the apiserver instead. kubectl is still
+used for interactive stuff (exec, logs -f) and kubectl apply"""
+import base64
+import json
+import threading
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from os import stat
+from os.path import expanduser, realpath
+from tempfile import NamedTemporaryFile
+from typing import List, Optional
+
+from future_lain_cli import transport
+from future_lain_cli.trace import span, tell_size
+from future_lain_cli.transport import CassetteMiss
+
+DEFAULT_KUBECONFIG = '~/.kube/config'
+NAMESPACE = 'default'
+# resources outside the core api group
+API_PATHS = {
+    'deployments': '/apis/apps/v1',
+}
+
+
+class KubeError(Exception):
+
+    def __init__(self, status_code, message):
+        self.status_code = status_code
+        self.message = message
+        super().__init__(f'{status_code}: {message}')
+
+
+def parse_timestamp(s):
+    """
+    >>> parse_timestamp('2019-11-22T08:39:01Z')
+    datetime.datetime(2019, 11, 22, 8, 39, 1, tzinfo=datetime.timezone.utc)
+    >>> parse_timestamp('2019-11-22T08:39:01.123456Z')
+    datetime.datetime(2019, 11, 22, 8, 39, 1, tzinfo=datetime.timezone.utc)
+    >>> parse_timestamp(None)
+    """
+    if not s:
+        return None
+    # MicroTime fields like eventTime come with fractional seconds, who cares
+    return datetime.strptime(s[:19], '%Y-%m-%dT%H:%M:%S').replace(tzinfo=timezone.utc)
+
+
+def tell_age(dt, now=None):
+    """mimic the AGE column of kubectl get
+    >>> from datetime import timedelta
+    >>> now = datetime(2019, 11, 22, tzinfo=timezone.utc)
+    >>> tell_age(now - timedelta(seconds=42), now=now)
+    '42s'
+    >>> tell_age(now - timedelta(minutes=3, seconds=5), now=now)
+    '3m5s'
+    >>> tell_age(now - timedelta(hours=5, minutes=1), now=now)
+    '5h1m'
+    >>> tell_age(now - timedelta(days=3, hours=5), now=now)
+    '3d5h'
+    >>> tell_age(None)
+    '<unknown>'
+    """
+    if not dt:
+        return '<unknown>'
+    now = now or datetime.now(timezone.utc)
+    seconds = max(int((now - dt).total_seconds()), 0)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    days, hours = divmod(hours, 24)
+    if days:
+        return f'{days}d{hours}h' if hours else f'{days}d'
+    if hours:
+        return f'{hours}h{minutes}m' if minutes else f'{hours}h'
+    if minutes:
+        return f'{minutes}m{seconds}s' if seconds else f'{minutes}m'
+    return f'{seconds}s'
+
+
+@dataclass
+class Pod:
+    name: str
+    phase: str
+    labels: dict
+    container_statuses: list
+    resource_version: str = ''
+    created: Optional[datetime] = None
+    deleted: Optional[datetime] = None
+    ip: str = ''
+    node: str = ''
+    reason: str = ''
+    message: str = ''
+    manifest: dict = field(default_factory=dict, repr=False)
+
+    @classmethod
+    def from_manifest(cls, dic):
+        metadata = dic.get('metadata', {})
+        spec = dic.get('spec', {})
+        status = dic.get('status', {})
+        return cls(
+            name=metadata['name'],
+            phase=status.get('phase', 'Unknown'),
+            labels=metadata.get('labels') or {},
+            container_statuses=status.get('containerStatuses') or [],
+            resource_version=metadata.get('resourceVersion', ''),
+            created=parse_timestamp(metadata.get('creationTimestamp')),
+            deleted=parse_timestamp(metadata.get('deletionTimestamp')),
+            ip=status.get('podIP', ''),
+            node=spec.get('nodeName', ''),
+            reason=status.get('reason', ''),
+            message=status.get('message', ''),
+            manifest=dic,
+        )
+
+    @property
+    def ready(self):
+        total = len(self.container_statuses) or len(self.manifest.get('spec', {}).get('containers', []))
+        ready = sum(1 for s in self.container_statuses if s.get('ready'))
+        return f'{ready}/{total}'
+
+    @property
+    def restarts(self):
+        return sum(s.get('restartCount', 0) for s in self.container_statuses)
+
+    @property
+    def status(self):
+        """mimic the STATUS column of kubectl get po, which is far more
+        useful than status.phase"""
+        if self.deleted:
+            return 'Terminating'
+        status = self.reason or self.phase
+        for s in self.container_statuses:
+            state = s.get('state', {})
+            waiting = state.get('waiting') or {}
+            terminated = state.get('terminated') or {}
+            if waiting.get('reason'):
+                status = waiting['reason']
+            elif terminated.get('reason'):
+                status = terminated['reason']
+
+        return status
+
+    @property
+    def container_messages(self):
+        messages = []
+        for s in self.container_statuses:
+            for state in s.get('state', {}).values():
+                if state and state.get('message'):
+                    messages.append(state['message'])
+
+        return messages
+
+
+@dataclass
+class Secret:
+    name: str
+    data: dict
+    resource_version: str = ''
+    manifest: dict = field(default_factory=dict, repr=False)
+
+    @classmethod
+    def from_manifest(cls, dic):
+        metadata = dic.get('metadata', {})
+        return cls(
+            name=metadata['name'],
+            data=dic.get('data') or {},
+            resource_version=metadata.get('resourceVersion', ''),
+            manifest=dic,
+        )
+
+    def decoded(self):
+        return {k: base64.b64decode(v).decode('utf-8') for k, v in self.data.items()}
+
+
+@dataclass
+class Event:
+    type: str
+    reason: str
+    message: str
+    object_kind: str
+    object_name: str
+    count: int = 1
+    last_seen: Optional[datetime] = None
+    manifest: dict = field(default_factory=dict, repr=False)
+
+    @classmethod
+    def from_manifest(cls, dic):
+        involved = dic.get('involvedObject', {})
+        return cls(
+            type=dic.get('type', ''),
+            reason=dic.get('reason', ''),
+            message=dic.get('message', ''),
+            object_kind=involved.get('kind', ''),
+            object_name=involved.get('name', ''),
+            count=dic.get('count') or 1,
+            last_seen=parse_timestamp(dic.get('lastTimestamp') or dic.get('eventTime')),
+            manifest=dic,
+        )
+
+
+@dataclass
+class Deployment:
+    name: str
+    generation: int = 0
+    observed_generation: int = 0
+    # spec.replicas
+    desired: int = 0
+    # status.replicas, includes old replicas pending termination
+    replicas: int = 0
+    updated: int = 0
+    ready: int = 0
+    available: int = 0
+    conditions: list = field(default_factory=list)
+    manifest: dict = field(default_factory=dict, repr=False)
+
+    @classmethod
+    def from_manifest(cls, dic):
+        metadata = dic.get('metadata', {})
+        spec = dic.get('spec', {})
+        status = dic.get('status', {})
+        return cls(
+            name=metadata['name'],
+            generation=metadata.get('generation', 0),
+            observed_generation=status.get('observedGeneration', 0),
+            desired=spec.get('replicas', 1),
+            replicas=status.get('replicas', 0),
+            updated=status.get('updatedReplicas', 0),
+            ready=status.get('readyReplicas', 0),
+            available=status.get('availableReplicas', 0),
+            conditions=status.get('conditions') or [],
+            manifest=dic,
+        )
+
+    @property
+    def progress(self):
+        return f'updated {self.updated}/{self.desired}, ready {self.ready}/{self.desired}, available {self.available}/{self.desired}'
+
+    def rollout_status(self):
+        """return (done, message), mimic kubectl rollout status, raise
+        KubeError if the deployment controller has given up
+        >>> Deployment('dummy-web', generation=2, observed_generation=1).rollout_status()
+        (False, 'waiting for deployment spec update to be observed')
+        >>> Deployment('dummy-web', 2, 2, desired=2, replicas=3, updated=2, available=2).rollout_status()
+        (False, '1 old replicas are pending termination')
+        >>> Deployment('dummy-web', 2, 2, desired=2, replicas=2, updated=2, ready=2, available=2).rollout_status()
+        (True, 'successfully rolled out')
+        """
+        if self.observed_generation < self.generation:
+            return False, 'waiting for deployment spec update to be observed'
+        for condition in self.conditions:
+            if condition.get('type') == 'Progressing' and condition.get('reason') == 'ProgressDeadlineExceeded':
+                raise KubeError(None, f'deployment {self.name} exceeded its progress deadline')
+
+        if self.updated < self.desired:
+            return False, f'{self.updated} out of {self.desired} new replicas have been updated'
+        if self.replicas > self.updated:
+            return False, f'{self.replicas - self.updated} old replicas are pending termination'
+        if self.available < self.updated:
+            return False, f'{self.available} of {self.updated} updated replicas are available'
+        return True, 'successfully rolled out'
+
+
+class KubeClient:
+    """talks to the apiserver described by a kubeconfig, using the current
+    context. supports the auth methods lain kubeconfigs actually use: token,
+    basic auth and client certificates"""
+
+    def __init__(self, kubeconfig=None, timeout=2):
+        # imported here to keep lain startup fast
+        import requests
+        import yaml
+        from requests.adapters import HTTPAdapter
+        self.kubeconfig = expanduser(kubeconfig or DEFAULT_KUBECONFIG)
+        self.timeout = timeout
+        with open(self.kubeconfig) as f:
+            config = yaml.load(f, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+
+        current_context = config.get('current-context')
+        context = pick_named(config.get('contexts'), current_context)
+        cluster = pick_named(config.get('clusters'), context['cluster'])
+        user = pick_named(config.get('users'), context.get('user')) if context.get('user') else {}
+        self.namespace = context.get('namespace') or NAMESPACE
+        self.server = cluster['server'].rstrip('/')
+        # requests only takes file paths for certificates, so *-data fields
+        # are written to tempfiles that live as long as this client
+        self.tempfiles = []
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=16)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        if cluster.get('insecure-skip-tls-verify'):
+            session.verify = False
+        else:
+            ca = self.tell_file(cluster, 'certificate-authority')
+            if ca:
+                session.verify = ca
+
+        cert = self.tell_file(user, 'client-certificate')
+        key = self.tell_file(user, 'client-key')
+        if cert and key:
+            session.cert = (cert, key)
+
+        token = user.get('token')
+        if not token and user.get('tokenFile'):
+            with open(expanduser(user['tokenFile'])) as f:
+                token = f.read().strip()
+
+        if token:
+            session.headers['Authorization'] = f'Bearer {token}'
+        elif user.get('username'):
+            session.auth = (user['username'], user.get('password', ''))
+
+        self.session = session
+
+    def tell_file(self, dic, name):
+        if dic.get(name):
+            return expanduser(dic[name])
+        data = dic.get(f'{name}-data')
+        if not data:
+            return None
+        f = NamedTemporaryFile(prefix='lain-kube-', suffix='.pem')
+        f.write(base64.b64decode(data))
+        f.flush()
+        self.tempfiles.append(f)
+        return f.name
+
+    def request(self, method, path, params=None, **kwargs):
+        import requests
+        kwargs.setdefault('timeout', self.timeout)
+        with span(f'{method} {path}', 'http', url=f'{self.server}{path}', params=params) as trace_args:
+            try:
+                res = transport.request(self.session, method, f'{self.server}{path}', params=params, **kwargs)
+            except requests.exceptions.RequestException as e:
+                raise KubeError(None, f'cannot reach {self.server}: {e}')
+            except CassetteMiss as e:
+                raise KubeError(None, str(e))
+            # streamed responses are still being read, only the headers are in
+            if kwargs.get('stream'):
+                content_length = res.headers.get('Content-Length')
+                bytes_in = int(content_length) if content_length else None
+            else:
+                bytes_in = len(res.content)
+            trace_args.update(status=res.status_code, bytes_out=tell_size(res.request.body), bytes_in=bytes_in)
+
+        if res.status_code >= 400:
+            try:
+                message = res.json().get('message') or res.text
+            except ValueError:
+                message = res.text
+            raise KubeError(res.status_code, message)
+        return res
+
+    def get(self, path, params=None, **kwargs):
+        return self.request('GET', path, params=params, **kwargs)
+
+    def namespaced(self, resource, name=None, api=None):
+        api = api or API_PATHS.get(resource, '/api/v1')
+        path = f'{api}/namespaces/{self.namespace}/{resource}'
+        if name:
+            path = f'{path}/{name}'
+        return path
+
+    def list(self, resource, label_selector=None, field_selector=None):
+        """return (items, resourceVersion), the latter is used to start a
+        watch from"""
+        params = {'labelSelector': label_selector, 'fieldSelector': field_selector}
+        res = self.get(self.namespaced(resource), params=params).json()
+        return res['items'], res['metadata'].get('resourceVersion')
+
+    def watch(self, resource, resource_version, label_selector=None, field_selector=None, timeout_seconds=300):
+        """yield (event type, manifest) until the apiserver ends this watch,
+        which happens every timeout_seconds"""
+        params = {
+            'labelSelector': label_selector,
+            'fieldSelector': field_selector,
+            'resourceVersion': resource_version,
+            'timeoutSeconds': timeout_seconds,
+            'allowWatchBookmarks': 'true',
+            'watch': 1,
+        }
+        import requests
+        res = self.get(self.namespaced(resource), params=params, stream=True, timeout=(self.timeout, timeout_seconds + 5))
+        with res:
+            try:
+                for line in res.iter_lines():
+                    if not line:
+                        continue
+                    event = json.loads(line)
+                    yield event['type'], event['object']
+            except requests.exceptions.RequestException as e:
+                raise KubeError(None, f'watch on {resource} interrupted: {e}')
+
+    def list_pods(self, label_selector=None, field_selector=None) -> List[Pod]:
+        items, _ = self.list('pods', label_selector=label_selector, field_selector=field_selector)
+        return [Pod.from_manifest(dic) for dic in items]
+
+    def read_pod_log(self, name, tail_lines=None) -> str:
+        res = self.get(self.namespaced('pods', name) + '/log', params={'tailLines': tail_lines})
+        return res.text
+
+    def stream_pod_log(self, name, tail_lines=None, since_seconds=None, follow=True):
+        """yield log lines as they come, until the container exits or the pod
+        is gone"""
+        import requests
+        params = {'follow': 'true' if follow else None, 'tailLines': tail_lines, 'sinceSeconds': since_seconds}
+        # no read timeout, a quiet pod is not a dead pod
+        res = self.get(self.namespaced('pods', name) + '/log', params=params, stream=True, timeout=(self.timeout, None))
+        with res:
+            try:
+                for line in res.iter_lines():
+                    yield line.decode('utf-8', errors='replace')
+            except requests.exceptions.RequestException as e:
+                raise KubeError(None, f'log stream of {name} interrupted: {e}')
+
+    def list_events(self, field_selector=None) -> List[Event]:
+        items, _ = self.list('events', field_selector=field_selector)
+        return [Event.from_manifest(dic) for dic in items]
+
+    def read_secret(self, name) -> Optional[Secret]:
+        """return None if secret doesn't exist"""
+        try:
+            res = self.get(self.namespaced('secrets', name))
+        except KubeError as e:
+            if e.status_code == 404:
+                return None
+            raise
+        return Secret.from_manifest(res.json())
+
+    def create_secret(self, name, data) -> Secret:
+        """data is plaintext, will be b64encoded here"""
+        manifest = {
+            'apiVersion': 'v1',
+            'kind': 'Secret',
+            'type': 'Opaque',
+            'metadata': {'name': name, 'namespace': self.namespace},
+            'data': {k: base64.b64encode(v.encode('utf-8')).decode('utf-8') for k, v in data.items()},
+        }
+        res = self.request('POST', self.namespaced('secrets'), json=manifest)
+        return Secret.from_manifest(res.json())
+
+    def patch(self, resource, name, patch):
+        """strategic merge patch, lists like containers are merged by name"""
+        res = self.request(
+            'PATCH',
+            self.namespaced(resource, name),
+            data=json.dumps(patch),
+            headers={'Content-Type': 'application/strategic-merge-patch+json'},
+        )
+        return res.json()
+
+    def read_deployment(self, name) -> Deployment:
+        res = self.get(self.namespaced('deployments', name))
+        return Deployment.from_manifest(res.json())
+
+    def set_image(self, deployment, container, image) -> Deployment:
+        """containers are merged by name, patching a container that doesn't
+        exist would add a second, image-only container, so check first"""
+        manifest = self.read_deployment(deployment).manifest
+        containers = manifest['spec']['template']['spec']['containers']
+        if container not in {c['name'] for c in containers}:
+            raise KubeError(422, f'deployment {deployment} has no container named {container}')
+        patch = {'spec': {'template': {'spec': {'containers': [{'name': container, 'image': image}]}}}}
+        return Deployment.from_manifest(self.patch('deployments', deployment, patch))
+
+
+class Informer:
+    """list, then watch a resource, and keep a local cache of the objects.
+    on_change is called (from the informer thread) whenever the cache changes,
+    so consumers redraw only when there's actually something new, instead of
+    polling the apiserver"""
+
+    def __init__(self, client, resource, parse, label_selector=None, field_selector=None, on_change=None, backoff=2):
+        self.client = client
+        self.resource = resource
+        self.parse = parse
+        self.label_selector = label_selector
+        self.field_selector = field_selector
+        self.on_change = on_change
+        self.backoff = backoff
+        self.cache = {}
+        self.error = None
+        self.lock = threading.Lock()
+        self.synced = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name=f'informer-{resource}', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    def items(self):
+        with self.lock:
+            return list(self.cache.values())
+
+    def notify(self):
+        if self.on_change:
+            self.on_change()
+
+    def relist(self):
+        items, resource_version = self.client.list(
+            self.resource, label_selector=self.label_selector, field_selector=self.field_selector,
+        )
+        with self.lock:
+            self.cache = {dic['metadata']['name']: self.parse(dic) for dic in items}
+
+        self.error = None
+        self.synced.set()
+        self.notify()
+        return resource_version
+
+    def run(self):
+        resource_version = None
+        while not self.stopped.is_set():
+            try:
+                if not resource_version:
+                    resource_version = self.relist()
+
+                resource_version = self.watch(resource_version)
+            except KubeError as e:
+                # 410 Gone means our resourceVersion is too old, relist
+                # right away. for other errors, show them and retry later
+                resource_version = None
+                if e.status_code != 410:
+                    self.error = str(e)
+                    self.notify()
+                    self.stopped.wait(self.backoff)
+
+    def watch(self, resource_version):
+        """apply watch events to cache, return the last seen
+        resourceVersion so that the next watch picks up where this one left"""
+        events = self.client.watch(
+            self.resource, resource_version, label_selector=self.label_selector, field_selector=self.field_selector,
+        )
+        for event_type, dic in events:
+            if self.stopped.is_set():
+                break
+            if event_type == 'ERROR':
+                raise KubeError(dic.get('code'), dic.get('message'))
+            resource_version = dic['metadata'].get('resourceVersion') or resource_version
+            if event_type == 'BOOKMARK':
+                continue
+            name = dic['metadata']['name']
+            with self.lock:
+                if event_type == 'DELETED':
+                    self.cache.pop(name, None)
+                else:
+                    self.cache[name] = self.parse(dic)
+
+            self.notify()
+
+        return resource_version
+
+
+def pick_named(items, name):
+    """kubeconfig stores contexts, clusters and users like
+    [{'name': name, 'context': {...}}], return the inner dict"""
+    for item in items or ():
+        if item.get('name') == name:
+            return next(v for k, v in item.items() if k != 'name')
+
+    raise KubeError(None, f'{name!r} not found in kubeconfig')
+
+
+# clients are reused across calls, keyed by the resolved kubeconfig file, so
+# `lain use` takes effect even within the same process
+kube_clients = {}
+
+
+def tell_kube_client(kubeconfig=None):
+    path = realpath(expanduser(kubeconfig or DEFAULT_KUBECONFIG))
+    try:
+        key = (path, stat(path).st_mtime_ns)
+    except FileNotFoundError:
+        raise KubeError(None, f'{path} not found, you should first `lain use [CLUSTER]`')
+
+    client = kube_clients.get(key)
+    if not client:
+        client = kube_clients[key] = KubeClient(path)
+
+    return client
+
+
+def pods_table(pods, wide=False):
+    """render pods like kubectl get po"""
+    headers = ['NAME', 'READY', 'STATUS', 'RESTARTS', 'AGE']
+    if wide:
+        headers.extend(['IP', 'NODE'])
+
+    rows = []
+    for pod in pods:
+        row = [pod.name, pod.ready, pod.status, str(pod.restarts), tell_age(pod.created)]
+        if wide:
+            row.extend([pod.ip or '<none>', pod.node or '<none>'])
+
+        rows.append(row)
+
+    return format_table(headers, rows)
+
+
+def events_table(events):
+    """render events like kubectl get event"""
+    headers = ['LAST SEEN', 'TYPE', 'REASON', 'OBJECT', 'MESSAGE']
+    rows = [
+        [tell_age(e.last_seen), e.type, e.reason, f'{e.object_kind.lower()}/{e.object_name}', e.message]
+        for e in events
+    ]
+    return format_table(headers, rows)
+
+
+def format_table(headers, rows):
+    """
+    >>> print(format_table(['NAME', 'AGE'], [['dummy-web', '3m'], ['x', '42s']]))
+    NAME        AGE
+    dummy-web   3m
+    x           42s
+    """
+    if not rows:
+        return 'No resources found.'
+    widths = [max(len(r[i]) for r in [headers, *rows]) for i in range(len(headers))]
+    lines = []
+    for row in [headers, *rows]:
+        cells = [cell.ljust(width) for cell, width in zip(row[:-1], widths)]
+        lines.append('   '.join([*cells, row[-1]]))
+
+    return '\n'.join(lines)
@@ -1,44 +1,89 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import json
 import os
-import shutil
+import re
+import sys
 from io import StringIO
 from os import getcwd as cwd
-from os.path import basename, dirname, expanduser, isfile, join
+from os.path import basename, expanduser, join
 
 import click
 
 from future_lain_cli import __version__
-from future_lain_cli.app_status import display_app_status
+from future_lain_cli.kube import KubeError, format_table, tell_kube_client
+from future_lain_cli.logs import LogFilter, LogStreamer, parse_duration
+from future_lain_cli.trace import start_tracing, stop_tracing
+from future_lain_cli.transport import (RecordingTransport, ReplayingTransport,
+                                       stop_transport, use_transport)
 from future_lain_cli.utils import (CHART_DIR_NAME, FUTURE_CLUSTERS,
-                                   HELM_WEIRD_STATE, TEMPLATE_DIR, KVPairType,
-                                   Registry, deploy_toast, dump_secret, echo,
-                                   ensure_absent, ensure_helm_initiated,
-                                   ensure_resource_initiated, error,
-                                   example_lain_yaml, find, get_app_status,
-                                   goodjob, helm, init_done_toast,
-                                   is_values_file, kubectl, kubectl_apply,
-                                   kubectl_edit, legacy_lain, pick_pod,
+                                   TEMPLATE_DIR, ClustersType, KVPairType,
+                                   Registry, brief, debug, deploy_toast, echo,
+                                   edit_secret, ensure_absent,
+                                   ensure_helm_initiated, error,
+                                   example_lain_yaml, excall, exec_in_pods,
+                                   explain_values, find, format_dotenv,
+                                   goodjob, group_outputs, helm, helm_cmd,
+                                   import_secret, init_done_toast,
+                                   is_values_file, kubectl, kubectl_cmd,
+                                   legacy_lain, load_chart_manifest,
+                                   load_env_file, pick_pod,
                                    populate_helm_context,
                                    populate_helm_context_from_lain_yaml,
-                                   tell_best_deploy, tell_cluster_info,
-                                   tell_cluster_values_file,
-                                   tell_helm_set_clause, tell_image_tag,
-                                   tell_secret, template_env,
-                                   template_update_toast,
-                                   too_much_logs_headsup, warn, yadu)
+                                   prepare_deploy, report_pod_failure,
+                                   rollback_release, run_concurrently,
+                                   save_chart_manifest, set_images,
+                                   tell_best_deploy, tell_binary,
+                                   tell_chart_manifest_file, tell_cluster_info,
+                                   tell_digest, tell_image_tag,
+                                   tell_kubeconfig, tell_kubeconfig_file,
+                                   tell_meta_version, tell_secret,
+                                   tell_template_env, tell_values_digests,
+                                   tell_yaml, template_update_toast,
+                                   track_rollouts, update_secret,
+                                   using_cluster, warn, watch_helm_upgrade,
+                                   write_if_changed, yadu)
+
+# these commands don't read values.yaml, so lain won't bother parsing it
+COMMANDS_WITHOUT_VALUES = frozenset({'version', 'init', 'use'})
 
 
 @click.group()
 @click.option('--silent', '-s', is_flag=True, help='log as little text as possible')
 @click.option('--verbose', '-v', is_flag=True)
+@click.option('--trace', type=click.Path(dir_okay=False, writable=True), envvar='LAIN_TRACE', help='record every subprocess and http request, and write them to this file in chrome trace format, also LAIN_TRACE')
+@click.option('--record', type=click.Path(dir_okay=False, writable=True), envvar='LAIN_RECORD', help='save every subprocess and http request, and their results, into this cassette, also LAIN_RECORD')
+@click.option('--replay', type=click.Path(exists=True, dir_okay=False), envvar='LAIN_REPLAY', help='serve every subprocess and http request from this cassette, nothing is actually called, also LAIN_REPLAY')
+@click.option('--realtime', is_flag=True, help='when replaying, calls take as long as they did when recorded')
 @click.pass_context
-def lain(ctx, silent, verbose):
+def lain(ctx, silent, verbose, trace, record, replay, realtime):
     """a tool that helps you manage helm charts and kubectl.
     for more, see https://github.com/ein-plus/lain-cli"""
     ctx.obj['silent'] = silent
     ctx.obj['verbose'] = verbose
+    if record and replay:
+        error('cannot --record and --replay at the same time', exit=1)
+    if (record or replay) and not ctx.resilient_parsing:
+        if record:
+            use_transport(RecordingTransport(record))
+        else:
+            use_transport(ReplayingTransport(replay, realtime=realtime))
+
+        ctx.call_on_close(stop_transport)
+
+    if trace and not ctx.resilient_parsing:
+        start_tracing(f'lain {ctx.invoked_subcommand}', argv=sys.argv)
+
+        def save_trace():
+            stop_tracing(trace)
+            debug(f'trace written to {trace}, open it in chrome://tracing or https://ui.perfetto.dev')
+
+        ctx.call_on_close(save_trace)
+
+    # shell completion, and some commands, don't need to know about values
+    if ctx.resilient_parsing or ctx.invoked_subcommand in COMMANDS_WITHOUT_VALUES:
+        return
     try:
         populate_helm_context(ctx.obj)
     except FileNotFoundError:
@@ -53,14 +98,15 @@ def lain(ctx, silent, verbose):
 @click.pass_context
 def init(ctx, appname, lain_yaml, force, template_only):
     """generate a helm chart for your app"""
-    # just using this command to ensure kubectl is downloaded
-    kubectl('version', '--client=true', capture_output=True)
+    # ensure kubectl is downloaded
+    tell_binary('kubectl')
     ctx.obj['appname'] = appname
     populate_helm_context_from_lain_yaml(ctx.obj, lain_yaml)
     # appname could change later during populate_helm_context_from_lain_yaml
     appname = ctx.obj['appname']
     if force:
         ensure_absent(CHART_DIR_NAME)
+        ensure_absent(tell_chart_manifest_file())
 
     try:
         os.mkdir(CHART_DIR_NAME)
@@ -71,23 +117,37 @@ def init(ctx, appname, lain_yaml, force, template_only):
             error(err)
             ctx.exit(1)
 
+    # files are only written when their content actually changed, so that
+    # refreshing an up-to-date chart is close to a no-op
+    manifest = load_chart_manifest()
+    templates = dict(manifest.get('templates') or {})
+    files = dict(manifest.get('files') or {})
     for f in find(TEMPLATE_DIR):
         if is_values_file(f) and template_only:
             continue
         render_dest = join(CHART_DIR_NAME, f.replace('.j2', '', 1))
+        with open(join(TEMPLATE_DIR, f), 'rb') as src:
+            content = src.read()
+
+        templates[f] = tell_digest(content)
         if f.endswith('.j2'):
-            template = template_env.get_template(basename(f))
-            with open(render_dest, 'w') as f:
-                f.write(template.render(**ctx.obj))
-        else:
-            src = join(TEMPLATE_DIR, f)
-            os.makedirs(dirname(render_dest), exist_ok=True)
-            shutil.copyfile(src, render_dest)
+            template = tell_template_env().get_template(basename(f))
+            content = template.render(**ctx.obj).encode('utf-8')
+
+        write_if_changed(render_dest, content)
+        files[render_dest] = tell_digest(content)
+
+    values = tell_values_digests()
+    if manifest.get('files') == files and manifest.get('values') == values:
+        # neither templates nor values changed since the last successful lint
+        echo(f'./{CHART_DIR_NAME} is already up to date')
+        return
 
     res = helm('lint', f'./{CHART_DIR_NAME}')
     if res.returncode:
         ctx.exit(res.returncode)
 
+    save_chart_manifest({'version': __version__, 'templates': templates, 'files': files, 'values': values})
     if template_only:
         template_update_toast()
     else:
@@ -101,25 +161,39 @@ def status(ctx):
     # we don't want stderr outputs to mess with our full screen application
     ctx.obj['silent'] = True
     ensure_helm_initiated()
+    # prompt_toolkit is heavy, only import it when needed
+    from future_lain_cli.app_status import display_app_status
     display_app_status()
 
 
 @lain.command()
 @click.argument('deploy', nargs=-1)
-@click.option('--tail', help='lines of recent log file to display, defaults to 50 if no deploy is specified, otherwise show full log')
+@click.option('--tail', type=int, help='lines of recent log file to display, defaults to 50 if no deploy is specified, otherwise show full log')
+@click.option('--grep', help='only show lines matching this regex')
+@click.option('--json-field', 'fields', multiple=True, type=KVPairType(), help='only show json lines with this field, e.g. --json-field user.id=42')
+@click.option('--level', type=click.Choice(['debug', 'info', 'warning', 'error', 'critical'], case_sensitive=False), help='only show lines at or above this level')
+@click.option('--since', help='only show logs newer than this, e.g. 10m, 1h30m, evaluated by the apiserver')
+@click.option('--sample', type=click.IntRange(min=1), default=1, help='only show 1 of every N matching lines, per pod')
+@click.option('--rate', type=click.IntRange(min=1), help='show at most this many lines per second, excess lines are dropped')
+@click.option('--summary', is_flag=True, help='print matching lines/sec per pod rather than the lines themselves')
 @click.pass_context
-def logs(ctx, deploy, tail):
+def logs(ctx, deploy, tail, grep, fields, level, since, sample, rate, summary):
     """\b
-    tail app log:
+    tail app log, from any number of pods, pods created during a rollout are
+    picked up automatically:
         lain log
         lain log web
+    filter, sample, or just count lines before they ever reach your terminal:
+        lain log web --level error --since 1h
+        lain log --json-field path=/api/login --grep timeout
+        lain log --summary
     """
     ensure_helm_initiated()
     appname = ctx.obj['appname']
     deploy_names = set(ctx.obj['values']['deployments'])
-    tail = 50
+    default_tail = 50
     if deploy:
-        tail = -1
+        default_tail = None
         deploy = deploy[-1]
         if deploy not in deploy_names:
             error(f'deploy {deploy} not found, choose from {deploy_names}', exit=1)
@@ -128,15 +202,57 @@ def logs(ctx, deploy, tail):
     else:
         selector = f'app.kubernetes.io/name={appname}'
 
-    res = kubectl('logs', '-f', f'--tail={tail}', '-l', selector, timeout=0)
-    if res.returncode:
-        too_much_logs_headsup()
+    since_seconds = None
+    if since:
+        try:
+            since_seconds = parse_duration(since)
+        except ValueError as e:
+            error(e, exit=1)
+
+        # with --since, show everything in that window
+        default_tail = None
+
+    if tail is None:
+        tail = default_tail
+
+    try:
+        log_filter = LogFilter(grep=grep, fields=fields, level=level)
+    except re.error as e:
+        error(f'bad --grep pattern: {e}', exit=1)
+
+    try:
+        client = tell_kube_client(tell_kubeconfig())
+    except KubeError as e:
+        error(e, exit=1)
+
+    streamer = LogStreamer(
+        client,
+        selector,
+        tail_lines=tail,
+        since_seconds=since_seconds,
+        log_filter=log_filter if log_filter else None,
+        sample=sample,
+        rate=rate,
+        summary=summary,
+    ).start()
+    try:
+        if summary:
+            streamer.run_summary()
+        else:
+            streamer.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        streamer.stop()
 
 
 @lain.command()
 @click.argument('deploy_and_command', nargs=-1)
+@click.option('--all', 'all_pods', is_flag=True, help='run the command non-interactively in every pod, rather than a shell in one pod')
+@click.option('--concurrency', type=click.IntRange(min=1), default=10, show_default=True, help='with --all, how many pods to exec at the same time')
+@click.option('--diff', is_flag=True, help='with --all, group pods by identical output')
 @click.pass_context
-def x(ctx, deploy_and_command):
+def x(ctx, deploy_and_command, all_pods, concurrency, diff):
     """\b
     this command helps you with kubectl exec, insanely easy to use:
         lain x
@@ -144,9 +260,25 @@ def x(ctx, deploy_and_command):
         lain x worker bash
         lain x web bash -c "ls | grep foo"
         lain x bash -c "ls | grep foo"
+    run in every pod, and see which ones are different:
+        lain x --all --diff web cat /etc/hosts
     """
     ensure_helm_initiated()
     deploy_names = set(ctx.obj['values']['deployments'])
+    if all_pods:
+        if not deploy_and_command:
+            error('a command is required with --all, an interactive shell in every pod makes no sense', exit=1)
+
+        deploy, *cmd = deploy_and_command
+        if deploy not in deploy_names:
+            deploy = None
+            cmd = deploy_and_command
+        elif not cmd:
+            error(f'a command is required with --all, e.g. lain x --all {deploy} ls', exit=1)
+
+        x_all(ctx, deploy, cmd, concurrency, diff)
+        return
+
     if deploy_and_command:
         deploy, *cmd = deploy_and_command
         if deploy not in deploy_names:
@@ -174,6 +306,40 @@ def x(ctx, deploy_and_command):
     kubectl('exec', '-it', podname, *cmd)
 
 
+def x_all(ctx, deploy, cmd, concurrency, diff):
+    """exec cmd in every running pod of deploy (or the whole app), all at once"""
+    appname = ctx.obj['appname']
+    if deploy:
+        selector = f'app.kubernetes.io/instance={appname}-{deploy}'
+    else:
+        selector = f'app.kubernetes.io/name={appname}'
+
+    try:
+        pods = tell_kube_client(tell_kubeconfig()).list_pods(label_selector=selector, field_selector='status.phase=Running')
+    except KubeError as e:
+        error(f'error during listing pods: {e}', exit=1)
+
+    if not pods:
+        error(f'no running pod found for {deploy or appname}', exit=1)
+
+    # exec may take long, so no request timeout here
+    cmds = {pod.name: kubectl_cmd('exec', pod.name, '--', *cmd, timeout=0) for pod in pods}
+    excall(next(iter(cmds.values())))
+    results = exec_in_pods(cmds, concurrency=concurrency, executable=tell_binary('kubectl'))
+    if diff:
+        for (returncode, output), podnames in group_outputs(results):
+            echo(click.style(f'{len(podnames)} pods, exit {returncode}: {", ".join(podnames)}', fg='green' if not returncode else 'red'))
+            # command output is printed verbatim, echo would dedent it
+            click.echo(output.rstrip('\n'))
+    else:
+        for podname, (returncode, output, _) in sorted(results.items()):
+            echo(click.style(f'[{podname}] exit {returncode}', fg='green' if not returncode else 'red'))
+            # command output is printed verbatim, echo would dedent it
+            click.echo(output.rstrip('\n'))
+
+    ctx.exit(max(returncode for returncode, _, _ in results.values()))
+
+
 @lain.command()
 @click.argument('cluster', type=click.Choice(FUTURE_CLUSTERS))
 @click.pass_context
@@ -183,11 +349,7 @@ def use(ctx, cluster):
 
     this command will link kubeconfig of specified CLUSTER to ~/.kube/config,
     so that you don\'t have to type --kubeconfig when using kubectl, or helm"""
-    kubeconfig_file = f'~/.kube/kubeconfig-{cluster}'
-    src = expanduser(kubeconfig_file)
-    if not isfile(src):
-        error(f'{kubeconfig_file} not found, go fetch it from 1pw, under the "kubeconfig" item', exit=1)
-
+    src = tell_kubeconfig_file(cluster)
     dest = expanduser('~/.kube/config')
     ensure_absent(dest)
     os.symlink(src, dest)
@@ -201,9 +363,11 @@ def use(ctx, cluster):
 @lain.command()
 @click.argument('deployments', nargs=-1)
 @click.option('--deduce', is_flag=True, help='use latest imageTag from registry rather than `lain meta`')
+@click.option('--deadline', type=int, default=300, show_default=True, help='exit with error if any rollout makes no progress for this many seconds')
 @click.pass_context
-def update_image(ctx, deployments, deduce):
-    """update, and only update image for some deploy"""
+def update_image(ctx, deployments, deduce, deadline):
+    """update, and only update image for some deploy, then wait for the
+    rollouts to finish"""
     ensure_helm_initiated()
     choices = set(ctx.obj['values']['deployments'].keys())
     if not deployments:
@@ -217,7 +381,7 @@ def update_image(ctx, deployments, deduce):
     registry = Registry(tell_cluster_info()['registry'])
     appname = ctx.obj['appname']
     if deduce:
-        recent_tags = registry.images_list(appname)
+        recent_tags = registry.tags_list(appname)
         if not recent_tags:
             error('wow, there\'s no pushed image at all', exit=1)
 
@@ -226,22 +390,46 @@ def update_image(ctx, deployments, deduce):
         image_tag = tell_image_tag()
 
     image = registry.make_image(image_tag)
-    for deploy in deployments:
-        res = kubectl('set', 'image', f'deployment/{appname}-{deploy}', f'{deploy}={image}', '--all')
-        if res.returncode:
-            error('abort due to kubectl failure, if you don\'t understand the above error output, seek help from SA')
+    try:
+        client = tell_kube_client(tell_kubeconfig())
+    except KubeError as e:
+        error(e, exit=1)
+
+    # all deployments are patched in one go, and their rollouts tracked
+    # concurrently, so this takes as long as the slowest rollout
+    images = {f'{appname}-{deploy}': (deploy, image) for deploy in sorted(deployments)}
+    echo(f'setting image {image} for {", ".join(images)}', err=True)
+    failures = set_images(client, images)
+    for name, e in failures.items():
+        error(f'cannot update deployment/{name}: {e}')
+
+    if failures:
+        error('abort due to kubernetes api failure, if you don\'t understand the above error output, seek help from SA', exit=1)
+
+    failure = track_rollouts(
+        client, list(images), label_selector=f'app.kubernetes.io/name={appname}', deadline=deadline,
+    )
+    if failure:
+        name, reason = failure
+        error(f'rollout of deployment/{name} failed: {reason}', exit=1)
+
+    goodjob(f'image updated for {", ".join(images)}')
 
 
 @lain.command()
 @click.argument('whatever', nargs=-1)
 @click.option('--set', 'pairs', multiple=True, type=KVPairType(), help='Override values in values.yaml, same as helm')
+@click.option('--clusters', type=ClustersType(), help='deploy to multiple lain4 clusters at once, e.g. --clusters future,bei')
+@click.option('--fail-fast/--no-fail-fast', default=True, help='stop and roll back as soon as a new pod is doomed, e.g. CrashLoopBackOff, rather than waiting for helm to time out')
 @click.pass_context
-def deploy(ctx, whatever, pairs):
+def deploy(ctx, whatever, pairs, clusters, fail_fast):
     """\b
     deploy your app.
     for lain4 clusters:
         lain use [CLUSTER]
         lain deploy
+    to deploy to multiple lain4 clusters in parallel, no need to lain use:
+        lain deploy --clusters future,bei
     for legacy clusters, your command will be passed to the legacy version of lain-cli
     """
     if whatever:
@@ -252,44 +440,71 @@ def deploy(ctx, whatever, pairs):
         legacy_lain('deploy', *whatever, exit=True)
 
     ensure_helm_initiated()
-    # no big deal, just using this line to initialized env first
-    # otherwise this deploy may fail because envFrom is referencing a
-    # non-existent secret
-    tell_secret(ctx.obj['env_name'])
-    ensure_resource_initiated(chart=True, secret=True)
-    appname = ctx.obj['appname']
-    status = get_app_status(appname)
-    if status and status['info']['status'] in HELM_WEIRD_STATE:
-        err = f'''Chart deployed but in a weird state. Now do this:
-            helm status {appname}
-            kubectl get po -l app.kubernetes.io/name={appname}
-            kubectl describe pod [POD_NAME]
-            kubectl logs -f pod [POD_NAME]
-        Once you learn and fix the problem, delete this failed install VERY CAREFULLY:
-            helm delete {appname}'''
-        error(err)
-        ctx.exit(1)
+    if clusters:
+        deploy_clusters(ctx, clusters, pairs)
+        return
 
+    helm_args = prepare_deploy(pairs)
     headsup = f'''
     While being deployed, you can use kubectl to check the status of you app:
         lain status
         lain logs
     '''
     echo(headsup, err=True)
-    set_clause = tell_helm_set_clause(pairs)
-    options = ['--atomic', '--install', '--wait', '--set', set_clause]
-    # if chart/values-[CLUSTER].yaml exists, use it
-    values_file = tell_cluster_values_file()
-    if values_file:
-        options.extend(['-f', values_file])
-
-    res = helm('upgrade', *options, appname, f'./{CHART_DIR_NAME}')
-    if res.returncode:
-        ctx.exit(res.returncode)
+    if not fail_fast:
+        res = helm(*helm_args)
+        if res.returncode:
+            ctx.exit(res.returncode)
+
+        deploy_toast()
+        return
+
+    try:
+        client = tell_kube_client(tell_kubeconfig())
+    except KubeError as e:
+        error(e, exit=1)
+
+    appname = ctx.obj['appname']
+    returncode, failure = watch_helm_upgrade(client, helm_args, appname)
+    if failure:
+        pod, reason = failure
+        report_pod_failure(client, pod, reason)
+        error('deploy aborted, rolling back')
+        rollback_release(appname)
+        ctx.exit(1)
+
+    if returncode:
+        ctx.exit(returncode)
 
     deploy_toast()
 
 
+def deploy_clusters(ctx, clusters, pairs):
+    """pre-flight checks run cluster by cluster, then helm upgrades run all at
+    once, each with its own kubeconfig"""
+    if not any(k == 'imageTag' for k, _ in pairs):
+        # same image for every cluster, only need to compute this once
+        pairs = [*pairs, ('imageTag', tell_meta_version())]
+
+    cmds = {}
+    for cluster in clusters:
+        with using_cluster(cluster):
+            cmds[cluster] = helm_cmd(*prepare_deploy(pairs))
+
+    for cmd in cmds.values():
+        excall(cmd)
+
+    results = run_concurrently(cmds, executable=tell_binary('helm'))
+    rows = [
+        [cluster, 'failed' if returncode else 'deployed', f'{seconds:.1f}s']
+        for cluster, (returncode, seconds) in results.items()
+    ]
+    echo(format_table(['CLUSTER', 'RESULT', 'DURATION'], rows), err=True)
+    returncode = max(returncode for returncode, _ in results.values())
+    if returncode:
+        ctx.exit(returncode)
+
+
 @lain.command()
 @click.pass_context
 def prepare(ctx):
@@ -306,12 +521,22 @@ def prepare(ctx):
 
 
 @lain.command()
+@click.option('--buildkit', is_flag=True, envvar='LAIN_BUILDKIT', help='build with docker buildx instead of legacy_lain, layers are cached in the cluster registry, also LAIN_BUILDKIT')
+@click.option('--push', is_flag=True, help='with --buildkit, push images, the prepare image and build cache to the cluster registry, without it, nothing is written to the registry')
 @click.pass_context
-def build(ctx):
+def build(ctx, buildkit, push):
     """\b
     legacy_lain functionality, if build clause exists in chart/values.yaml,
     then uses values.yaml as lain.yaml. otherwise this command behaves just
-    like legacy_lain"""
+    like legacy_lain.
+    with --buildkit, images are built by docker buildx, release and meta
+    concurrently, see future_lain_cli/build.py"""
+    if buildkit:
+        from future_lain_cli.build import build_images
+        build_images(push=push)
+        return
+    if push:
+        error('--push only works with --buildkit, for legacy_lain, use lain push', exit=1)
     if 'build' not in ctx.obj.get('values', {}):
         fake_lain_yaml = False
     else:
@@ -352,6 +577,39 @@ def push(ctx, whatever):
     legacy_lain('push', *whatever)
 
 
+@lain.group()
+@click.pass_context
+def values(ctx):
+    """\b
+    helm values, as lain deploy would see them.
+    values come from chart/values.yaml, chart/values-[CLUSTER].yaml, and
+    --set, in that order of precedence.
+    """
+    ensure_helm_initiated()
+
+
+@values.command()
+@click.argument('key', required=False)
+@click.option('--set', 'pairs', multiple=True, type=KVPairType(), help='same as lain deploy --set')
+@click.pass_context
+def explain(ctx, key, pairs):
+    """\b
+    tell which file, or --set, a value comes from:
+        lain values explain deployments.web.replicaCount
+        lain values explain deployments.web
+        lain values explain
+    """
+    rows = explain_values(key, cluster=ctx.obj.get('cluster'), pairs=pairs)
+    if not rows:
+        error(f'{key} not found in values', exit=1)
+
+    table = [
+        [leaf, brief(json.dumps(value, ensure_ascii=False)), source, ', '.join(overridden)]
+        for leaf, value, source, overridden in rows
+    ]
+    echo(format_table(['KEY', 'VALUE', 'SOURCE', 'OVERRIDES'], table))
+
+
 @lain.group()
 @click.pass_context
 def env(ctx):
@@ -375,11 +633,7 @@ def add(ctx, pairs):
     if not pairs:
         goodjob('You just added nothing, what a great way to use this command', exit=True)
 
-    env_dic = tell_secret(ctx.obj['env_name'], init='env')
-    for k, v in pairs:
-        env_dic['data'][k] = v
-
-    kubectl_apply(env_dic)
+    update_secret(ctx.obj['env_name'], pairs, init='env')
     goodjob(f'env edited, you can use `lain env show` to view them', exit=True)
 
 
@@ -395,8 +649,55 @@ def show(ctx):
 @click.pass_context
 def edit(ctx):
     """env management."""
-    f = dump_secret(ctx.obj['env_name'], init='env')
-    kubectl_edit(f)
+    edit_secret(ctx.obj['env_name'], init='env')
+
+
+@env.command(name='import')
+@click.argument('f', type=click.File())
+@click.option('--prune', is_flag=True, help='remove keys that are missing from the imported file')
+@click.option('--dry-run', is_flag=True, help='only show what would change')
+@click.pass_context
+def import_(ctx, f, prune, dry_run):
+    """\b
+    import env from a dotenv file, or yaml (file name ends with .yaml / .yml),
+    everything is written in a single request:
+        lain env import .env --dry-run
+        lain env import .env
+    """
+    try:
+        data = load_env_file(f)
+    except (ValueError, tell_yaml().error.YAMLError) as e:
+        error(f'cannot read {f.name}: {e}', exit=1)
+
+    env_name = ctx.obj['env_name']
+    added, changed, removed = import_secret(env_name, data, prune=prune, dry_run=dry_run)
+    for keys, sign, color in [(added, '+', 'green'), (changed, '~', 'yellow'), (removed, '-', 'red')]:
+        for k in keys:
+            click.echo(click.style(f'{sign} {k}', fg=color), err=True)
+
+    summary = f'{len(added)} added, {len(changed)} changed, {len(removed)} removed'
+    if dry_run:
+        goodjob(f'dry run, nothing written to secret/{env_name}: {summary}', exit=True)
+
+    goodjob(f'secret/{env_name} updated: {summary}', exit=True)
+
+
+@env.command()
+@click.argument('f', type=click.File('w'), default='-')
+@click.option('--yaml', 'as_yaml', is_flag=True, help='export as yaml rather than dotenv')
+@click.pass_context
+def export(ctx, f, as_yaml):
+    """\b
+    export env as dotenv (or yaml), to stdout or a file:
+        lain env export > .env
+        lain env export --yaml env.yaml
+    """
+    secret_dic = tell_secret(ctx.obj['env_name'], init='env')
+    if as_yaml:
+        f.write(yadu(dict(secret_dic['data'])))
+        return
+    for k, v in sorted(secret_dic['data'].items()):
+        f.write(format_dotenv(k, v) + '\n')
 
 
 @lain.group()
@@ -435,9 +736,9 @@ def add(ctx, whatever, f):
     secret_name = ctx.obj['secret_name']
     f = whatever[0]
     fname = basename(f)
-    secret_dic = tell_secret(secret_name, init='secret')
-    secret_dic['data'][fname] = open(f).read()
-    kubectl_apply(secret_dic)
+    with open(f) as secret_file:
+        update_secret(secret_name, [(fname, secret_file.read())], init='secret')
+
     goodjob(f'{f} has been added to secret/{secret_name}, now you should delete this file', exit=True)
 
 
@@ -468,8 +769,7 @@ def show(ctx, whatever):
 def edit(ctx):
     """secret management. For lain4 only."""
     ensure_helm_initiated()
-    f = dump_secret(ctx.obj['secret_name'], init='secret')
-    kubectl_edit(f)
+    edit_secret(ctx.obj['secret_name'], init='secret')
 
 
 @lain.command()
@@ -0,0 +1,370 @@
+"""stream logs from every pod of an app, without the 8 stream limit of kubectl
+logs -f -l.
+
+pods are watched with an informer, each running pod gets its own streaming
+connection read by a daemon thread, so pods created during a rollout are
+picked up as they start. every stream puts lines into its own bounded queue,
+when the terminal can't keep up the queue fills, the reader thread blocks,
+and TCP flow control pushes back on the apiserver, rather than lain buffering
+logs without limit.
+
+filters are evaluated by those reader threads, before anything is queued or
+rendered, so a busy app can be examined without flooding the terminal"""
+import json
+import queue
+import re
+import threading
+import time
+from itertools import cycle
+
+import click
+
+from future_lain_cli.kube import Informer, KubeError, Pod, format_table
+
+COLORS = ['cyan', 'magenta', 'blue', 'yellow', 'green', 'bright_cyan', 'bright_magenta', 'bright_blue']
+LEVELS = {
+    'debug': 10,
+    'info': 20,
+    'warn': 30,
+    'warning': 30,
+    'err': 40,
+    'error': 40,
+    'critical': 50,
+    'fatal': 50,
+}
+LEVEL_PATTERN = re.compile(r'\b(DEBUG|INFO|WARN|WARNING|ERR|ERROR|CRITICAL|FATAL)\b', re.IGNORECASE)
+# where structured loggers put the level
+LEVEL_FIELDS = ('level', 'levelname', 'severity', 'lvl')
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_duration(s):
+    """
+    >>> parse_duration('90s')
+    90
+    >>> parse_duration('1h30m')
+    5400
+    >>> parse_duration('42')
+    42
+    >>> parse_duration('yesterday')
+    Traceback (most recent call last):
+      ...
+    ValueError: bad duration 'yesterday', try something like 10m or 1h30m
+    """
+    if s.isdigit():
+        return int(s)
+    parts = re.findall(r'(\d+)([smhd])', s)
+    if not parts or ''.join(n + unit for n, unit in parts) != s:
+        raise ValueError(f'bad duration {s!r}, try something like 10m or 1h30m')
+    return sum(int(n) * DURATION_UNITS[unit] for n, unit in parts)
+
+
+def dig(dic, dotted):
+    for k in dotted.split('.'):
+        if not isinstance(dic, dict):
+            return None
+        dic = dic.get(k)
+
+    return dic
+
+
+def tell_level(line, record=None):
+    """
+    >>> tell_level('2019-11-22 08:39:01 ERROR something broke')
+    40
+    >>> tell_level('{}', record={'levelname': 'warning'})
+    30
+    >>> tell_level('hello')
+    """
+    if record:
+        for field in LEVEL_FIELDS:
+            level = record.get(field)
+            if isinstance(level, str) and level.lower() in LEVELS:
+                return LEVELS[level.lower()]
+
+    m = LEVEL_PATTERN.search(line)
+    if m:
+        return LEVELS[m.group(1).lower()]
+    return None
+
+
+def is_verbatim(value):
+    """whether value shows up as is in any json that holds it
+    >>> is_verbatim('42'), is_verbatim('张三'), is_verbatim('True'), is_verbatim('a/b')
+    (True, False, False, False)
+    """
+    return value.isascii() and json.dumps(value) == f'"{value}"' and '/' not in value and value not in {'True', 'False'}
+
+
+class LogFilter:
+    """decide whether a log line should be shown, cheap checks go first so
+    that most lines are dropped before any json parsing happens
+    >>> f = LogFilter(grep='timeout', fields=[('user.id', '42')])
+    >>> f('{"user": {"id": 42}, "msg": "timeout"}')
+    True
+    >>> f('{"user": {"id": 43}, "msg": "timeout"}')
+    False
+    >>> f('timeout, but not json 42')
+    False
+    >>> LogFilter(level='warning')('INFO all good')
+    False
+    >>> LogFilter(fields=[('user', '张三')])('{"user": "\\\\u5f20\\\\u4e09"}')
+    True
+    >>> LogFilter(fields=[('ok', 'True')])('{"ok": true}')
+    True
+    >>> LogFilter(fields=[('path', '/healthz')])('{"path": "\\\\/healthz"}')
+    True
+    """
+
+    def __init__(self, grep=None, fields=(), level=None):
+        self.grep = re.compile(grep) if grep else None
+        self.fields = [(k, str(v)) for k, v in fields]
+        # values that json loggers might write differently, escaped, or as
+        # true / false, can't be looked for in the raw line
+        self.verbatim = [v for _, v in self.fields if is_verbatim(v)]
+        self.level = LEVELS[level.lower()] if level else None
+
+    def __bool__(self):
+        return bool(self.grep or self.fields or self.level)
+
+    def __call__(self, line):
+        if self.grep and not self.grep.search(line):
+            return False
+        if any(v not in line for v in self.verbatim):
+            return False
+        record = None
+        if self.fields or self.level:
+            stripped = line.lstrip()
+            if stripped.startswith('{'):
+                try:
+                    record = json.loads(stripped)
+                except ValueError:
+                    pass
+
+        if self.fields:
+            if not isinstance(record, dict):
+                return False
+            for k, v in self.fields:
+                value = dig(record, k)
+                if value is None or (str(value) != v and json.dumps(value) != v):
+                    return False
+
+        if self.level:
+            level = tell_level(line, record if isinstance(record, dict) else None)
+            # lines without a recognizable level are kept, think tracebacks
+            if level is not None and level < self.level:
+                return False
+
+        return True
+
+
+class RateLimiter:
+    """token bucket, allows rate lines per second with bursts of the same size"""
+
+    def __init__(self, rate, clock=time.monotonic):
+        self.rate = rate
+        self.clock = clock
+        self.tokens = rate
+        self.last = clock()
+        self.dropped = 0
+
+    def allow(self):
+        now = self.clock()
+        self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        self.dropped += 1
+        return False
+
+
+class LogStream:
+
+    def __init__(self, client, pod, tail_lines, buffer_size, ready, color, since_seconds=None, log_filter=None, sample=1, keep_lines=True):
+        self.client = client
+        self.pod_name = pod.name
+        self.restarts = pod.restarts
+        self.tail_lines = tail_lines
+        self.since_seconds = since_seconds
+        self.log_filter = log_filter
+        # keep 1 of every sample matching lines
+        self.sample = sample
+        # in summary mode lines are only counted
+        self.keep_lines = keep_lines
+        self.seen = 0
+        self.matched = 0
+        self.started = time.monotonic()
+        self.prefix = click.style(f'[{pod.name}] ', fg=color)
+        self.queue = queue.Queue(maxsize=buffer_size)
+        self.ready = ready
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.run, name=f'logs-{pod.name}', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def put(self, line):
+        # blocks when the buffer is full, that's the backpressure
+        self.queue.put(line)
+        self.ready.set()
+
+    def run(self):
+        log_filter = self.log_filter
+        try:
+            lines = self.client.stream_pod_log(self.pod_name, tail_lines=self.tail_lines, since_seconds=self.since_seconds)
+            for line in lines:
+                self.seen += 1
+                if log_filter and not log_filter(line):
+                    continue
+                self.matched += 1
+                if self.keep_lines and (self.matched - 1) % self.sample == 0:
+                    self.put(line)
+        except KubeError as e:
+            self.put(f'log stream ended: {e.message}')
+        finally:
+            self.done.set()
+            self.ready.set()
+
+
+class LogStreamer:
+    """stream logs of pods matching label_selector, pods that exist when the
+    streamer starts begin with their last tail_lines lines, pods that appear
+    later are streamed from their very first line"""
+
+    def __init__(self, client, label_selector, tail_lines=None, since_seconds=None, log_filter=None, sample=1, rate=None, summary=False, buffer_size=1000, batch=100):
+        self.client = client
+        self.tail_lines = tail_lines
+        self.since_seconds = since_seconds
+        self.log_filter = log_filter
+        self.sample = sample
+        self.rate_limiter = RateLimiter(rate) if rate else None
+        self.summary = summary
+        self.buffer_size = buffer_size
+        # lines taken from a stream in one go, so a chatty pod cannot starve the
+        # others
+        self.batch = batch
+        self.ready = threading.Event()
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        # (pod name, restarts) → LogStream
+        self.streams = {}
+        self.seen = set()
+        # including finished ones, for the summary
+        self.all_streams = []
+        self.initialized = False
+        self.colors = cycle(COLORS)
+        self.informer = Informer(
+            client, 'pods', Pod.from_manifest, label_selector=label_selector, on_change=self.reconcile,
+        )
+
+    def start(self):
+        self.informer.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.informer.stop()
+        self.ready.set()
+
+    def reconcile(self):
+        """start a stream for every pod whose container is up, a restarted
+        container gets a new stream"""
+        if not self.informer.synced.is_set():
+            return
+        with self.lock:
+            for pod in self.informer.items():
+                key = (pod.name, pod.restarts)
+                if pod.phase not in {'Running', 'Succeeded', 'Failed'} or key in self.seen:
+                    continue
+                self.seen.add(key)
+                # only pods that were already there when lain started are
+                # tailed, new pods and restarted containers are shown in full
+                tail_lines = None if self.initialized else self.tail_lines
+                self.streams[key] = LogStream(
+                    self.client, pod, tail_lines, self.buffer_size, self.ready, next(self.colors),
+                    since_seconds=self.since_seconds, log_filter=self.log_filter, sample=self.sample,
+                    keep_lines=not self.summary,
+                ).start()
+                self.all_streams.append(self.streams[key])
+
+            self.initialized = True
+
+        self.ready.set()
+
+    def drain(self, write):
+        """write at most self.batch lines from every stream, return True if
+        there are lines left"""
+        with self.lock:
+            streams = list(self.streams.items())
+
+        left = False
+        for key, stream in streams:
+            # checked before reading, so that lines put right before the
+            # stream ended aren't lost
+            done = stream.done.is_set()
+            for _ in range(self.batch):
+                try:
+                    line = stream.queue.get_nowait()
+                except queue.Empty:
+                    if done:
+                        with self.lock:
+                            self.streams.pop(key, None)
+
+                    break
+                if not self.rate_limiter or self.rate_limiter.allow():
+                    write(stream.prefix + line)
+            else:
+                left = True
+
+        return left
+
+    def report_dropped(self):
+        if self.rate_limiter and self.rate_limiter.dropped:
+            click.echo(click.style(f'{self.rate_limiter.dropped} lines dropped due to --rate', fg='magenta'), err=True)
+            self.rate_limiter.dropped = 0
+
+    def summarize(self):
+        """lines/sec of every pod, of matching lines and of all lines"""
+        now = time.monotonic()
+        rows = []
+        with self.lock:
+            streams = list(self.all_streams)
+
+        for stream in sorted(streams, key=lambda s: s.pod_name):
+            elapsed = max(now - stream.started, 1e-3)
+            rows.append([
+                stream.pod_name,
+                f'{stream.matched / elapsed:.1f}',
+                str(stream.matched),
+                f'{stream.seen / elapsed:.1f}',
+                str(stream.seen),
+            ])
+
+        return format_table(['POD', 'MATCHED/S', 'MATCHED', 'LINES/S', 'LINES'], rows)
+
+    def run_summary(self, write=click.echo, interval=2):
+        """instead of printing lines, print a lines/sec table every interval
+        seconds"""
+        while not self.stopped.wait(interval):
+            write(self.summarize() + '\n')
+
+    def run(self, write=click.echo):
+        """write lines from all streams until stopped"""
+        last_error = None
+        last_report = time.monotonic()
+        while not self.stopped.is_set():
+            if time.monotonic() - last_report > 1:
+                self.report_dropped()
+                last_report = time.monotonic()
+
+            if self.drain(write):
+                continue
+            self.ready.wait(0.5)
+            self.ready.clear()
+            # the informer retries on its own, just let the user know
+            if self.informer.error and self.informer.error != last_error:
+                click.echo(click.style(self.informer.error, fg='red'), err=True)
+
+            last_error = self.informer.error
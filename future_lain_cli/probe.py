@@ -0,0 +1,117 @@
+"""background ingress prober for lain status.
+
+every url is probed on its own schedule in a daemon thread, through one pooled
+keep-alive session per host, so slow or dead urls never block a redraw. why
+threads rather than asyncio? prompt_toolkit already owns the event loop in the
+main thread, and requests doesn't speak asyncio anyway"""
+import math
+import threading
+import time
+from collections import deque, namedtuple
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from future_lain_cli.trace import span
+
+
+def percentile(sorted_values, p):
+    """nearest-rank percentile
+    >>> percentile([1, 2, 3, 4, 5, 6, 7, 8, 9, 10], 50)
+    5
+    >>> percentile([1, 2, 3, 4, 5, 6, 7, 8, 9, 10], 95)
+    10
+    >>> percentile([], 99)
+    """
+    if not sorted_values:
+        return None
+    rank = max(math.ceil(len(sorted_values) * p / 100), 1)
+    return sorted_values[rank - 1]
+
+
+ProbeResult = namedtuple('ProbeResult', ['latency', 'status', 'text', 'ok'])
+
+
+class IngressProber:
+    """probe urls every interval seconds, keep the last window results of
+    each url for latency percentiles and error rate"""
+
+    def __init__(self, urls, interval=2, timeout=1, window=100, on_change=None):
+        self.urls = list(urls)
+        self.interval = interval
+        self.timeout = timeout
+        self.on_change = on_change
+        self.results = {url: deque(maxlen=window) for url in self.urls}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.sessions = {}
+        for url in self.urls:
+            host = urlparse(url).netloc
+            if host not in self.sessions:
+                session = requests.Session()
+                session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
+                session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
+                self.sessions[host] = session
+
+        self.threads = [
+            threading.Thread(target=self.run, args=(url,), name=f'probe-{url}', daemon=True)
+            for url in self.urls
+        ]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    def probe(self, url):
+        host = urlparse(url).netloc
+        session = self.sessions[host]
+        with span(f'GET {host}', 'http', url=url) as trace_args:
+            start = time.perf_counter()
+            try:
+                res = session.get(url, timeout=self.timeout)
+            except requests.exceptions.RequestException as e:
+                trace_args['error'] = repr(e)
+                return ProbeResult(time.perf_counter() - start, e.__class__.__name__, str(e), ok=False)
+            trace_args.update(status=res.status_code, bytes_in=len(res.content))
+
+        return ProbeResult(time.perf_counter() - start, res.status_code, res.text, ok=res.status_code < 500)
+
+    def run(self, url):
+        while not self.stopped.is_set():
+            result = self.probe(url)
+            with self.lock:
+                self.results[url].append(result)
+
+            if self.on_change:
+                self.on_change()
+
+            self.stopped.wait(self.interval)
+
+    def report(self, url):
+        """latency in milliseconds, error rate in percent"""
+        with self.lock:
+            results = list(self.results[url])
+
+        if not results:
+            return {'url': url, 'status': '...', 'text': '', 'count': 0}
+        latencies = sorted(r.latency * 1000 for r in results)
+        last = results[-1]
+        return {
+            'url': url,
+            'status': last.status,
+            'text': last.text,
+            'count': len(results),
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+            'error_rate': 100 * sum(1 for r in results if not r.ok) / len(results),
+        }
+
+    def reports(self):
+        return [self.report(url) for url in self.urls]
@@ -0,0 +1,131 @@
+"""record every subprocess and http request lain makes as a span, and write
+them in chrome trace event format, open the result in chrome://tracing or
+https://ui.perfetto.dev:
+
+    lain --trace trace.json deploy
+    LAIN_TRACE=trace.json lain deploy
+
+tracing is off unless asked for, in which case span() costs nothing but a
+global lookup"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from os.path import basename
+
+tracer = None
+# options that take a separate value, in commands that lain runs
+OPTIONS_WITH_VALUE = frozenset({'-n', '--namespace', '--kubeconfig', '--context', '-c', '--container'})
+
+
+class Tracer:
+    """collects complete events ('ph': 'X'), timestamps are microseconds since
+    tracing started, the whole lain command is the root span"""
+
+    def __init__(self, name, **args):
+        self.name = name
+        self.args = args
+        self.pid = os.getpid()
+        self.start = time.perf_counter()
+        self.events = []
+        self.threads = {}
+        self.lock = threading.Lock()
+
+    def now(self):
+        return (time.perf_counter() - self.start) * 1e6
+
+    def record(self, name, cat, ts, args):
+        thread = threading.current_thread()
+        event = {
+            'name': name, 'cat': cat, 'ph': 'X', 'ts': ts, 'dur': self.now() - ts,
+            'pid': self.pid, 'tid': thread.ident, 'args': args,
+        }
+        with self.lock:
+            self.threads[thread.ident] = thread.name
+            self.events.append(event)
+
+    def dump(self):
+        main_thread = threading.main_thread()
+        root = {
+            'name': self.name, 'cat': 'command', 'ph': 'X', 'ts': 0, 'dur': self.now(),
+            'pid': self.pid, 'tid': main_thread.ident, 'args': self.args,
+        }
+        with self.lock:
+            threads = {main_thread.ident: main_thread.name, **self.threads}
+            events = list(self.events)
+
+        metadata = [
+            {'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': tid, 'args': {'name': name}}
+            for tid, name in threads.items()
+        ]
+        return {'traceEvents': [*metadata, root, *events], 'displayTimeUnit': 'ms'}
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.dump(), f)
+
+
+def start_tracing(name, **args):
+    global tracer
+    tracer = Tracer(name, **args)
+    return tracer
+
+
+def stop_tracing(path):
+    global tracer
+    if tracer:
+        tracer.save(path)
+        tracer = None
+
+
+@contextmanager
+def span(name, cat, **args):
+    """time the block as a span, the yielded args can be added to while the
+    block runs, e.g. the exit code"""
+    current = tracer
+    if not current:
+        yield args
+        return
+    ts = current.now()
+    try:
+        yield args
+    except BaseException as e:
+        args['error'] = repr(e)
+        raise
+    finally:
+        current.record(name, cat, ts, args)
+
+
+def tell_cmd_name(cmd):
+    """name a subprocess span by the program and its subcommand
+    >>> tell_cmd_name(['helm', '-n', 'default', '--kubeconfig', '/tmp/k', 'upgrade', '--atomic', 'dummy'])
+    'helm upgrade'
+    >>> tell_cmd_name(['/usr/local/bin/kubectl', '--request-timeout=2', 'get', 'po'])
+    'kubectl get'
+    >>> tell_cmd_name('legacy_lain meta')
+    'legacy_lain meta'
+    """
+    if isinstance(cmd, str):
+        cmd = cmd.split()
+    args = iter(cmd[1:])
+    for arg in args:
+        if arg in OPTIONS_WITH_VALUE:
+            next(args, None)
+        elif not arg.startswith('-'):
+            return f'{basename(cmd[0])} {arg}'
+
+    return basename(cmd[0])
+
+
+def tell_size(data):
+    """size of whatever was sent to or read from a subprocess or a request"""
+    if data is None:
+        return 0
+    if isinstance(data, str):
+        return len(data.encode('utf-8'))
+    try:
+        return len(data)
+    except TypeError:
+        # file objects, generators: unknown
+        return None
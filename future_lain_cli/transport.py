@@ -0,0 +1,432 @@
+"""every subprocess and http request that lain makes goes through the current
+transport. the default one does the real thing, the other two reproduce
+sessions offline:
+
+    lain --record session.json deploy              # real deploy, every call saved
+    lain --replay session.json deploy              # same deploy, cluster untouched
+    lain --replay session.json --realtime deploy   # with the recorded latency
+
+a cassette is the list of calls lain made: argv or method and url, stdout,
+stderr, exit code or http status, and seconds taken. output that went
+straight to the terminal instead of being captured by lain isn't recorded.
+calls are replayed in recorded order, per argv or url, once they run out the
+last one is served again. cassettes whose name ends with .gz are gzipped.
+
+secrets don't make it into cassettes: apiserver responses and kubectl output
+that hold a Secret are recorded with its data redacted"""
+import base64
+import gzip
+import io
+import json
+import subprocess
+import threading
+import time
+from collections import defaultdict, deque
+from os.path import expanduser
+from urllib.parse import parse_qsl, urlencode, urlparse
+
+HOME = expanduser('~')
+# response headers that lain actually reads
+RECORDED_HEADERS = ('Content-Type', 'ETag', 'Link')
+# once a recorded stream (watch, log -f) runs out, further ones stay quiet
+# for this long, like a watch with nothing to report
+QUIET_STREAM_SECONDS = 1
+# still valid base64, so that redacted secrets can be replayed
+REDACTED = 'cmVkYWN0ZWQ='
+LAST_APPLIED = 'kubectl.kubernetes.io/last-applied-configuration'
+
+
+class CassetteMiss(Exception):
+    """the call being replayed was never recorded"""
+
+
+def encode(data):
+    """
+    >>> encode(b'ok'), encode('ok'), encode(b'\\xff'), encode([b'o', b'k']), encode(None)
+    ({'utf8': 'ok'}, {'text': 'ok'}, {'b64': '/w=='}, {'utf8': 'ok'}, None)
+    """
+    if data is None:
+        return None
+    if isinstance(data, list):
+        data = b''.join(data)
+    if isinstance(data, str):
+        return {'text': data}
+    try:
+        return {'utf8': data.decode('utf-8')}
+    except UnicodeDecodeError:
+        return {'b64': base64.b64encode(data).decode('ascii')}
+
+
+def decode(dic):
+    """
+    >>> decode(encode(b'\\xff')), decode(encode('ok')), decode(None)
+    (b'\\xff', 'ok', None)
+    """
+    if dic is None:
+        return None
+    if 'text' in dic:
+        return dic['text']
+    if 'utf8' in dic:
+        return dic['utf8'].encode('utf-8')
+    return base64.b64decode(dic['b64'])
+
+
+def redact_object(obj):
+    """return obj with the data of every Secret in it redacted, or None if
+    there's no Secret in it, lists and watch events are looked into
+    >>> redact_object({'kind': 'Secret', 'metadata': {'name': 'dummy-env'}, 'data': {'FOO': 'QkFS'}})
+    {'kind': 'Secret', 'metadata': {'name': 'dummy-env'}, 'data': {'FOO': 'cmVkYWN0ZWQ='}}
+    >>> redact_object({'type': 'ADDED', 'object': {'kind': 'Pod'}})
+    """
+    if not isinstance(obj, dict):
+        return None
+    if obj.get('kind') == 'Secret':
+        obj = dict(obj)
+        for k in ('data', 'stringData'):
+            if obj.get(k):
+                obj[k] = {key: REDACTED for key in obj[k]}
+
+        annotations = (obj.get('metadata') or {}).get('annotations') or {}
+        if LAST_APPLIED in annotations:
+            obj['metadata'] = {**obj['metadata'], 'annotations': {**annotations, LAST_APPLIED: REDACTED}}
+        return obj
+    if isinstance(obj.get('items'), list):
+        items = [redact_object(item) for item in obj['items']]
+        if any(items):
+            return {**obj, 'items': [new or old for new, old in zip(items, obj['items'])]}
+        return None
+    redacted = redact_object(obj.get('object'))
+    return redacted and {**obj, 'object': redacted}
+
+
+def redact(data):
+    """return data with secrets redacted, or None if there's no secret in
+    it. understands json (apiserver responses, kubectl -o json), json lines
+    (watch streams) and yaml (kubectl -o yaml)
+    >>> redact(b'{"kind": "Secret", "data": {"FOO": "QkFS"}}')
+    b'{"kind": "Secret", "data": {"FOO": "cmVkYWN0ZWQ="}}'
+    >>> redact(b'kind: Secret\\ndata:\\n  FOO: QkFS\\n')
+    b'data:\\n  FOO: cmVkYWN0ZWQ=\\nkind: Secret\\n'
+    >>> redact(b'{"kind": "Pod"}'), redact(b'hello'), redact(None)
+    (None, None, None)
+    """
+    if isinstance(data, list):
+        data = b''.join(data)
+    if not data:
+        return None
+    text = data.decode('utf-8', 'replace') if isinstance(data, bytes) else data
+    if 'Secret' not in text:
+        return None
+    redacted = None
+    try:
+        redacted = redact_object(json.loads(text))
+        redacted = redacted and json.dumps(redacted)
+    except ValueError:
+        lines = text.splitlines()
+        try:
+            objs = [json.loads(line) for line in lines if line.strip()]
+            redacted_lines = [redact_object(obj) for obj in objs]
+            if any(redacted_lines):
+                redacted = ''.join(json.dumps(new or old) + '\n' for new, old in zip(redacted_lines, objs))
+        except ValueError:
+            from future_lain_cli.utils import yadu, yalo
+            try:
+                redacted = redact_object(yalo(text))
+            except Exception:
+                redacted = None
+            redacted = redacted and yadu(redacted)
+
+    if redacted is None:
+        return None
+    return redacted.encode('utf-8') if isinstance(data, bytes) else redacted
+
+
+def tell_cmd_key(cmd):
+    """argv, with home directory normalized, so that cassettes work across
+    machines
+    >>> tell_cmd_key(['helm', '--kubeconfig', HOME + '/.kube/kubeconfig-bei', 'status', 'dummy'])
+    'helm --kubeconfig ~/.kube/kubeconfig-bei status dummy'
+    """
+    if isinstance(cmd, str):
+        return cmd.replace(HOME, '~')
+    return ' '.join(str(arg).replace(HOME, '~') for arg in cmd)
+
+
+def tell_request_key(method, url, params=None):
+    """method, path and sorted query, the host is left out, so that the same
+    session can be replayed against whatever kubeconfig
+    >>> tell_request_key('GET', 'https://10.0.0.1:6443/api/v1/namespaces/default/pods', {'watch': None, 'labelSelector': 'app=dummy'})
+    'GET /api/v1/namespaces/default/pods?labelSelector=app%3Ddummy'
+    >>> tell_request_key('GET', 'http://registry/v2/dummy/tags/list?n=2&last=b')
+    'GET /v2/dummy/tags/list?last=b&n=2'
+    """
+    parsed = urlparse(url)
+    query = parse_qsl(parsed.query) + [(k, str(v)) for k, v in (params or {}).items() if v is not None]
+    query = urlencode(sorted(query))
+    return f'{method} {parsed.path}' + (f'?{query}' if query else '')
+
+
+def make_response(method, url, status, headers, body):
+    from http.client import responses
+
+    from requests.models import PreparedRequest, Response
+    from requests.structures import CaseInsensitiveDict
+    from requests.utils import get_encoding_from_headers
+    res = Response()
+    res.status_code = status
+    res.reason = responses.get(status, '')
+    res.headers = CaseInsensitiveDict(headers or {})
+    res.encoding = get_encoding_from_headers(res.headers)
+    res.url = url
+    res._content = body
+    res._content_consumed = True
+    res.request = PreparedRequest()
+    res.request.prepare(method=method, url=url)
+    return res
+
+
+class Transport:
+    """does the real thing"""
+
+    offline = False
+
+    def run(self, cmd, **kwargs):
+        return subprocess.run(cmd, **kwargs)
+
+    def popen(self, cmd, **kwargs):
+        return subprocess.Popen(cmd, **kwargs)
+
+    def request(self, session, method, url, *args, **kwargs):
+        return session.request(method, url, *args, **kwargs)
+
+    def save(self):
+        pass
+
+
+class RecordedProcess:
+    """a Popen that writes down how it went"""
+
+    def __init__(self, proc, call):
+        self.proc = proc
+        self.call = call
+        self.start = time.perf_counter()
+        self.output = []
+        self.stdout = self.tee(proc.stdout) if proc.stdout else None
+
+    def tee(self, f):
+        self.call['stdout'] = self.output
+        for line in f:
+            self.output.append(line)
+            yield line
+
+    @property
+    def returncode(self):
+        return self.proc.returncode
+
+    def finish(self, returncode):
+        if returncode is not None and self.call['returncode'] is None:
+            self.call.update(returncode=returncode, seconds=time.perf_counter() - self.start)
+        return returncode
+
+    def poll(self):
+        return self.finish(self.proc.poll())
+
+    def wait(self, timeout=None):
+        return self.finish(self.proc.wait(timeout))
+
+    def terminate(self):
+        self.proc.terminate()
+
+
+class RecordingTransport(Transport):
+    """does the real thing, and writes every call down into a cassette"""
+
+    def __init__(self, path):
+        self.path = path
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def add(self, call):
+        with self.lock:
+            self.calls.append(call)
+
+        return call
+
+    def run(self, cmd, **kwargs):
+        start = time.perf_counter()
+        res = super().run(cmd, **kwargs)
+        self.add({
+            'cmd': tell_cmd_key(cmd),
+            'returncode': res.returncode,
+            'stdout': res.stdout,
+            'stderr': res.stderr,
+            'seconds': time.perf_counter() - start,
+        })
+        return res
+
+    def popen(self, cmd, **kwargs):
+        proc = super().popen(cmd, **kwargs)
+        call = self.add({'cmd': tell_cmd_key(cmd), 'returncode': None, 'stdout': None, 'stderr': None, 'seconds': None})
+        return RecordedProcess(proc, call)
+
+    def request(self, session, method, url, *args, **kwargs):
+        start = time.perf_counter()
+        res = super().request(session, method, url, *args, **kwargs)
+        call = self.add({
+            'request': tell_request_key(method, url, kwargs.get('params')),
+            'status': res.status_code,
+            'headers': {k: res.headers[k] for k in RECORDED_HEADERS if k in res.headers},
+            'body': None,
+            'seconds': time.perf_counter() - start,
+        })
+        if not kwargs.get('stream'):
+            call['body'] = res.content
+            return res
+        # streamed bodies are recorded as they're read
+        chunks = call['body'] = []
+        iter_content = res.iter_content
+
+        def recording_iter_content(*args, **kwargs):
+            for chunk in iter_content(*args, **kwargs):
+                chunks.append(chunk)
+                yield chunk
+
+        res.iter_content = recording_iter_content
+        return res
+
+    def save(self):
+        redacted = []
+        with self.lock:
+            calls = []
+            for call in self.calls:
+                call = dict(call)
+                for k in ('stdout', 'body'):
+                    data = redact(call.get(k))
+                    if data is not None:
+                        call[k] = data
+                        redacted.append(call.get('cmd') or call.get('request'))
+
+                calls.append({k: encode(v) if k in {'stdout', 'stderr', 'body'} else v for k, v in call.items()})
+
+        if redacted:
+            from future_lain_cli.utils import warn
+            warn(f'secrets were recorded into {self.path}, with their data redacted: {", ".join(redacted)}')
+
+        opener = gzip.open if self.path.endswith('.gz') else open
+        with opener(self.path, 'wt') as f:
+            json.dump({'version': 1, 'calls': calls}, f)
+
+
+class ReplayedProcess:
+    """a Popen that plays back a recorded one"""
+
+    def __init__(self, cmd, call, piped, seconds):
+        self.args = cmd
+        self.call = call
+        self.returncode = None
+        self.deadline = time.monotonic() + seconds
+        self.stdout = io.BytesIO(decode(call['stdout']) or b'') if piped else None
+
+    def poll(self):
+        if self.returncode is None and time.monotonic() >= self.deadline:
+            self.returncode = self.call['returncode']
+        return self.returncode
+
+    def wait(self, timeout=None):
+        time.sleep(max(self.deadline - time.monotonic(), 0))
+        return self.poll()
+
+    def terminate(self):
+        if self.returncode is None:
+            self.returncode = -15
+
+
+class ReplayingTransport(Transport):
+    """serves every call from a cassette, never touches anything. with
+    realtime, calls take as long as they did when recorded"""
+
+    offline = True
+
+    def __init__(self, path, realtime=False):
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt') as f:
+            calls = json.load(f)['calls']
+
+        self.queues = defaultdict(deque)
+        for call in calls:
+            self.queues[call.get('cmd') or call.get('request')].append(call)
+
+        self.last = {}
+        self.realtime = realtime
+        self.lock = threading.Lock()
+
+    def next_call(self, key):
+        """return (call, whether the recorded calls for key have run out)"""
+        with self.lock:
+            queue = self.queues.get(key)
+            if queue:
+                call = self.last[key] = queue.popleft()
+                return call, False
+            if key in self.last:
+                return self.last[key], True
+
+        raise CassetteMiss(f'not in the cassette: {key}')
+
+    def tell_seconds(self, call):
+        return (call['seconds'] or 0) if self.realtime else 0
+
+    def run(self, cmd, **kwargs):
+        call, _ = self.next_call(tell_cmd_key(cmd))
+        time.sleep(self.tell_seconds(call))
+        return subprocess.CompletedProcess(cmd, call['returncode'], decode(call['stdout']), decode(call['stderr']))
+
+    def popen(self, cmd, **kwargs):
+        call, _ = self.next_call(tell_cmd_key(cmd))
+        return ReplayedProcess(cmd, call, kwargs.get('stdout') == subprocess.PIPE, self.tell_seconds(call))
+
+    def request(self, session, method, url, *args, **kwargs):
+        call, exhausted = self.next_call(tell_request_key(method, url, kwargs.get('params')))
+        body = decode(call['body']) or b''
+        if exhausted and kwargs.get('stream'):
+            time.sleep(QUIET_STREAM_SECONDS)
+            body = b''
+        else:
+            time.sleep(self.tell_seconds(call))
+
+        return make_response(method, url, call['status'], call['headers'], body)
+
+
+current = Transport()
+
+
+def use_transport(transport):
+    global current
+    current = transport
+    return transport
+
+
+def stop_transport():
+    """save the cassette if recording, and go back to the real thing"""
+    current.save()
+    use_transport(Transport())
+
+
+def is_offline():
+    return current.offline
+
+
+def is_active():
+    """whether calls are being recorded or replayed"""
+    return type(current) is not Transport
+
+
+def run(cmd, **kwargs):
+    return current.run(cmd, **kwargs)
+
+
+def popen(cmd, **kwargs):
+    return current.popen(cmd, **kwargs)
+
+
+def request(session, method, url, *args, **kwargs):
+    return current.request(session, method, url, *args, **kwargs)
@@ -1,39 +1,72 @@
 import base64
+import fcntl
+import hashlib
 import inspect
 import json
 import os
 import re
 import shlex
 import shutil
+import signal
 import stat
 import subprocess
 import sys
+import threading
+import time
+import zlib
 from collections.abc import Mapping
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import (ExitStack, contextmanager, redirect_stderr,
+                        redirect_stdout)
+from copy import deepcopy
+from functools import lru_cache, partial
 from inspect import cleandoc
+from itertools import cycle
 from os import getcwd as cwd
 from os import readlink, remove
 from os.path import (abspath, basename, dirname, expanduser, isabs, isdir,
-                     isfile, join)
-from tempfile import NamedTemporaryFile, TemporaryDirectory
+                     isfile, join, realpath)
+from tempfile import NamedTemporaryFile, TemporaryFile
 from types import MappingProxyType
 from urllib.parse import urljoin
 
 import click
-import requests
-import yaml
-from humanfriendly import parse_size
-from jinja2 import Environment, FileSystemLoader
+
+from future_lain_cli import transport
+from future_lain_cli.kube import (Deployment, Informer, KubeError, Pod,
+                                  events_table, format_table, pods_table,
+                                  tell_kube_client)
+from future_lain_cli.trace import span, tell_cmd_name, tell_size
+from future_lain_cli.transport import CassetteMiss
 
 # safe to delete when release is in this state
 HELM_WEIRD_STATE = {'failed', 'pending-install'}
+# kubelet keeps retrying pods in these states, but they never recover on their
+# own, a deploy that runs into any of them is doomed
+DOOMED_POD_STATES = frozenset({
+    'CrashLoopBackOff', 'ImagePullBackOff', 'ErrImageNeverPull', 'InvalidImageName',
+    'CreateContainerConfigError', 'CreateContainerError', 'RunContainerError',
+})
 CLI_DIR = dirname(abspath(__file__))
 TEMPLATE_DIR = join(CLI_DIR, 'chart_template')
-template_env = Environment(loader=FileSystemLoader(searchpath=TEMPLATE_DIR), extensions=['jinja2.ext.loopcontrols'])
 CHART_DIR_NAME = 'chart'
 ENV = os.environ
 LAIN_EXBIN_PREFIX = ENV.get('LAIN_EXBIN_PREFIX') or '/usr/local/bin'
 HELM_BIN = join(LAIN_EXBIN_PREFIX, 'helm')
 KUBECTL_BIN = join(LAIN_EXBIN_PREFIX, 'kubectl')
+LAIN_CACHE_DIR = ENV.get('LAIN_CACHE_DIR') or expanduser('~/.cache/lain')
+TOOLCHAIN_CACHE_FILE = join(LAIN_CACHE_DIR, 'toolchain.json')
+# downloaded kubectl / helm, named after their sha256, LAIN_EXBIN_PREFIX only
+# has symlinks to these, so the cache can be shared between CI runners
+BINARY_CACHE_DIR = join(LAIN_CACHE_DIR, 'bin')
+# {commit sha: meta version}, see tell_meta_version
+META_VERSION_CACHE_FILE = join(LAIN_CACHE_DIR, 'meta.json')
+META_VERSION_CACHE_SIZE = 100
+# binaries are fetched in chunks of this size, in parallel when the server
+# supports range requests, an interrupted download resumes from the chunks
+# already there
+BINARY_CHUNK_SIZE = 4 * 1024 * 1024
+BINARY_DOWNLOAD_WORKERS = 4
 CDN = 'https://static.einplus.cn'
 ENV['PATH'] = f'{LAIN_EXBIN_PREFIX}:{ENV["PATH"]}'
 FUTURE_CLUSTERS = MappingProxyType({
@@ -161,25 +194,26 @@ def tell_ingress_urls():
 def pick_pod(deploy_name=None, phase=None):
     ctx = context()
     appname = ctx.obj['appname']
-    cmd = ['get', 'pod', '-o=jsonpath={..metadata.name}']
     if deploy_name:
-        cmd.extend(['-l', f'app.kubernetes.io/instance={appname}-{deploy_name}'])
+        selector = f'app.kubernetes.io/instance={appname}-{deploy_name}'
     else:
-        cmd.extend(['-l', f'app.kubernetes.io/name={appname}'])
+        selector = f'app.kubernetes.io/name={appname}'
 
-    if phase:
-        cmd.extend([f'--field-selector=status.phase=={phase}'])
+    field_selector = f'status.phase={phase}' if phase else None
+    try:
+        pods = tell_kube_client(tell_kubeconfig()).list_pods(label_selector=selector, field_selector=field_selector)
+    except KubeError as e:
+        error(f'error during listing pods: {e}', exit=1)
 
-    res = kubectl(*cmd, capture_output=True)
-    podnames = ensure_str(res.stdout).split()
     try:
-        return podnames[-1]
+        return pods[-1].name
     except IndexError:
         return
 
 
 def tell_best_deploy():
     """deployment name with the most memory"""
+    from humanfriendly import parse_size
     ctx = context()
     deploys = ctx.obj['values']['deployments']
     chosen = list(deploys.keys())[0]
@@ -238,36 +272,15 @@ kibana, for log output and analysing:
     http://{{ kibana }}/app/logtrail#/?q=kubernetes.pod_name.keyword:{{ appname }}*&h=All&t=Now&i=logstash-*
 {%- endif %}
 '''
-deploy_toast_template = template_env.from_string(deploy_toast_str)
 
 
 def deploy_toast():
     ctx = context()
     ctx.obj.update(tell_cluster_info())
-    headsup = deploy_toast_template.render(**ctx.obj)
+    headsup = tell_template_env().from_string(deploy_toast_str).render(**ctx.obj)
     goodjob(headsup)
 
 
-too_much_logs_headsup_str = '''if lain logs doesn't work for you, you can always use kubectl directly like this:
-    kubectl logs -f --tail 50 {{ podname }}
-{% if kibana %}
-or go to kibana:
-    http://{{ kibana }}/app/logtrail#/?q=kubernetes.pod_name.keyword:{{ appname }}*&h=All&t=Now&i=logstash-*
-{%- endif %}
-'''
-too_much_logs_headsup_template = template_env.from_string(too_much_logs_headsup_str)
-
-
-def too_much_logs_headsup():
-    # kubectl cannot tail from more than 8 log streams, when that happens,
-    # print a help message to redirect users to kibana, if applicable
-    ctx = context()
-    ctx.obj.update(tell_cluster_info())
-    podname = pick_pod()
-    headsup = too_much_logs_headsup_template.render(podname=podname, **ctx.obj)
-    error(headsup)
-
-
 init_done_str = f'''a helm chart is generated under the ./{CHART_DIR_NAME} directory. what's next?
 * review ./{CHART_DIR_NAME}/values.yaml
 * if this app needs cluster-specific secret files or env, you should create them:
@@ -294,33 +307,149 @@ def template_update_toast():
     subprocess_run(['git', 'diff'])
 
 
+def tell_tag_timestamp(tag):
+    """
+    >>> tell_tag_timestamp('release-1574411941-f4fca3bd2bf90691491c2280ef399f5dfa3b4daa')
+    1574411941
+    """
+    return int(tag.split('-', 2)[1])
+
+
+def tell_next_page(res):
+    """follow the Link header of docker registry API pagination
+    >>> class Response:
+    ...     headers = {'Link': '</v2/dummy/tags/list?last=release-1&n=100>; rel="next"'}
+    >>> tell_next_page(Response())
+    '/v2/dummy/tags/list?last=release-1&n=100'
+    """
+    link = res.headers.get('Link')
+    if not link:
+        return None
+    m = re.match(r'^\s*<([^>]+)>\s*;\s*rel="?next"?', link)
+    if m:
+        return m.group(1)
+
+
 class Registry:
     """this client deals with legacy lain registries, it filters out legacy
-    data from the registry API"""
+    data from the registry API.
+    tags are kept in a local index under LAIN_CACHE_DIR, registry only returns
+    tags that come after the last one we've seen, so most refreshes download
+    a single tiny page, or nothing at all (304)"""
+
+    page_size = 1000
+    # the index is rebuilt from scratch this often, so that deleted tags
+    # don't linger in it forever
+    index_ttl = 3600
 
     def __init__(self, host):
         self.host = host
         self.base_url = f'http://{host}'
+        import requests
+        self.session = requests.Session()
 
     def request(self, method, path, params=None, data=None, *args, **kwargs):
         url = urljoin(self.base_url, path)
         kwargs.setdefault('timeout', 2)
-        res = requests.request(method, url, params=params, data=data, *args, **kwargs)
+        with span(f'{method} {self.host}', 'http', url=url, params=params) as trace_args:
+            try:
+                res = transport.request(self.session, method, url, params=params, data=data, *args, **kwargs)
+            except CassetteMiss as e:
+                error(str(e), exit=1)
+            trace_args.update(status=res.status_code, bytes_out=tell_size(res.request.body), bytes_in=len(res.content))
+
         return res
 
     def get(self, url, *args, **kwargs):
         return self.request('GET', url, *args, **kwargs)
 
+    def has_tag(self, repo_name, tag):
+        """whether repo_name:tag is in the registry, without listing tags,
+        which would filter out anything that isn't a release"""
+        accept = ', '.join([
+            'application/vnd.docker.distribution.manifest.v2+json',
+            'application/vnd.docker.distribution.manifest.list.v2+json',
+            'application/vnd.oci.image.index.v1+json',
+        ])
+        res = self.request('HEAD', f'/v2/{repo_name}/manifests/{tag}', headers={'Accept': accept})
+        if res.status_code == 404:
+            return False
+        res.raise_for_status()
+        return True
+
     def make_image(self, tag):
         ctx = context()
         repo = ctx.obj['appname']
         return f'{self.host}/{repo}:{tag}'
 
-    def tags_list(self, repo_name):
+    def tell_index_file(self, repo_name):
+        return join(LAIN_CACHE_DIR, 'registry', self.host, f'{repo_name}.json')
+
+    def load_index(self, repo_name):
+        try:
+            with open(self.tell_index_file(repo_name)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {'tags': [], 'last': None, 'etag': None, 'refreshed': 0}
+
+    def save_index(self, repo_name, index):
+        index_file = self.tell_index_file(repo_name)
+        try:
+            os.makedirs(dirname(index_file), exist_ok=True)
+            with NamedTemporaryFile('w', dir=dirname(index_file), delete=False) as f:
+                json.dump(index, f)
+
+            os.replace(f.name, index_file)
+        except OSError as e:
+            debug(f'cannot write registry index {index_file}: {e}')
+
+    def fetch_tags(self, repo_name, last=None, etag=None):
+        """return (raw tags, etag), raw tags is None if nothing changed since
+        etag"""
         path = f'/v2/{repo_name}/tags/list'
-        responson = self.get(path).json()
-        tags = [s for s in responson['tags'] if LEGACY_IMAGE_PATTERN.match(s)]
-        return sorted(tags, reverse=True)
+        params = {'n': self.page_size}
+        if last:
+            params['last'] = last
+
+        headers = {'If-None-Match': etag} if etag else {}
+        res = self.get(path, params=params, headers=headers)
+        if res.status_code == 304:
+            return None, etag
+        if res.status_code == 404:
+            return [], None
+        res.raise_for_status()
+        first_page_etag = res.headers.get('ETag')
+        tags = res.json().get('tags') or []
+        next_page = tell_next_page(res)
+        while next_page:
+            res = self.get(next_page)
+            res.raise_for_status()
+            tags.extend(res.json().get('tags') or [])
+            next_page = tell_next_page(res)
+
+        return tags, first_page_etag
+
+    def tags_list(self, repo_name, full=False):
+        """release tags, latest first. only fetch tags newer than the local
+        index, unless full=True, or the index is older than index_ttl"""
+        index = self.load_index(repo_name)
+        if full or time.time() - (index.get('refreshed') or 0) > self.index_ttl:
+            index = {'tags': [], 'last': None, 'etag': None, 'refreshed': time.time()}
+        raw_tags, etag = self.fetch_tags(repo_name, last=index['last'], etag=index['etag'])
+        if raw_tags is None:
+            return index['tags']
+        new_tags = {s for s in raw_tags if LEGACY_IMAGE_PATTERN.match(s)}
+        tags = sorted(new_tags.union(index['tags']), key=tell_tag_timestamp, reverse=True)
+        index = {
+            'tags': tags,
+            # only release tags count, the registry sorts tags lexically, and
+            # a tag like "stable" would hide every release that comes after
+            'last': max([*new_tags, index['last'] or '']) or None,
+            'etag': etag,
+            'refreshed': index['refreshed'],
+        }
+        self.save_index(repo_name, index)
+        return tags
 
 
 def clean_kubernetes_manifests(dic):
@@ -330,13 +459,13 @@ def clean_kubernetes_manifests(dic):
     metadata.pop('selfLink', '')
     metadata.pop('uid', '')
     metadata.pop('resourceVersion', '')
+    metadata.pop('managedFields', '')
     annotations = metadata.get('annotations', {})
     annotations.pop('kubectl.kubernetes.io/last-applied-configuration', '')
 
 
-def dump_secret(secret_name, init='env'):
+def dump_secret(secret_dic):
     """create a tempfile and dump plaintext secret into it"""
-    secret_dic = tell_secret(secret_name, init=init)
     f = NamedTemporaryFile(suffix='.yaml')
     yadu(secret_dic, f)
     return f
@@ -350,56 +479,117 @@ def tell_cluster_info(cluster=None):
     return FUTURE_CLUSTERS[cluster]
 
 
+SECRET_EXAMPLE_DATA = MappingProxyType({
+    'env': MappingProxyType({'FOO': 'BAR'}),
+    'secret': MappingProxyType({'topsecret.txt': 'I\nAM\nBATMAN'}),
+})
+
+
 def tell_secret(secret_name, init='env'):
     """return Kubernetes secret object in python dict, all b64decoded.
     If secret doesn't exist, create one first, and with some example content"""
-    d = TemporaryDirectory()
-    if init == 'env':
-        init_clause = '--from-literal=FOO=BAR'
-    elif init == 'secret':
-        example_file = 'topsecret.txt'
-        example_file_path = join(d.name, example_file)
-        with open(example_file_path, 'w') as f:
-            f.write('I\nAM\nBATMAN')
-
-        init_clause = f'--from-file={example_file_path}'
-    else:
+    secret_dic, _ = fetch_secret(secret_name, init=init)
+    return secret_dic
+
+
+def fetch_secret(secret_name, init='env'):
+    """same as tell_secret, but also return the resourceVersion, which is
+    needed to safely patch it later"""
+    if init not in SECRET_EXAMPLE_DATA:
         raise ValueError(f'init style: env, secret. dont\'t know what this is: {init}')
 
-    kubectl('create', 'secret', 'generic', secret_name, init_clause, capture_output=True)
-    d.cleanup()  # don't wanna cleanup too early
-    res = kubectl('get', 'secret', '-oyaml', secret_name, capture_output=True, check=True)
-    dic = yalo(res.stdout)
+    try:
+        client = tell_kube_client(tell_kubeconfig())
+        secret = client.read_secret(secret_name)
+        if not secret:
+            secret = client.create_secret(secret_name, SECRET_EXAMPLE_DATA[init])
+    except KubeError as e:
+        error(f'error during fetching secret/{secret_name}: {e}', exit=1)
+
+    dic = deepcopy(secret.manifest)
     clean_kubernetes_manifests(dic)
-    dic.setdefault('data', {})
-    for fname, s in dic['data'].items():
-        decoded = base64.b64decode(s).decode('utf-8')
+    dic['data'] = {}
+    for fname, decoded in secret.decoded().items():
         # gotta do this so yaml.dump will print nicely
         dic['data'][fname] = literal(decoded) if '\n' in decoded else decoded
 
-    return dic
+    return dic, secret.resource_version
 
 
-def kubectl_edit(f):
+def secret_data_patch(before, after):
+    """key level diff between plaintext secret data, as a merge patch, only
+    changed keys are sent, deleted keys are set to null
+    >>> secret_data_patch({'FOO': 'BAR', 'EGG': 'SPAM'}, {'FOO': 'BAR', 'EGG': 'HAM', 'NEW': '1'})
+    {'EGG': 'SEFN', 'NEW': 'MQ=='}
+    >>> secret_data_patch({'FOO': 'BAR'}, {})
+    {'FOO': None}
+    """
+    patch = {}
+    for fname, s in after.items():
+        if not isinstance(s, str):
+            raise ValueError(f'kubernetes secret data should be string, got {fname}: {s}')
+        if before.get(fname) != s:
+            patch[fname] = base64.b64encode(s.encode('utf-8')).decode('utf-8')
+
+    for fname in before.keys() - after.keys():
+        patch[fname] = None
+
+    return patch
+
+
+def patch_secret(secret_name, before, after, resource_version):
+    """send only the changed keys, and refuse to overwrite changes made by
+    others since resource_version. return the patched keys"""
+    data_patch = secret_data_patch(before, after)
+    if not data_patch:
+        return data_patch
+    # resourceVersion in a patch acts as a precondition, the apiserver
+    # answers 409 if the secret has changed in the meantime. the annotation
+    # left by kubectl apply holds a full copy of the secret, drop it as well
+    metadata = {
+        'resourceVersion': resource_version,
+        'annotations': {'kubectl.kubernetes.io/last-applied-configuration': None},
+    }
+    patch = {'metadata': metadata, 'data': data_patch}
+    debug(f'patching secret/{secret_name}: {sorted(data_patch)}')
+    client = tell_kube_client(tell_kubeconfig())
+    client.patch('secrets', secret_name, patch)
+    return data_patch
+
+
+def edit_secret(secret_name, init='env'):
+    """open the plaintext secret in $EDITOR, then patch what's changed"""
+    secret_dic, resource_version = fetch_secret(secret_name, init=init)
+    before = dict(secret_dic['data'])
+    f = dump_secret(secret_dic)
     edit_file(f)
     try:
-        secret_dic = yalo(f)
-        res = kubectl_apply(secret_dic)
-    except (yaml.error.YAMLError, ValueError) as e:
+        after = yalo(f)['data'] or {}
+        changed = patch_secret(secret_name, before, after, resource_version)
+    except (tell_yaml().error.YAMLError, ValueError, TypeError, KeyError, AttributeError) as e:
         name = preserve_tempfile(f)
         err = f'''not a valid kubernetes secret file after edit:
             {e}
 
             don't worry, your work has been saved to: {name}'''
         error(err, exit=1)
-
-    if res.returncode:
+    except KubeError as e:
         name = preserve_tempfile(f)
+        if e.status_code == 409:
+            reason = f'secret/{secret_name} has been changed by someone else since you opened it, nothing is written'
+        else:
+            reason = f'error during patching secret/{secret_name}: {e}'
+
         err = f'''
-        error during kubectl apply (read the above error).
+        {reason}
         don't worry, your work has been saved to: {name}'''
         error(err, exit=1)
 
+    if not changed:
+        goodjob(f'nothing changed in secret/{secret_name}')
+    else:
+        goodjob(f'secret/{secret_name} updated: {", ".join(sorted(changed))}')
+
 
 def preserve_tempfile(f):
     name = f.name
@@ -412,32 +602,114 @@ def preserve_tempfile(f):
     return name
 
 
-def kubectl_apply(dic):
-    """do a b64encode on all data fields, then kubectl apply, easy job"""
-    if dic['kind'] == 'Secret':
-        for fname, s in dic['data'].items():
-            try:
-                dic['data'][fname] = base64.b64encode(s.encode('utf-8')).decode('utf-8')
-            except AttributeError:
-                raise ValueError(f'kubernetes secret data should be string, got {fname}: {s}')
+DOTENV_LINE = re.compile(r'^\s*(?:export\s+)?([A-Za-z_][A-Za-z0-9_.-]*)\s*=\s*(.*?)\s*$')
+DOTENV_ESCAPES = {'n': '\n', 't': '\t', '"': '"', '\\': '\\', '$': '$'}
 
-    debug('dumping kubernetes manifest:')
-    debug(dic)
-    f = NamedTemporaryFile(suffix='.yaml')
-    yadu(dic, f)
-    f.seek(0)
-    return kubectl('apply', '-f', f.name)
+
+def parse_dotenv(lines):
+    r"""yield (key, value) from dotenv lines, one line at a time
+    >>> list(parse_dotenv(['# comment', 'export FOO=bar', "EGG='spam # not a comment'", 'MULTI="a\\nb"', 'BARE=x # comment']))
+    [('FOO', 'bar'), ('EGG', 'spam # not a comment'), ('MULTI', 'a\nb'), ('BARE', 'x')]
+    """
+    for lineno, line in enumerate(lines, 1):
+        if not line.strip() or line.lstrip().startswith('#'):
+            continue
+        m = DOTENV_LINE.match(line)
+        if not m:
+            raise ValueError(f'line {lineno} is not KEY=VALUE: {line.strip()}')
+        key, value = m.groups()
+        if len(value) > 1 and value[0] == value[-1] == "'":
+            value = value[1:-1]
+        elif len(value) > 1 and value[0] == value[-1] == '"':
+            value = re.sub(r'\\(.)', lambda m: DOTENV_ESCAPES.get(m.group(1), m.group(0)), value[1:-1])
+        else:
+            value = value.split(' #', 1)[0].rstrip()
+
+        yield key, value
+
+
+def format_dotenv(key, value):
+    r"""
+    >>> format_dotenv('FOO', 'bar')
+    'FOO=bar'
+    >>> format_dotenv('MULTI', 'a "b"\nc')
+    'MULTI="a \\"b\\"\\nc"'
+    """
+    if re.fullmatch(r'[A-Za-z0-9_./:@,+-]*', value):
+        return f'{key}={value}'
+    escaped = value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n').replace('\t', '\\t').replace('$', '\\$')
+    return f'{key}="{escaped}"'
+
+
+def load_env_file(f):
+    """dotenv, or yaml if the file name says so. a yaml file can be a plain
+    mapping, or a secret manifest, like the output of lain env show"""
+    name = getattr(f, 'name', '') or ''
+    if not name.endswith(('.yaml', '.yml')):
+        return dict(parse_dotenv(f))
+    dic = yalo(f) or {}
+    if dic.get('kind') == 'Secret':
+        dic = dic.get('data') or {}
+    if not isinstance(dic, dict):
+        raise ValueError(f'expecting a mapping in {name}')
+    return {str(k): v if isinstance(v, str) else json.dumps(v) for k, v in dic.items()}
+
+
+def diff_secret_data(before, after, prune=False):
+    """return (added, changed, removed) keys
+    >>> diff_secret_data({'A': '1', 'B': '2', 'C': '3'}, {'A': '1', 'B': '0', 'D': '4'}, prune=True)
+    (['D'], ['B'], ['C'])
+    """
+    added = sorted(after.keys() - before.keys())
+    changed = sorted(k for k in after.keys() & before.keys() if after[k] != before[k])
+    removed = sorted(before.keys() - after.keys()) if prune else []
+    return added, changed, removed
+
+
+def import_secret(secret_name, data, prune=False, dry_run=False):
+    """upsert data into secret, in one write request: created with exactly
+    data if it doesn't exist, otherwise patched with the changed keys.
+    keys not in data are kept, unless prune. return (added, changed, removed)"""
+    client = tell_kube_client(tell_kubeconfig())
+    try:
+        secret = client.read_secret(secret_name)
+        before = secret.decoded() if secret else {}
+        after = dict(data) if prune else {**before, **data}
+        diff = diff_secret_data(before, after, prune=prune)
+        if dry_run or not any(diff):
+            return diff
+        if secret:
+            patch_secret(secret_name, before, after, secret.resource_version)
+        else:
+            client.create_secret(secret_name, after)
+    except KubeError as e:
+        if e.status_code == 409:
+            error(f'secret/{secret_name} has been changed by someone else during import, nothing is written', exit=1)
+        error(f'error during importing into secret/{secret_name}: {e}', exit=1)
+
+    return diff
+
+
+def update_secret(secret_name, pairs, init='env'):
+    """set keys in secret, without touching the rest"""
+    secret_dic, resource_version = fetch_secret(secret_name, init=init)
+    before = secret_dic['data']
+    try:
+        return patch_secret(secret_name, before, {**before, **dict(pairs)}, resource_version)
+    except KubeError as e:
+        error(f'error during patching secret/{secret_name}: {e}', exit=1)
 
 
-def tell_cluster_values_file():
-    cluster = tell_cluster()
+def tell_cluster_values_file(cluster=None):
+    cluster = cluster or tell_cluster()
     values_file = join(CHART_DIR_NAME, f'values-{cluster}.yaml')
     if isfile(values_file):
         return values_file
 
 
-def tell_helm_set_clause(pairs):
-    """Sure you can override helm values, but I might not approve it"""
+def tell_helm_set_clause(pairs, image_tag=None):
+    """Sure you can override helm values, but I might not approve it. pass
+    image_tag if it's already been checked by tell_image_tag"""
     ctx = context()
     cluster = ctx.obj['cluster']
     registry = FUTURE_CLUSTERS[cluster]['registry']
@@ -446,24 +718,26 @@ def tell_helm_set_clause(pairs):
         f'registry={registry}', f'cluster={cluster}',
         *[f'{k}={v}' for k, v in pairs if k != 'imageTag']
     ]
-    pair = next(((k, image_tag) for k, image_tag in pairs if k == 'imageTag'), None)
-    image_tag = None
-    if pair:
-        _, image_tag = pair
+    if not image_tag:
+        pair = next(((k, image_tag) for k, image_tag in pairs if k == 'imageTag'), None)
+        if pair:
+            _, image_tag = pair
+
+        image_tag = tell_image_tag(image_tag)
 
-    image_tag = tell_image_tag(image_tag)
     kvlist.append(f'imageTag={image_tag}')
     return ','.join(kvlist)
 
 
-def tell_image_tag(image_tag=None):
+def tell_image_tag(image_tag=None, existing_tags=None):
     """really smart method to figure out which image_tag is the right one to deploy:
         1. if image_tag isn't provided, obtain from legacy_lain
-        2. check for existence against the specified registry
+        2. check for existence against the specified registry, existing_tags
+           can be passed in if they're already fetched
         3. if image doesn't exist, print helpful suggestions
     """
     if not image_tag:
-        image_tag = legacy_lain('meta', capture_output=True).stdout.decode('utf-8').strip()
+        image_tag = tell_meta_version()
 
     if not image_tag.startswith('release-'):
         image_tag = f'release-{image_tag}'
@@ -471,9 +745,15 @@ def tell_image_tag(image_tag=None):
     ctx = context()
     appname = ctx.obj['appname']
     registry = Registry(tell_cluster_info()['registry'])
-    existing_tags = registry.tags_list(appname)
+    if existing_tags is None:
+        existing_tags = registry.tags_list(appname)
+
+    if image_tag not in existing_tags:
+        # local index may have gone stale, e.g. tags deleted and pushed again
+        existing_tags = registry.tags_list(appname, full=True)
+
     if image_tag not in existing_tags:
-        latest_tag = max(existing_tags)
+        latest_tag = existing_tags[0] if existing_tags else None
         recent_tags = '\n            '.join(existing_tags[:5])
         caller_name = inspect.stack()[1].function
         if caller_name == 'update_image':
@@ -498,23 +778,253 @@ def tell_image_tag(image_tag=None):
     return image_tag
 
 
-def legacy_lain(*args, exit=None, fake_lain_yaml=True, **kwargs):
-    """sometimes we wanna use chart/values.yaml as LAIN_YAML, thus the fake_lain_yaml flag"""
-    cmd = ['legacy_lain', *args]
-    # use chart/values.yaml as lain.yaml if it exists
+def find_git_dir(path=None):
+    """the .git directory of the repo that path is in, following the
+    `gitdir:` file that worktrees and submodules use"""
+    path = abspath(path or cwd())
+    while True:
+        dot_git = join(path, '.git')
+        if isdir(dot_git):
+            return dot_git
+        if isfile(dot_git):
+            with open(dot_git) as f:
+                content = f.read().strip()
+
+            if content.startswith('gitdir:'):
+                return abspath(join(path, content[len('gitdir:'):].strip()))
+        parent = dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+def tell_git_dirs(git_dir):
+    """worktrees keep their own HEAD, but share refs and objects with the
+    main repo, which is pointed to by commondir"""
+    try:
+        with open(join(git_dir, 'commondir')) as f:
+            return [git_dir, abspath(join(git_dir, f.read().strip()))]
+    except FileNotFoundError:
+        return [git_dir]
+
+
+def tell_git_head(git_dir):
+    """the commit sha HEAD points to, None for a repo without commits"""
+    with open(join(git_dir, 'HEAD')) as f:
+        head = f.read().strip()
+
+    if not head.startswith('ref:'):
+        return head
+    ref = head[len('ref:'):].strip()
+    git_dirs = tell_git_dirs(git_dir)
+    for d in git_dirs:
+        try:
+            with open(join(d, ref)) as f:
+                return f.read().strip()
+        except (FileNotFoundError, NotADirectoryError):
+            pass
+
+    for d in git_dirs:
+        try:
+            with open(join(d, 'packed-refs')) as f:
+                for line in f:
+                    sha, _, name = line.strip().partition(' ')
+                    if name == ref:
+                        return sha
+        except FileNotFoundError:
+            pass
+
+    return None
+
+
+def parse_commit_time(raw):
+    """committer timestamp of a decompressed commit object
+    >>> parse_commit_time(b'commit 157\\x00tree 4b825dc642cb6eb9a060e54bf8d69288fbee4904\\nauthor Bruce <b@ein.plus> 1574400000 +0800\\ncommitter Bruce <b@ein.plus> 1574411941 +0800\\n\\nrelease')
+    1574411941
+    """
+    _, _, body = raw.partition(b'\x00')
+    for line in body.split(b'\n'):
+        if not line:
+            break
+        if line.startswith(b'committer '):
+            return int(line.rsplit(b' ', 2)[1])
+
+    return None
+
+
+def read_commit_time(git_dir, sha):
+    """None if the commit isn't a loose object, i.e. it's in a pack"""
+    for d in tell_git_dirs(git_dir):
+        try:
+            with open(join(d, 'objects', sha[:2], sha[2:]), 'rb') as f:
+                return parse_commit_time(zlib.decompress(f.read()))
+        except FileNotFoundError:
+            pass
+
+    return None
+
+
+def tell_meta_version():
+    """<commit timestamp>-<commit sha> of HEAD, which is what `legacy_lain
+    meta` prints, and how images are tagged. computed from .git, commits that
+    are packed need a `git show`, results are cached by HEAD"""
+    git_dir = find_git_dir()
+    if not git_dir:
+        error(f'{cwd()} is not in a git repository, cannot tell image tag without a commit', exit=1)
+
+    head = tell_git_head(git_dir)
+    if not head:
+        error('no commits yet, cannot tell image tag without a commit', exit=1)
+
+    cache = load_json_cache(META_VERSION_CACHE_FILE)
+    if head in cache:
+        return cache[head]
+    timestamp = read_commit_time(git_dir, head)
+    if timestamp is None:
+        res = subprocess_run(['git', 'show', '-s', '--format=%ct', head], capture_output=True, check=True)
+        timestamp = int(res.stdout)
+
+    meta_version = cache[head] = f'{timestamp}-{head}'
+    # one entry per commit deployed from this machine, keep the latest ones
+    save_json_cache(dict(list(cache.items())[-META_VERSION_CACHE_SIZE:]), META_VERSION_CACHE_FILE)
+    return meta_version
+
+
+@lru_cache(maxsize=None)
+def load_legacy_lain():
+    """(argh parser, lain_cli.utils) of legacy_lain, loaded once per process,
+    (None, None) if lain_cli cannot be imported here"""
+    try:
+        import lain_cli.utils as legacy_utils
+        from lain_cli.lain import build_parser
+    except ImportError as e:
+        debug(f'legacy_lain will run in a subprocess: {e}')
+        return None, None
+    return build_parser(), legacy_utils
+
+
+def tell_exit_code(code):
+    """
+    >>> tell_exit_code(None), tell_exit_code(3), tell_exit_code('bad news')
+    (0, 3, 1)
+    """
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    return 1
+
+
+@contextmanager
+def capture_fds():
+    """point fd 1 and 2 at temporary files for the duration, and yield them,
+    so that output of child processes is captured along with our own. fds
+    are process wide, so this is for the main thread only"""
+    captured = TemporaryFile(), TemporaryFile()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = os.dup(1), os.dup(2)
+    try:
+        for fd, f in zip((1, 2), captured):
+            os.dup2(f.fileno(), fd)
+
+        with open(1, 'w', encoding='utf-8', closefd=False) as out, \
+                open(2, 'w', encoding='utf-8', closefd=False) as err, \
+                redirect_stdout(out), redirect_stderr(err):
+            yield captured
+    finally:
+        for fd, saved_fd in zip((1, 2), saved):
+            os.dup2(saved_fd, fd)
+            os.close(saved_fd)
+
+
+@contextmanager
+def legacy_sigint_handler(handler):
+    """what lain_cli.lain.main() does for legacy_lain, undone afterwards"""
+    if threading.current_thread() is not threading.main_thread():
+        yield
+        return
+    saved = signal.signal(signal.SIGINT, handler)
+    try:
+        yield
+    finally:
+        signal.signal(signal.SIGINT, saved)
+
+
+def dispatch_legacy_lain(args, lain_yaml_path=None, capture_output=False):
+    """run legacy_lain within this process, as if it were a subprocess:
+    return a CompletedProcess, with output captured at the fd level if asked
+    to, so that whatever legacy_lain spawns is captured as well"""
+    parser, legacy_utils = load_legacy_lain()
+    captured = None
+    saved_lain_yaml_path = legacy_utils.LAIN_YAML_PATH
+    if lain_yaml_path:
+        legacy_utils.LAIN_YAML_PATH = lain_yaml_path
+    returncode = 0
+    try:
+        with ExitStack() as stack:
+            stack.enter_context(legacy_sigint_handler(legacy_utils.exit_gracefully))
+            if capture_output:
+                captured = stack.enter_context(capture_fds())
+            try:
+                parser.dispatch(argv=list(args), output_file=sys.stdout)
+            except SystemExit as e:
+                returncode = tell_exit_code(e.code)
+                if isinstance(e.code, str):
+                    print(e.code, file=sys.stderr)
+            except Exception as e:
+                # a legacy_lain subprocess would have died of it, with a
+                # nonzero exit code, lain shouldn't
+                returncode = getattr(e, 'returncode', None) or 1
+                print(f'legacy_lain {" ".join(args)}: {e.__class__.__name__}: {e}', file=sys.stderr)
+    finally:
+        legacy_utils.LAIN_YAML_PATH = saved_lain_yaml_path
+
+    if not capture_output:
+        return subprocess.CompletedProcess(['legacy_lain', *args], returncode)
+    outputs = []
+    for f in captured:
+        with f:
+            f.seek(0)
+            outputs.append(f.read())
+
+    return subprocess.CompletedProcess(['legacy_lain', *args], returncode, *outputs)
+
+
+@contextmanager
+def legacy_lain_yaml(fake_lain_yaml=True):
+    """yield the lain.yaml legacy_lain should use, None for the default.
+    lain_sdk reads lain.yaml from disk, and builds images in the directory
+    where lain.yaml is, so chart/values.yaml has to be copied next to the
+    build context for the duration"""
     values_yaml = f'./{CHART_DIR_NAME}/values.yaml'
-    temp_lain_yaml = NamedTemporaryFile(prefix=f'{cwd()}/')
-    if isfile(values_yaml) and fake_lain_yaml:
-        # legacy_lain really needs lain.yaml to be in the same directory as the
-        # docker build context, yet nobody want to maintain legacy_lain code, so
-        # it's easiest to just copy chart/values.yaml into a tempfile
-        temp_lain_yaml.write(open(values_yaml, 'rb').read())
-        ENV['LAIN_YAML'] = temp_lain_yaml.name
-        temp_lain_yaml.seek(0)
+    if not (fake_lain_yaml and isfile(values_yaml)):
+        yield None
+        return
+    with NamedTemporaryFile(prefix=f'{cwd()}/') as temp_lain_yaml:
+        with open(values_yaml, 'rb') as f:
+            temp_lain_yaml.write(f.read())
+
+        temp_lain_yaml.flush()
+        yield temp_lain_yaml.name
 
+
+def legacy_lain(*args, exit=None, fake_lain_yaml=True, **kwargs):
+    """sometimes we wanna use chart/values.yaml as LAIN_YAML, thus the fake_lain_yaml flag.
+    lain_cli is run in-process when it's importable, and when nothing is being
+    recorded or replayed, otherwise in a legacy_lain subprocess"""
+    cmd = ['legacy_lain', *args]
     excall(cmd)
-    res = subprocess_run(cmd, env=ENV, **kwargs)
-    temp_lain_yaml.close()
+    in_process = not transport.is_active() and set(kwargs) <= {'capture_output'} and load_legacy_lain()[0]
+    with legacy_lain_yaml(fake_lain_yaml) as lain_yaml_path:
+        if in_process:
+            with span(tell_cmd_name(cmd), 'legacy', argv=cmd) as trace_args:
+                res = dispatch_legacy_lain(args, lain_yaml_path=lain_yaml_path, **kwargs)
+                trace_args['returncode'] = res.returncode
+        else:
+            env = {**ENV, 'LAIN_YAML': lain_yaml_path} if lain_yaml_path else ENV
+            res = subprocess_run(cmd, env=env, **kwargs)
+
     if exit:
         context().exit(res.returncode)
 
@@ -538,8 +1048,12 @@ def ensure_resource_initiated(chart=False, secret=False):
         ]
         if subPaths:
             cluster = ctx.obj['cluster']
-            res = kubectl('-n', 'default', 'get', 'secret', ctx.obj['secret_name'], capture_output=True)
-            if res.returncode:
+            try:
+                secret = tell_kube_client(tell_kubeconfig()).read_secret(ctx.obj['secret_name'])
+            except KubeError as e:
+                error(f'error during fetching secret/{ctx.obj["secret_name"]}: {e}', exit=1)
+
+            if not secret:
                 tutorial = '\n'.join(f'lain secret add {f}' for f in subPaths)
                 err = f'''
                 Secret {subPaths} not found, you should create them:
@@ -549,7 +1063,7 @@ def ensure_resource_initiated(chart=False, secret=False):
                     lain secret edit
                 '''
                 error(err)
-                ctx.exit(res.returncode)
+                ctx.exit(1)
 
     return True
 
@@ -559,7 +1073,18 @@ def subprocess_run(*args, **kwargs):
     python traceback, people want to see command stderr, rather than
     meaningless tracebacks"""
     check = kwargs.pop('check', None)
-    res = subprocess.run(*args, **kwargs)
+    cmd = args[0] if args else kwargs['args']
+    with span(tell_cmd_name(cmd), 'subprocess', argv=cmd) as trace_args:
+        try:
+            res = transport.run(*args, **kwargs)
+        except CassetteMiss as e:
+            error(str(e), exit=1)
+        trace_args.update(
+            returncode=res.returncode,
+            bytes_out=tell_size(kwargs.get('input')),
+            bytes_in=(tell_size(res.stdout) or 0) + (tell_size(res.stderr) or 0),
+        )
+
     if check:
         code = res.returncode
         if code:
@@ -568,41 +1093,177 @@ def subprocess_run(*args, **kwargs):
     return res
 
 
-def helm(*args, **kwargs):
+def tell_version_tuple(version):
+    """
+    >>> tell_version_tuple('v1.17.0')
+    (1, 17, 0)
+    >>> tell_version_tuple('v3.0.2+g19e47ee')
+    (3, 0, 2)
+    >>> tell_version_tuple('whatever')
+    ()
+    """
+    m = re.match(r'^v?(\d+(?:\.\d+)*)', version or '')
+    if not m:
+        return ()
+    return tuple(int(n) for n in m.group(1).split('.'))
+
+
+# how to probe each binary, and the minimum version lain4 can work with
+TOOLCHAIN = MappingProxyType({
+    'kubectl': MappingProxyType({
+        'probe': ('version', '--short', '--client=true'),
+        'dest': KUBECTL_BIN,
+        'minimum': (1, 15),
+    }),
+    'helm': MappingProxyType({
+        'probe': ('version', '--short'),
+        'dest': HELM_BIN,
+        'minimum': (3,),
+    }),
+})
+# resolved binaries, so that within a single lain process, each binary is
+# only stat-ed once
+toolchain_memo = {}
+
+
+def load_json_cache(path):
     try:
-        version_res = subprocess_run(['helm', 'version', '--short'], capture_output=True, check=True)
-        version = version_res.stdout.decode('utf-8')
-    except FileNotFoundError:
-        download_binary('helm', dest=HELM_BIN)
-        return helm(*args, **kwargs)
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_json_cache(cache, path):
+    try:
+        os.makedirs(dirname(path), exist_ok=True)
+        with NamedTemporaryFile('w', dir=dirname(path), delete=False) as f:
+            json.dump(cache, f)
+
+        os.replace(f.name, path)
+    except OSError as e:
+        # a read-only home directory shouldn't stop anyone from deploying
+        debug(f'cannot write cache {path}: {e}')
+
+
+def load_toolchain_cache():
+    return load_json_cache(TOOLCHAIN_CACHE_FILE)
+
+
+def save_toolchain_cache(cache):
+    save_json_cache(cache, TOOLCHAIN_CACHE_FILE)
+
+
+def probe_binary(thing, path):
+    """run `[thing] version` and return the version string, this is the only
+    place where lain spawns a process just to learn about its toolchain"""
+    try:
+        res = subprocess_run([thing, *TOOLCHAIN[thing]['probe']], executable=path, capture_output=True)
     except PermissionError:
-        error(f'Bad binary: {HELM_BIN}, remove it befure use', exit=1)
-    if not version.startswith('v3'):
-        download_binary('helm', dest=HELM_BIN)
-        return helm(*args, **kwargs)
-    cmd = ['helm', '-n', 'default', *args]
+        error(f'Bad binary: {path}, remove it before use', exit=1)
+
+    if res.returncode:
+        return None
+    # kubectl: "Client Version: v1.17.0", helm: "v3.0.2+g19e47ee"
+    return ensure_str(res.stdout).strip().split()[-1]
+
+
+def tell_binary(thing, downloaded=False):
+    """return absolute path for kubectl / helm, download when missing or
+    incompatible.
+    version probing costs a subprocess, thus results are cached on disk, keyed
+    by path, inode and mtime, a binary that's replaced or upgraded in place
+    will be probed again"""
+    if transport.is_offline():
+        # nothing is actually run
+        return thing
+    spec = TOOLCHAIN[thing]
+    path = shutil.which(thing)
+    if not path:
+        if downloaded:
+            error(f'{thing} not found even after download, check your PATH and LAIN_EXBIN_PREFIX', exit=1)
+
+        download_binary(thing, dest=spec['dest'])
+        return tell_binary(thing, downloaded=True)
+
+    st = os.stat(path)
+    fingerprint = {'inode': st.st_ino, 'mtime': st.st_mtime_ns}
+    memo = toolchain_memo.get(thing)
+    if memo and memo['path'] == path and memo['fingerprint'] == fingerprint:
+        return path
+
+    cache = load_toolchain_cache()
+    record = cache.get(path)
+    if not record or {k: record.get(k) for k in fingerprint} != fingerprint:
+        version = probe_binary(thing, path)
+        record = {
+            **fingerprint,
+            'version': version,
+            'compatible': tell_version_tuple(version) >= spec['minimum'],
+        }
+        cache[path] = record
+        save_toolchain_cache(cache)
+
+    if not record['compatible']:
+        if downloaded:
+            error(f'{path} is still incompatible ({record["version"]}) after download, remove it before use', exit=1)
+
+        download_binary(thing, dest=spec['dest'])
+        return tell_binary(thing, downloaded=True)
+
+    toolchain_memo[thing] = {'path': path, 'fingerprint': fingerprint, 'version': record['version']}
+    return path
+
+
+def tell_kubeconfig():
+    """kubeconfig for this invocation, None means ~/.kube/config, which is
+    what `lain use` links to"""
+    ctx = context(silent=True)
+    if ctx and ctx.obj:
+        return ctx.obj.get('kubeconfig')
+
+
+def tell_kubeconfig_file(cluster):
+    kubeconfig_file = expanduser(f'~/.kube/kubeconfig-{cluster}')
+    if not isfile(kubeconfig_file):
+        error(f'{kubeconfig_file} not found, go fetch it from 1pw, under the "kubeconfig" item', exit=1)
+
+    return kubeconfig_file
+
+
+def helm_cmd(*args):
+    cmd = ['helm', '-n', 'default']
+    kubeconfig = tell_kubeconfig()
+    if kubeconfig:
+        cmd.extend(['--kubeconfig', kubeconfig])
+
+    cmd.extend(args)
+    return cmd
+
+
+def helm(*args, **kwargs):
+    helm_bin = tell_binary('helm')
+    cmd = helm_cmd(*args)
     excall(cmd)
-    completed = subprocess_run(cmd, env=ENV, **kwargs)
+    completed = subprocess_run(cmd, executable=helm_bin, env=ENV, **kwargs)
     return completed
 
 
+def kubectl_cmd(*args, timeout=2):
+    cmd = ['kubectl', f'--request-timeout={timeout}']
+    kubeconfig = tell_kubeconfig()
+    if kubeconfig:
+        cmd.append(f'--kubeconfig={kubeconfig}')
+
+    cmd.extend(args)
+    return cmd
+
+
 def kubectl(*args, exit=None, timeout=2, **kwargs):
-    try:
-        version_res = subprocess_run(['kubectl', 'version', '--short', '--client=true'], capture_output=True)
-        version = version_res.stdout.decode('utf-8').strip().split()[-1]
-    except FileNotFoundError:
-        download_binary('kubectl', dest=KUBECTL_BIN)
-        return kubectl(*args, exit=exit, **kwargs)
-    except PermissionError:
-        error(f'Bad binary: {KUBECTL_BIN}, remove it befure use', exit=1)
-    if version < 'v1.15':
-        download_binary('kubectl', dest=KUBECTL_BIN)
-        return kubectl(*args, exit=exit, **kwargs)
-    env = os.environ
-    env['PATH'] = f'{KUBECTL_BIN}:{env["PATH"]}'
-    cmd = ['kubectl', f'--request-timeout={timeout}', *args]
+    kubectl_bin = tell_binary('kubectl')
+    cmd = kubectl_cmd(*args, timeout=timeout)
     excall(cmd)
-    completed = subprocess_run(cmd, env=env, **kwargs)
+    completed = subprocess_run(cmd, executable=kubectl_bin, env=ENV, **kwargs)
     if exit:
         context().exit(completed.returncode)
 
@@ -612,7 +1273,12 @@ def kubectl(*args, exit=None, timeout=2, **kwargs):
 def print_app_status():
     ctx = context()
     appname = ctx.obj['appname']
-    kubectl('get', 'po', '-l', f'app.kubernetes.io/name={appname}')
+    try:
+        pods = tell_kube_client(tell_kubeconfig()).list_pods(label_selector=f'app.kubernetes.io/name={appname}')
+    except KubeError as e:
+        error(f'error during listing pods: {e}', exit=1)
+
+    echo(pods_table(pods))
 
 
 def tell_cluster():
@@ -641,28 +1307,195 @@ def tell_platform():
     context().exit(1)
 
 
+def sha256sum(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(partial(f.read, BINARY_CHUNK_SIZE), b''):
+            h.update(block)
+
+    return h.hexdigest()
+
+
+def tell_chunks(size, chunk_size=None):
+    """byte ranges to fetch, inclusive, like in the Range header
+    >>> tell_chunks(10, chunk_size=4)
+    [(0, 3), (4, 7), (8, 9)]
+    >>> tell_chunks(0)
+    []
+    """
+    chunk_size = chunk_size or BINARY_CHUNK_SIZE
+    return [(start, min(start + chunk_size, size) - 1) for start in range(0, size, chunk_size)]
+
+
+class DownloadChanged(Exception):
+    """the file changed on the server during an interrupted download"""
+
+
+def fetch_binary(session, url, dest, etag, size):
+    """download url into dest. when the server supports range requests,
+    chunks are fetched in parallel, and recorded in {dest}.json as they
+    complete, so that an interrupted download picks up where it left off, as
+    long as the ETag stays the same"""
+    state_file = f'{dest}.json'
+    state = load_json_cache(state_file)
+    if (state.get('url'), state.get('etag'), state.get('size')) != (url, etag, size) or not isfile(dest):
+        state = {'url': url, 'etag': etag, 'size': size, 'done': []}
+        with open(dest, 'wb') as f:
+            f.truncate(size)
+
+    done = set(state['done'])
+    todo = [chunk for chunk in tell_chunks(size) if chunk[0] not in done]
+    if done:
+        echo(f'resuming download, {len(done)} of {len(done) + len(todo)} chunks already there', err=True)
+    lock = threading.Lock()
+    fd = os.open(dest, os.O_WRONLY)
+
+    def fetch(chunk):
+        start, end = chunk
+        headers = {'Range': f'bytes={start}-{end}', 'If-Range': etag}
+        with session.get(url, headers=headers, stream=True) as res:
+            res.raise_for_status()
+            if res.status_code != 206:
+                raise DownloadChanged(url)
+            offset = start
+            for block in res.iter_content(64 * 1024):
+                os.pwrite(fd, block, offset)
+                offset += len(block)
+
+        if offset != end + 1:
+            raise IOError(f'short read for bytes {start}-{end} of {url}')
+        with lock:
+            state['done'].append(start)
+            save_json_cache(state, state_file)
+
+    executor = ThreadPoolExecutor(max_workers=BINARY_DOWNLOAD_WORKERS)
+    futures = [executor.submit(fetch, chunk) for chunk in todo]
+    try:
+        for future in futures:
+            future.result()
+    except DownloadChanged:
+        ensure_absent(state_file)
+        raise
+    finally:
+        # on ctrl-c, let the running chunks finish, and drop the rest
+        for future in futures:
+            future.cancel()
+        executor.shutdown()
+        os.close(fd)
+
+    ensure_absent(state_file)
+
+
+def stream_binary(session, url, dest):
+    """servers that can't do ranges get a plain download, without resume"""
+    with session.get(url, stream=True) as res:
+        res.raise_for_status()
+        with open(dest, 'wb') as f:
+            for block in res.iter_content(64 * 1024):
+                f.write(block)
+
+
+def link_binary(blob, dest):
+    """atomically point dest to blob, whatever was at dest is replaced"""
+    tmp = f'{dest}.lain-{os.getpid()}'
+    try:
+        if os.path.lexists(tmp):
+            remove(tmp)
+        os.symlink(blob, tmp)
+        os.replace(tmp, dest)
+    except OSError as e:
+        error(f'cannot link {blob} to {dest}: {e}, export LAIN_EXBIN_PREFIX and try this again', exit=1)
+
+
+@contextmanager
+def file_lock(path):
+    """an exclusive lock across processes, held for the duration"""
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
 def download_binary(thing, dest):
+    """fetch kubectl / helm into BINARY_CACHE_DIR, verify it, and symlink it
+    to dest. the index maps url to the sha256 and ETag of what was downloaded,
+    a binary that's already in the cache costs a single HEAD request"""
     assert thing in {'kubectl', 'helm'}
     platform = tell_platform()
     url = f'{CDN}/lain4/{thing}-{platform}'
-    headsup = f'''
+    cache_dir = BINARY_CACHE_DIR
+    index_file = join(cache_dir, 'index.json')
+    os.makedirs(join(cache_dir, 'partial'), exist_ok=True)
+    import requests
+    session = requests.Session()
+    with span(f'HEAD {url}', 'http', url=url):
+        try:
+            head = session.head(url, allow_redirects=True)
+            head.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            error(f'cannot download {url}: {e}', exit=1)
+
+    etag = head.headers.get('ETag')
+    size = int(head.headers.get('Content-Length') or 0)
+    partial_file = join(cache_dir, 'partial', f'{thing}-{platform}')
+    # the cache is shared between processes, CI runners bootstrapping at the
+    # same time take turns, and whoever comes second finds it in the index
+    with file_lock(f'{partial_file}.lock'):
+        index = load_json_cache(index_file)
+        entry = index.get(url)
+        if entry and etag and entry['etag'] == etag:
+            blob = join(cache_dir, entry['sha256'])
+            if isfile(blob) and sha256sum(blob) == entry['sha256']:
+                debug(f'{url} found in {cache_dir}')
+                link_binary(blob, dest)
+                return
+
+        headsup = f'''
     Don\'t mind me, just gonna download {url} into {dest}.
     If you don't like this, you can either:
         export LAIN_EXBIN_PREFIX and try this again
         install kubectl and helm yourself (for example, Homebrew)
     '''
-    click.echo(headsup, err=True)
-    try:
-        with requests.get(url, stream=True) as res:
-            with open(dest, 'wb') as f:
-                shutil.copyfileobj(res.raw, f)
-    except KeyboardInterrupt:
-        error(f'Download did not complete, {HELM_BIN} will be cleaned up', exit=1)
-        ensure_absent(f)
-
-    # do a `chmod +x` on this thing
-    st = os.stat(dest)
-    os.chmod(dest, st.st_mode | stat.S_IEXEC)
+        click.echo(headsup, err=True)
+        resumable = bool(etag and size and head.headers.get('Accept-Ranges') == 'bytes')
+        try:
+            with span(f'GET {url}', 'http', url=url, bytes_in=size):
+                if resumable:
+                    fetch_binary(session, url, partial_file, etag, size)
+                else:
+                    stream_binary(session, url, partial_file)
+        except KeyboardInterrupt:
+            if not resumable:
+                ensure_absent(partial_file)
+            error('Download did not complete' + (', run this again to resume' if resumable else ''), exit=1)
+        except DownloadChanged:
+            error(f'{url} changed during download, run this again to start over', exit=1)
+        except (requests.exceptions.RequestException, IOError) as e:
+            error(f'cannot download {url}: {e}' + (', run this again to resume' if resumable else ''), exit=1)
+
+        if size and os.path.getsize(partial_file) != size:
+            ensure_absent(partial_file)
+            error(f'{url} is truncated, expected {size} bytes, run this again', exit=1)
+        digest = sha256sum(partial_file)
+        if entry and entry['etag'] == etag and entry['sha256'] != digest:
+            ensure_absent(partial_file)
+            error(f'{url} does not match its recorded checksum {entry["sha256"]}, run this again', exit=1)
+
+        blob = join(cache_dir, digest)
+        # do a `chmod +x` on this thing
+        st = os.stat(partial_file)
+        os.chmod(partial_file, st.st_mode | stat.S_IEXEC | stat.S_IXGRP | stat.S_IXOTH)
+        os.replace(partial_file, blob)
+        with file_lock(f'{index_file}.lock'):
+            # kubectl and helm may be downloaded at the same time, don't lose
+            # the other's entry
+            index = load_json_cache(index_file)
+            index[url] = {'sha256': digest, 'etag': etag, 'size': size}
+            save_json_cache(index, index_file)
+
+    link_binary(blob, dest)
     autocompletion_tutorial = {
         'kubectl': '''For zsh user, checkout https://github.com/robbyrussell/oh-my-zsh/blob/master/plugins/kubectl/kubectl.plugin.zsh
         Others may learn the same thing at https://kubernetes.io/docs/tasks/tools/install-kubectl/#optional-kubectl-configurations''',
@@ -696,6 +1529,67 @@ def find(path):
             yield relpath
 
 
+def tell_digest(content):
+    """
+    >>> tell_digest(b'lain')[:12]
+    'sha256:f9221'
+    """
+    return 'sha256:' + hashlib.sha256(content).hexdigest()
+
+
+def tell_file_digest(path):
+    try:
+        with open(path, 'rb') as f:
+            return tell_digest(f.read())
+    except FileNotFoundError:
+        return None
+
+
+def write_if_changed(path, content):
+    """write bytes to path only if the content differs from what's on disk,
+    returns True if the file was written"""
+    if tell_file_digest(path) == tell_digest(content):
+        return False
+    os.makedirs(dirname(path) or '.', exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(content)
+
+    return True
+
+
+def tell_values_digests():
+    """digests of every values file in ./chart, lint results depend on these"""
+    try:
+        fnames = sorted(f for f in os.listdir(CHART_DIR_NAME) if is_values_file(f))
+    except FileNotFoundError:
+        return {}
+    return {f: tell_file_digest(join(CHART_DIR_NAME, f)) for f in fnames}
+
+
+def tell_chart_manifest_file():
+    """records what lain init last applied to ./chart, and whether it passed
+    lint, kept out of the chart so that it's neither committed nor packaged"""
+    chart_dir = realpath(CHART_DIR_NAME)
+    digest = hashlib.sha1(chart_dir.encode('utf-8')).hexdigest()[:16]
+    return join(LAIN_CACHE_DIR, 'charts', f'{digest}.json')
+
+
+def load_chart_manifest():
+    try:
+        with open(tell_chart_manifest_file()) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_chart_manifest(manifest):
+    manifest_file = tell_chart_manifest_file()
+    os.makedirs(dirname(manifest_file), exist_ok=True)
+    with open(manifest_file, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
 def edit_file(f):
     f.seek(0)
     subprocess.call([ENV.get('EDITOR', 'vim'), f.name])
@@ -706,20 +1600,24 @@ def yalo(f):
     """tired of yaml bitching about unsafe loaders"""
     # I've seen things you wouldn't believe
     # tempfile buffer content could be different from the actual hard disk
-    # content
-    if hasattr(f, 'name'):
-        with open(f.name) as file_again:
+    # content, editors even replace the file altogether, so files with a
+    # path are read from disk, and only once
+    name = getattr(f, 'name', None)
+    if isinstance(name, str) and isfile(name):
+        if hasattr(f, 'flush'):
+            f.flush()
+
+        with open(name, 'rb') as file_again:
             f = file_again.read()
-
-    if hasattr(f, 'read'):
+    elif hasattr(f, 'read'):
         f.seek(0)
         f = f.read()
 
-    return yaml.load(f, Loader=yaml.FullLoader)
+    return tell_yaml().load(f, Loader=tell_yaml_loader())
 
 
 def yadu(dic, f=None):
-    s = yaml.dump(dic, allow_unicode=True)
+    s = tell_yaml().dump(dic, Dumper=tell_yaml_dumper(), allow_unicode=True)
     if not f:
         return s
     if hasattr(f, 'read'):
@@ -743,16 +1641,194 @@ def brief(s):
     return single_line
 
 
+def record_leaves(provenance, value, source, path):
+    """record source for every leaf under path, if source is None, record
+    the leaf value itself"""
+    if isinstance(value, Mapping) and value:
+        for k, v in value.items():
+            record_leaves(provenance, v, source, f'{path}.{k}' if path else k)
+    else:
+        provenance[path] = value if source is None else source
+
+
+def merge_values(merged, provenance, layer, source, prefix=''):
+    """same as recursive_update, but also records which source set each leaf
+    >>> merged, provenance = {}, {}
+    >>> merge_values(merged, provenance, {'a': {'b': 1, 'c': 2}, 'd': [1]}, 'values.yaml')
+    >>> merge_values(merged, provenance, {'a': {'c': 3}, 'd': {'e': 4}}, 'values-bei.yaml')
+    >>> merged
+    {'a': {'b': 1, 'c': 3}, 'd': {'e': 4}}
+    >>> provenance
+    {'a.b': 'values.yaml', 'a.c': 'values-bei.yaml', 'd.e': 'values-bei.yaml'}
+    """
+    for k, v in (layer or {}).items():
+        path = f'{prefix}{k}'
+        if isinstance(v, Mapping) and type(merged.get(k)) is type(v):
+            merge_values(merged[k], provenance, v, source, f'{path}.')
+            continue
+        # replaced as a whole, forget where the old value came from
+        provenance.pop(path, None)
+        for stale in [p for p in provenance if p.startswith(f'{path}.')]:
+            del provenance[stale]
+
+        merged[k] = deepcopy(v)
+        record_leaves(provenance, v, source, path)
+
+
+def parse_set_value(s):
+    """mimic how helm --set treats values
+    >>> [parse_set_value(s) for s in ['3', 'true', 'null', '1.5', 'web']]
+    [3, True, None, '1.5', 'web']
+    """
+    if re.fullmatch(r'-?\d+', s):
+        return int(s)
+    return {'true': True, 'false': False, 'null': None}.get(s, s)
+
+
+def apply_set_pairs(merged, provenance, pairs, source='--set'):
+    """apply --set pairs like deployments.web.replicaCount=3"""
+    for k, v in pairs:
+        *parents, leaf = k.split('.')
+        layer = {leaf: parse_set_value(v)}
+        for parent in reversed(parents):
+            layer = {parent: layer}
+
+        merge_values(merged, provenance, layer, source)
+
+
+def explain_values(key=None, cluster=None, pairs=()):
+    """return [(leaf, value, source, overridden sources)] for leaves under key,
+    as lain deploy would see them"""
+    cluster = cluster or tell_cluster()
+    values, provenance = resolve_helm_values(cluster)
+    # every layer, by itself, to tell what's been overridden
+    layer_leaves = []
+    for source, path in tell_values_layers(cluster):
+        leaves = {}
+        with open(path) as f:
+            record_leaves(leaves, yalo(f), source, '')
+
+        layer_leaves.append((source, set(leaves)))
+
+    # lain deploy always passes these through --set, see tell_helm_set_clause
+    registry = FUTURE_CLUSTERS[cluster]['registry']
+    apply_set_pairs(values, provenance, [('registry', registry), ('cluster', cluster)], source='lain deploy')
+    if not any(k == 'imageTag' for k, _ in pairs):
+        apply_set_pairs(values, provenance, [('imageTag', '<lain meta>')], source='lain deploy')
+
+    apply_set_pairs(values, provenance, pairs)
+    flat = {}
+    record_leaves(flat, values, None, '')
+    rows = []
+    for leaf in sorted(provenance):
+        if key and leaf != key and not leaf.startswith(f'{key}.'):
+            continue
+        value = flat[leaf]
+        source = provenance[leaf]
+        overridden = [s for s, leaves in layer_leaves if leaf in leaves and s != source]
+        rows.append((leaf, value, source, overridden))
+
+    return rows
+
+
+def tell_values_layers(cluster=None):
+    """[(source, path)], later ones take precedence"""
+    layers = [(f'{CHART_DIR_NAME}/values.yaml', join(CHART_DIR_NAME, 'values.yaml'))]
+    cluster_values_file = tell_cluster_values_file(cluster)
+    if cluster_values_file:
+        layers.append((cluster_values_file, cluster_values_file))
+
+    return layers
+
+
+def tell_file_signature(path):
+    """raises FileNotFoundError, just like open()"""
+    st = os.stat(path)
+    return [st.st_mtime_ns, st.st_size]
+
+
+def tell_values_cache_file(cluster):
+    chart_dir = realpath(CHART_DIR_NAME)
+    digest = hashlib.sha1(chart_dir.encode('utf-8')).hexdigest()[:16]
+    return join(LAIN_CACHE_DIR, 'values', f'{digest}-{cluster or "default"}.json')
+
+
+def load_values_cache(cache_file, signature):
+    try:
+        with open(cache_file) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if cache.get('signature') != signature:
+        return None
+    return cache
+
+
+def save_values_cache(cache_file, cache):
+    try:
+        s = json.dumps(cache)
+        # json turns non-string keys into strings, values like that just
+        # don't get cached
+        if json.loads(s) != cache:
+            return
+        os.makedirs(dirname(cache_file), exist_ok=True)
+        with NamedTemporaryFile('w', dir=dirname(cache_file), delete=False) as f:
+            f.write(s)
+
+        os.replace(f.name, cache_file)
+    except (OSError, TypeError, ValueError) as e:
+        debug(f'cannot write values cache {cache_file}: {e}')
+
+
+# (chart dir, cluster): cache dict, see resolve_helm_values
+values_memo = {}
+
+
+def resolve_helm_values(cluster=None):
+    """chart/values.yaml, overridden by chart/values-[CLUSTER].yaml. return
+    (values, provenance), provenance tells which file set each leaf.
+    layers are parsed only when they changed since last time, the merged
+    result is cached on disk, keyed by file mtimes and the cluster"""
+    from future_lain_cli import __version__
+
+    # outside of a lain4 app, raise FileNotFoundError before anything else
+    tell_file_signature(join(CHART_DIR_NAME, 'values.yaml'))
+    cluster = cluster or tell_cluster()
+    layers = tell_values_layers(cluster)
+    signature = [__version__, *[[source, *tell_file_signature(path)] for source, path in layers]]
+    key = (realpath(CHART_DIR_NAME), cluster)
+    cache = values_memo.get(key)
+    if not cache or cache['signature'] != signature:
+        cache_file = tell_values_cache_file(cluster)
+        cache = load_values_cache(cache_file, signature)
+        if not cache:
+            values, provenance = {}, {}
+            for source, path in layers:
+                with open(path) as f:
+                    merge_values(values, provenance, yalo(f), source)
+
+            cache = {'signature': signature, 'values': values, 'provenance': provenance}
+            save_values_cache(cache_file, cache)
+
+        values_memo[key] = cache
+
+    return deepcopy(cache['values']), dict(cache['provenance'])
+
+
+def tell_helm_values(cluster=None):
+    """chart/values.yaml, overridden by chart/values-[CLUSTER].yaml"""
+    values, _ = resolve_helm_values(cluster)
+    return values
+
+
 def populate_helm_context(obj):
     """gather basic information about the current app.
     If cluster info is provided, will try to fetch app status from Kubernetes"""
     values_yaml = f'./{CHART_DIR_NAME}/values.yaml'
     try:
-        with open(values_yaml) as f:
-            helm_values = yalo(f)
-            appname = obj['appname'] = helm_values['appname']
-            obj['values'] = helm_values
-
+        helm_values = tell_helm_values()
+        appname = obj['appname'] = helm_values['appname']
+        obj['values'] = helm_values
         obj['secret_name'] = f'{appname}-secret'
         obj['env_name'] = f'{appname}-env'
     except FileNotFoundError:
@@ -761,10 +1837,6 @@ def populate_helm_context(obj):
     except KeyError:
         error(f'{values_yaml} doesn\'t look like a valid lain4 yaml, if you want to use lain4 for this app, use `lain inif -f`', exit=1)
 
-    cluster_values_file = tell_cluster_values_file()
-    if cluster_values_file:
-        recursive_update(helm_values, yalo(open(cluster_values_file)))
-
     # collect ingress urls
     obj['urls'] = tell_ingress_urls()
     # set this flag to let us know the user is actually running lain in a lain4
@@ -772,12 +1844,377 @@ def populate_helm_context(obj):
     obj['helm'] = True
 
 
+@contextmanager
+def using_cluster(cluster):
+    """temporarily point lain at another cluster, using its own kubeconfig,
+    registry and values, without touching ~/.kube/config"""
+    ctx = context()
+    saved = {k: ctx.obj.get(k) for k in ('cluster', 'kubeconfig', 'values', 'urls')}
+    ctx.obj['kubeconfig'] = tell_kubeconfig_file(cluster)
+    ctx.obj['cluster'] = cluster
+    ctx.obj['values'] = tell_helm_values(cluster)
+    ctx.obj['urls'] = tell_ingress_urls()
+    try:
+        yield ctx.obj
+    finally:
+        ctx.obj.update(saved)
+
+
 def ensure_helm_initiated():
     ctx = context()
     if not ctx.obj.get('helm'):
         error('not in a lain4 app repo, nothing to do', exit=1)
 
 
+def prepare_deploy(pairs):
+    """pre-flight checks for lain deploy, return arguments for helm. the
+    checks hardly depend on each other, so they run concurrently, and a
+    timing report is printed"""
+    ctx = context()
+    appname = ctx.obj['appname']
+    image_tag = next((v for k, v in pairs if k == 'imageTag'), None)
+    registry = Registry(tell_cluster_info()['registry'])
+    steps = {
+        # no big deal, just using this line to initialized env first
+        # otherwise this deploy may fail because envFrom is referencing a
+        # non-existent secret
+        'env': (partial(tell_secret, ctx.obj['env_name']), ()),
+        'secret': (partial(ensure_resource_initiated, chart=True, secret=True), ()),
+        'helm status': (partial(get_app_status, appname), ()),
+        'meta version': (lambda: image_tag or tell_meta_version(), ()),
+        'registry tags': (partial(registry.tags_list, appname), ()),
+        'image tag': (
+            lambda tag, tags: tell_image_tag(tag, existing_tags=tags), ('meta version', 'registry tags'),
+        ),
+    }
+    start = time.perf_counter()
+    results, timings = run_dag(steps)
+    rows = [[name, ', '.join(steps[name][1]), f'{timings[name]:.2f}s'] for name in steps]
+    echo(format_table(['STEP', 'AFTER', 'DURATION'], rows), err=True)
+    echo(
+        f'pre-flight took {time.perf_counter() - start:.2f}s, {sum(timings.values()):.2f}s if run one by one',
+        err=True,
+    )
+    status = results['helm status']
+    if status and status['info']['status'] in HELM_WEIRD_STATE:
+        err = f'''Chart deployed but in a weird state. Now do this:
+            helm status {appname}
+            kubectl get po -l app.kubernetes.io/name={appname}
+            kubectl describe pod [POD_NAME]
+            kubectl logs -f pod [POD_NAME]
+        Once you learn and fix the problem, delete this failed install VERY CAREFULLY:
+            helm delete {appname}'''
+        error(err)
+        ctx.exit(1)
+
+    set_clause = tell_helm_set_clause(pairs, image_tag=results['image tag'])
+    options = ['--atomic', '--install', '--wait', '--set', set_clause]
+    # if chart/values-[CLUSTER].yaml exists, use it
+    values_file = tell_cluster_values_file(ctx.obj['cluster'])
+    if values_file:
+        options.extend(['-f', values_file])
+
+    return ['upgrade', *options, appname, f'./{CHART_DIR_NAME}']
+
+
+def run_dag(steps, max_workers=8):
+    """run {name: (func, deps)} in threads, a step starts as soon as all of
+    its deps are done, and is called with their results. return ({name:
+    result}, {name: seconds}). if a step raises, nothing new is started, and
+    the exception is re-raised once running steps are done
+    >>> results, _ = run_dag({'b': (lambda a: a + 1, ('a',)), 'a': (lambda: 1, ())})
+    >>> results
+    {'a': 1, 'b': 2}
+    """
+    # click context is thread local, steps still need it
+    ctx = context(silent=True)
+    results, timings = {}, {}
+    pending, running = dict(steps), {}
+
+    def run(name, func, args):
+        start = time.perf_counter()
+        try:
+            with span(name, 'step'):
+                if not ctx:
+                    return func(*args)
+                with ctx.scope(cleanup=False):
+                    return func(*args)
+        finally:
+            timings[name] = time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=max_workers) as e:
+        while pending or running:
+            for name, (func, deps) in list(pending.items()):
+                if all(d in results for d in deps):
+                    del pending[name]
+                    running[e.submit(run, name, func, [results[d] for d in deps])] = name
+
+            if not running:
+                raise ValueError(f'cannot run {", ".join(pending)}, check their deps')
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future)] = future.result()
+
+    return results, timings
+
+
+def run_concurrently(cmds, executable=None, outputs=None):
+    """run {label: cmd} all at once, output is interleaved line by line, and
+    prefixed with label. return {label: (returncode, seconds)}. if outputs is
+    a dict, lines are also collected into outputs[label]"""
+    lock = threading.Lock()
+    colors = cycle(['cyan', 'magenta', 'blue', 'yellow', 'green'])
+
+    def run(label, cmd, color):
+        prefix = click.style(f'[{label}] ', fg=color)
+        start = time.perf_counter()
+        with span(tell_cmd_name(cmd), 'subprocess', argv=cmd, label=label) as trace_args:
+            proc = transport.popen(cmd, executable=executable, env=ENV, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            bytes_in = 0
+            lines = outputs.setdefault(label, []) if outputs is not None else None
+            for line in proc.stdout:
+                bytes_in += len(line)
+                line = ensure_str(line).rstrip('\n')
+                if lines is not None:
+                    lines.append(line)
+                with lock:
+                    click.echo(prefix + line, err=True)
+
+            trace_args.update(returncode=proc.wait(), bytes_in=bytes_in)
+
+        return proc.returncode, time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=len(cmds) or 1) as e:
+        futures = {label: e.submit(run, label, cmd, color) for (label, cmd), color in zip(cmds.items(), colors)}
+
+    return {label: future.result() for label, future in futures.items()}
+
+
+def exec_in_pods(cmds, concurrency=10, executable=None):
+    """run {podname: cmd} non-interactively, at most concurrency at a time.
+    return {podname: (returncode, output, seconds)}, output has stdout and
+    stderr combined"""
+
+    def run(cmd):
+        start = time.perf_counter()
+        res = subprocess_run(
+            cmd, executable=executable, env=ENV, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        )
+        return res.returncode, ensure_str(res.stdout), time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=max(min(concurrency, len(cmds)), 1)) as e:
+        futures = {podname: e.submit(run, cmd) for podname, cmd in cmds.items()}
+
+    return {podname: future.result() for podname, future in futures.items()}
+
+
+def group_outputs(results):
+    """group pods by identical (returncode, output), biggest group first
+    >>> group_outputs({'a': (0, 'ok', 1), 'b': (1, 'oops', 1), 'c': (0, 'ok', 2)})
+    [((0, 'ok'), ['a', 'c']), ((1, 'oops'), ['b'])]
+    """
+    groups = {}
+    for podname, (returncode, output, _) in sorted(results.items()):
+        groups.setdefault((returncode, output), []).append(podname)
+
+    return sorted(groups.items(), key=lambda kv: len(kv[1]), reverse=True)
+
+
+def set_images(client, images):
+    """patch {deployment: (container, image)} all at once, return
+    {deployment: KubeError} for those that failed"""
+    with ThreadPoolExecutor(max_workers=len(images) or 1) as e:
+        futures = {
+            name: e.submit(client.set_image, name, container, image)
+            for name, (container, image) in images.items()
+        }
+
+    failures = {}
+    for name, future in futures.items():
+        try:
+            future.result()
+        except KubeError as e:
+            failures[name] = e
+
+    return failures
+
+
+def track_rollouts(client, names, label_selector=None, deadline=300, interval=1):
+    """watch rollouts of deployments concurrently, print a progress line for a
+    deployment whenever it moves. return None if everything rolled out, or
+    (name, reason) for the first rollout that failed or stalled for more than
+    deadline seconds"""
+    changed = threading.Event()
+    informer = Informer(
+        client, 'deployments', Deployment.from_manifest, label_selector=label_selector, on_change=changed.set,
+    ).start()
+    prefixes = {
+        name: click.style(f'[{name}] ', fg=color)
+        for name, color in zip(names, cycle(['cyan', 'magenta', 'blue', 'yellow', 'green']))
+    }
+    pending = set(names)
+    last_progress = {}
+    last_moved = dict.fromkeys(names, time.monotonic())
+    try:
+        while pending:
+            changed.wait(interval)
+            changed.clear()
+            deployments = {d.name: d for d in informer.items()}
+            now = time.monotonic()
+            for name in sorted(pending):
+                deploy = deployments.get(name)
+                done = False
+                if informer.error:
+                    progress = informer.error
+                elif not informer.synced.is_set():
+                    progress = 'loading...'
+                elif not deploy:
+                    progress = 'deployment not found'
+                else:
+                    try:
+                        done, message = deploy.rollout_status()
+                    except KubeError as e:
+                        return name, e.message
+                    progress = f'{deploy.progress}, {message}'
+
+                if progress != last_progress.get(name):
+                    last_progress[name] = progress
+                    last_moved[name] = now
+                    click.echo(prefixes[name] + progress, err=True)
+
+                if done:
+                    pending.discard(name)
+                elif now - last_moved[name] > deadline:
+                    return name, f'no progress in {deadline}s, {progress}'
+    finally:
+        informer.stop()
+
+    return None
+
+
+def tell_pod_failure(pod):
+    """return the reason if any container of pod is in a doomed state
+    >>> tell_pod_failure(Pod('dummy-web-1', 'Running', {}, [{'state': {'running': {}}}]))
+    >>> tell_pod_failure(Pod('dummy-web-1', 'Running', {}, [{'state': {'waiting': {'reason': 'CrashLoopBackOff'}}}]))
+    'CrashLoopBackOff'
+    """
+    init_statuses = pod.manifest.get('status', {}).get('initContainerStatuses') or []
+    for s in [*init_statuses, *pod.container_statuses]:
+        reason = ((s.get('state') or {}).get('waiting') or {}).get('reason')
+        if reason in DOOMED_POD_STATES:
+            return reason
+
+    return None
+
+
+def watch_helm_upgrade(client, helm_args, appname, interval=1, sync_timeout=5):
+    """run helm upgrade --wait while watching the deployments and pods of the
+    app, rollout progress is printed as it moves. if a pod created during this
+    upgrade ends up in a doomed state, helm is stopped right away rather than
+    left to wait out its timeout. return (returncode, failure), failure is
+    (pod, reason) or None"""
+    selector = f'app.kubernetes.io/name={appname}'
+    changed = threading.Event()
+    deploy_informer = Informer(
+        client, 'deployments', Deployment.from_manifest, label_selector=selector, on_change=changed.set,
+    ).start()
+    pod_informer = Informer(client, 'pods', Pod.from_manifest, label_selector=selector, on_change=changed.set).start()
+
+    def tell_progress(deploy):
+        try:
+            _, message = deploy.rollout_status()
+        except KubeError as e:
+            message = e.message
+        return f'{deploy.progress}, {message}'
+
+    colors = cycle(['cyan', 'magenta', 'blue', 'yellow', 'green'])
+    prefixes = {}
+    try:
+        # pods that exist before helm runs are not ours to judge, if they
+        # cannot be told apart, don't judge at all
+        watching = pod_informer.synced.wait(sync_timeout) and deploy_informer.synced.wait(sync_timeout)
+        if not watching:
+            warn(f'cannot watch pods and deployments, will wait for helm: {pod_informer.error or deploy_informer.error}')
+        existing = {p.name for p in pod_informer.items()}
+        last_progress = {d.name: tell_progress(d) for d in deploy_informer.items()}
+        cmd = helm_cmd(*helm_args)
+        excall(cmd)
+        with span(tell_cmd_name(cmd), 'subprocess', argv=cmd) as trace_args:
+            proc = transport.popen(cmd, executable=tell_binary('helm'), env=ENV)
+            # wake up the moment helm exits
+            threading.Thread(target=lambda: (proc.wait(), changed.set()), daemon=True).start()
+            failure = None
+            while not failure and proc.poll() is None:
+                changed.wait(interval)
+                changed.clear()
+                if not watching:
+                    continue
+                for deploy in sorted(deploy_informer.items(), key=lambda d: d.name):
+                    progress = tell_progress(deploy)
+                    if progress != last_progress.get(deploy.name):
+                        last_progress[deploy.name] = progress
+                        if deploy.name not in prefixes:
+                            prefixes[deploy.name] = click.style(f'[{deploy.name}] ', fg=next(colors))
+                        click.echo(prefixes[deploy.name] + progress, err=True)
+
+                for pod in sorted(pod_informer.items(), key=lambda p: p.name):
+                    if pod.name in existing or pod.deleted:
+                        continue
+                    reason = tell_pod_failure(pod)
+                    if reason:
+                        failure = pod, reason
+                        proc.terminate()
+                        break
+
+            trace_args['returncode'] = proc.wait()
+    finally:
+        deploy_informer.stop()
+        pod_informer.stop()
+
+    return proc.returncode, failure
+
+
+def report_pod_failure(client, pod, reason, tail_lines=20):
+    """print everything we know about why pod is doomed"""
+    error(f'pod/{pod.name} is in {reason}')
+    try:
+        events = client.list_events(field_selector=f'involvedObject.name={pod.name}')
+    except KubeError as e:
+        events = []
+        warn(f'cannot get events for pod/{pod.name}: {e}')
+
+    if events:
+        echo(events_table(events), err=True)
+
+    for message in pod.container_messages:
+        echo(message, err=True)
+
+    if reason in {'CrashLoopBackOff', 'RunContainerError'}:
+        try:
+            log = client.read_pod_log(pod.name, tail_lines=tail_lines)
+        except KubeError as e:
+            log = str(e)
+        if log.strip():
+            echo(f'last {tail_lines} lines of log:', err=True)
+            click.echo(log.rstrip('\n'), err=True)
+
+
+def rollback_release(appname):
+    """undo a helm upgrade that has been stopped half way, same as what
+    --atomic does when helm times out: a failed install is uninstalled, a
+    failed upgrade is rolled back to the previous revision"""
+    res = helm('history', appname, '--max', '2', '-o', 'json', capture_output=True)
+    if res.returncode:
+        # helm was stopped before the release is even recorded
+        return None
+    revisions = sorted(json.loads(res.stdout), key=lambda r: r['revision'])
+    if not revisions or revisions[-1]['status'] not in {'pending-install', 'pending-upgrade', 'failed'}:
+        return None
+    if len(revisions) == 1:
+        return helm('uninstall', appname)
+    return helm('rollback', appname, str(revisions[-2]['revision']))
+
+
 def get_app_status(appname):
     res = helm('status', appname, '-o', 'json', capture_output=True)
     if not res.returncode:
@@ -887,10 +2324,17 @@ test:
 """
 
 
-template_env.filters['basename'] = basename
-template_env.filters['quote'] = quote
-template_env.filters['to_yaml'] = yadu
-template_env.filters['brief'] = brief
+@lru_cache(maxsize=None)
+def tell_template_env():
+    """jinja2 is only imported, and templates only compiled, by commands
+    that actually render something"""
+    from jinja2 import Environment, FileSystemLoader
+    template_env = Environment(loader=FileSystemLoader(searchpath=TEMPLATE_DIR), extensions=['jinja2.ext.loopcontrols'])
+    template_env.filters['basename'] = basename
+    template_env.filters['quote'] = quote
+    template_env.filters['to_yaml'] = yadu
+    template_env.filters['brief'] = brief
+    return template_env
 
 
 class literal(str):
@@ -898,10 +2342,44 @@ class literal(str):
 
 
 def literal_presenter(dumper, data):
-    return dumper.represent_scalar('tag:yaml.org,2002:str', data, style='|')
+    # libyaml only takes exact str, not subclasses
+    return dumper.represent_scalar('tag:yaml.org,2002:str', str(data), style='|')
 
 
-yaml.add_representer(literal, literal_presenter)
+@lru_cache(maxsize=None)
+def tell_yaml():
+    """yaml is imported on first use, `lain version` and shell completion
+    don't need it"""
+    import yaml
+    for dumper in (yaml.Dumper, getattr(yaml, 'CDumper', None)):
+        if dumper:
+            yaml.add_representer(literal, literal_presenter, Dumper=dumper)
+
+    return yaml
+
+
+def tell_yaml_loader():
+    """the libyaml loader is ~10x faster, but PyYAML may be built without it"""
+    yaml = tell_yaml()
+    return getattr(yaml, 'CFullLoader', yaml.FullLoader)
+
+
+def tell_yaml_dumper():
+    yaml = tell_yaml()
+    return getattr(yaml, 'CDumper', yaml.Dumper)
+
+
+class ClustersType(click.ParamType):
+    name = "clusters"
+
+    def convert(self, value, param, ctx):
+        if isinstance(value, (list, tuple)):
+            return value
+        clusters = [c.strip() for c in value.split(',') if c.strip()]
+        unknown = set(clusters).difference(FUTURE_CLUSTERS)
+        if not clusters or unknown:
+            self.fail(f"expected comma separated clusters from {set(FUTURE_CLUSTERS)}, got {value!r}", param, ctx)
+        return clusters
 
 
 class KVPairType(click.ParamType):
@@ -52,13 +52,17 @@ two_level_commands = [
 ]
 
 
-def main():
-    signal.signal(signal.SIGINT, exit_gracefully)
+def build_parser():
     parser = argh.ArghParser()
     parser.add_commands(one_level_commands)
     for command in two_level_commands:
         argh.add_commands(parser, command.subcommands(), namespace=command.namespace(), help=command.help_message())
-    parser.dispatch()
+    return parser
+
+
+def main():
+    signal.signal(signal.SIGINT, exit_gracefully)
+    build_parser().dispatch()
 
 
 if __name__ == "__main__":
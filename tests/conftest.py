@@ -54,7 +54,8 @@ def run_under_click_context(f, args=(), kwargs=None) -> Tuple[click.testing.Resu
     wrap the function call in a click command"""
     cache = {'func_result': None}
 
-    @lain.command()
+    # click>=8 strips the _command suffix from function names, so be explicit
+    @lain.command(name='wrapper-command')
     @click.pass_context
     def wrapper_command(ctx):
         global func_result
@@ -86,3 +87,17 @@ def dummy(request):
 def registry(request):
     cluster_info = FUTURE_CLUSTERS[TEST_CLUSTER]
     return Registry(cluster_info['registry'])
+
+
+@pytest.fixture
+def apiserver(tmp_path, monkeypatch):
+    """a fake apiserver, with ~/.kube/config pointed to it"""
+    from future_lain_cli import kube
+    from future_lain_cli.utils import yadu
+    from tests.fake_apiserver import FakeApiserver
+    with FakeApiserver() as server:
+        kubeconfig = tmp_path / 'kubeconfig-fake'
+        yadu(server.kubeconfig(), str(kubeconfig))
+        monkeypatch.setattr(kube, 'DEFAULT_KUBECONFIG', str(kubeconfig))
+        monkeypatch.setattr(kube, 'kube_clients', {})
+        yield server
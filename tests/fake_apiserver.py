@@ -0,0 +1,350 @@
+"""a fake Kubernetes apiserver, just enough to test lain's read paths without a
+real cluster"""
+import base64
+import json
+import threading
+import time
+from copy import deepcopy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+FAKE_TOKEN = 'lain-fake-token'
+
+
+def make_pod(name, phase='Running', labels=None, **status):
+    return {
+        'apiVersion': 'v1',
+        'kind': 'Pod',
+        'metadata': {
+            'name': name,
+            'namespace': 'default',
+            'labels': labels or {},
+            'resourceVersion': '1',
+            'creationTimestamp': '2019-11-22T08:39:01Z',
+        },
+        'spec': {'containers': [{'name': 'web'}], 'nodeName': 'node1'},
+        'status': {'phase': phase, 'podIP': '10.0.0.1', **status},
+    }
+
+
+def make_event(involved_name, reason, message, type_='Warning'):
+    return {
+        'apiVersion': 'v1',
+        'kind': 'Event',
+        'metadata': {'name': f'{involved_name}.{reason}', 'namespace': 'default'},
+        'involvedObject': {'kind': 'Pod', 'name': involved_name},
+        'reason': reason,
+        'message': message,
+        'type': type_,
+        'count': 1,
+        'lastTimestamp': '2019-11-22T08:39:01Z',
+    }
+
+
+def make_deployment(name, replicas=1, labels=None, image='dummy:1'):
+    container = name.rsplit('-', 1)[-1]
+    return {
+        'apiVersion': 'apps/v1',
+        'kind': 'Deployment',
+        'metadata': {'name': name, 'namespace': 'default', 'labels': labels or {}, 'generation': 1},
+        'spec': {
+            'replicas': replicas,
+            'template': {'spec': {'containers': [{'name': container, 'image': image}]}},
+        },
+        'status': {
+            'observedGeneration': 1,
+            'replicas': replicas,
+            'updatedReplicas': replicas,
+            'readyReplicas': replicas,
+            'availableReplicas': replicas,
+        },
+    }
+
+
+def strategic_merge(obj, patch):
+    """good enough for tests: dicts are merged recursively, lists of dicts are
+    merged by name"""
+    for k, v in patch.items():
+        if v is None:
+            obj.pop(k, None)
+        elif isinstance(v, dict) and isinstance(obj.get(k), dict):
+            strategic_merge(obj[k], v)
+        elif isinstance(v, dict):
+            obj[k] = strategic_merge({}, v)
+        elif isinstance(v, list) and isinstance(obj.get(k), list) and all('name' in i for i in v):
+            existing = {i['name']: i for i in obj[k]}
+            for item in v:
+                if item['name'] in existing:
+                    strategic_merge(existing[item['name']], item)
+                else:
+                    obj[k].append(item)
+        else:
+            obj[k] = v
+
+    return obj
+
+
+def match_labels(obj, selector):
+    labels = obj['metadata'].get('labels') or {}
+    for clause in filter(None, (selector or '').split(',')):
+        k, v = clause.split('=', 1)
+        if labels.get(k) != v:
+            return False
+    return True
+
+
+def dig(obj, dotted):
+    for k in dotted.split('.'):
+        obj = (obj or {}).get(k)
+    return obj
+
+
+def match_fields(obj, selector):
+    for clause in filter(None, (selector or '').split(',')):
+        if '!=' in clause:
+            k, v = clause.split('!=', 1)
+            if dig(obj, k) == v:
+                return False
+        else:
+            k, v = clause.replace('==', '=').split('=', 1)
+            if dig(obj, k) != v:
+                return False
+    return True
+
+
+class FakeApiserver:
+    """objects are stored in self.objects[resource][name], every request is
+    recorded in self.requests as (method, path). changes made through add() and
+    delete() are streamed to watchers. with auto_rollout, a deployment whose
+    spec is patched is rolled out right away, as if by a very fast controller"""
+
+    def __init__(self, auto_rollout=False):
+        self.auto_rollout = auto_rollout
+        self.objects = {'pods': {}, 'secrets': {}, 'events': {}, 'deployments': {}}
+        self.logs = {}
+        self.requests = []
+        self.resource_version = 1
+        # (resourceVersion, resource, event type, object)
+        self.history = []
+        self.changed = threading.Condition()
+        self.closing = False
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def reply(self, code, body):
+                if isinstance(body, (dict, list)):
+                    body = json.dumps(body)
+                payload = body.encode('utf-8')
+                self.send_response(code)
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def handle_any(self, method):
+                url = urlparse(self.path)
+                server.requests.append((method, url.path))
+                if self.headers.get('Authorization') != f'Bearer {FAKE_TOKEN}':
+                    return self.reply(401, {'message': 'Unauthorized'})
+                length = int(self.headers.get('Content-Length') or 0)
+                body = json.loads(self.rfile.read(length)) if length else None
+                params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+                if method == 'GET' and params.get('watch'):
+                    return server.stream_watch(self, url.path.rstrip('/').split('/')[-1], params)
+                if method == 'GET' and params.get('follow') and url.path.endswith('/log'):
+                    return server.stream_log(self, url.path.split('/')[-2], params)
+                code, res = server.route(method, url.path, params, body)
+                self.reply(code, res)
+
+            def do_GET(self):
+                self.handle_any('GET')
+
+            def do_POST(self):
+                self.handle_any('POST')
+
+            def do_PATCH(self):
+                self.handle_any('PATCH')
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.httpd.server_port}'
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        with self.changed:
+            self.closing = True
+            self.changed.notify_all()
+
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def bump(self, obj):
+        self.resource_version += 1
+        obj['metadata']['resourceVersion'] = str(self.resource_version)
+
+    def add(self, resource, obj):
+        with self.changed:
+            self.bump(obj)
+            name = obj['metadata']['name']
+            event_type = 'MODIFIED' if name in self.objects[resource] else 'ADDED'
+            self.objects[resource][name] = obj
+            self.history.append((self.resource_version, resource, event_type, deepcopy(obj)))
+            self.changed.notify_all()
+
+    def delete(self, resource, name):
+        with self.changed:
+            obj = self.objects[resource].pop(name)
+            self.bump(obj)
+            self.history.append((self.resource_version, resource, 'DELETED', deepcopy(obj)))
+            self.changed.notify_all()
+
+    def stream_watch(self, handler, resource, params):
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Transfer-Encoding', 'chunked')
+        handler.send_header('Connection', 'close')
+        handler.end_headers()
+        handler.close_connection = True
+        since = int(params.get('resourceVersion') or 0)
+        deadline = time.time() + int(params.get('timeoutSeconds') or 300)
+        while time.time() < deadline:
+            with self.changed:
+                if self.closing:
+                    break
+                events = [
+                    (rv, event_type, obj) for rv, res, event_type, obj in self.history
+                    if rv > since and res == resource
+                    and match_labels(obj, params.get('labelSelector'))
+                    and match_fields(obj, params.get('fieldSelector'))
+                ]
+                if not events:
+                    self.changed.wait(0.1)
+                    continue
+
+            for rv, event_type, obj in events:
+                line = (json.dumps({'type': event_type, 'object': obj}) + '\n').encode('utf-8')
+                try:
+                    handler.wfile.write(b'%x\r\n%s\r\n' % (len(line), line))
+                    handler.wfile.flush()
+                except OSError:
+                    return
+                since = rv
+
+        try:
+            handler.wfile.write(b'0\r\n\r\n')
+        except OSError:
+            pass
+
+    def append_log(self, name, *lines):
+        with self.changed:
+            self.logs.setdefault(name, []).extend(lines)
+            self.changed.notify_all()
+
+    def stream_log(self, handler, name, params):
+        """stream log lines of a pod until the pod is deleted"""
+        handler.send_response(200)
+        handler.send_header('Transfer-Encoding', 'chunked')
+        handler.send_header('Connection', 'close')
+        handler.end_headers()
+        handler.close_connection = True
+        with self.changed:
+            lines = self.logs.get(name, [])
+            tail = params.get('tailLines')
+            sent = max(len(lines) - int(tail), 0) if tail else 0
+
+        while True:
+            with self.changed:
+                lines = self.logs.get(name, [])
+                if sent == len(lines):
+                    if self.closing or name not in self.objects['pods']:
+                        break
+                    self.changed.wait(0.1)
+                    continue
+                new, sent = lines[sent:], len(lines)
+
+            payload = ''.join(f'{line}\n' for line in new).encode('utf-8')
+            try:
+                handler.wfile.write(b'%x\r\n%s\r\n' % (len(payload), payload))
+                handler.wfile.flush()
+            except OSError:
+                return
+
+        try:
+            handler.wfile.write(b'0\r\n\r\n')
+        except OSError:
+            pass
+
+    def add_secret(self, name, data):
+        self.add('secrets', {
+            'apiVersion': 'v1',
+            'kind': 'Secret',
+            'type': 'Opaque',
+            'metadata': {'name': name, 'namespace': 'default'},
+            'data': {k: base64.b64encode(v.encode('utf-8')).decode('utf-8') for k, v in data.items()},
+        })
+
+    def kubeconfig(self):
+        return {
+            'apiVersion': 'v1',
+            'kind': 'Config',
+            'clusters': [{'name': 'fake', 'cluster': {'server': self.url}}],
+            'contexts': [{'name': 'fake', 'context': {'cluster': 'fake', 'namespace': 'default', 'user': 'fake'}}],
+            'current-context': 'fake',
+            'users': [{'name': 'fake', 'user': {'token': FAKE_TOKEN}}],
+        }
+
+    def route(self, method, path, params, body):
+        parts = path.strip('/').split('/')
+        # /api/v1/namespaces/default/{resource}[/{name}[/log]], or
+        # /apis/{group}/{version}/namespaces/default/...
+        if 'namespaces' in parts:
+            parts = parts[parts.index('namespaces') - 2:]
+        resource = parts[4] if len(parts) > 4 else None
+        name = parts[5] if len(parts) > 5 else None
+        store = self.objects.get(resource)
+        if store is None:
+            return 404, {'message': f'{path} not found'}
+        if method == 'GET' and not name:
+            items = [
+                obj for obj in store.values()
+                if match_labels(obj, params.get('labelSelector')) and match_fields(obj, params.get('fieldSelector'))
+            ]
+            return 200, {'kind': 'List', 'metadata': {'resourceVersion': str(self.resource_version)}, 'items': items}
+        if method == 'POST' and not name:
+            name = body['metadata']['name']
+            if name in store:
+                return 409, {'message': f'{resource} "{name}" already exists'}
+            self.add(resource, body)
+            return 201, body
+        if name not in store:
+            return 404, {'message': f'{resource} "{name}" not found'}
+        if len(parts) > 6 and parts[6] == 'log':
+            lines = self.logs.get(name, [])
+            tail = int(params.get('tailLines') or len(lines))
+            return 200, ''.join(f'{line}\n' for line in lines[-tail:])
+        if method == 'GET':
+            return 200, store[name]
+        if method == 'PATCH':
+            precondition = body.get('metadata', {}).get('resourceVersion')
+            if precondition and precondition != store[name]['metadata']['resourceVersion']:
+                return 409, {'message': f'Operation cannot be fulfilled on {resource} "{name}": the object has been modified'}
+            obj = strategic_merge(deepcopy(store[name]), body)
+            if obj.get('spec') != store[name].get('spec'):
+                obj['metadata']['generation'] = obj['metadata'].get('generation', 0) + 1
+                if resource == 'deployments' and self.auto_rollout:
+                    replicas = obj['spec'].get('replicas', 1)
+                    obj['status'].update(
+                        observedGeneration=obj['metadata']['generation'], replicas=replicas,
+                        updatedReplicas=replicas, readyReplicas=replicas, availableReplicas=replicas,
+                    )
+            self.add(resource, obj)
+            return 200, obj
+        return 405, {'message': 'method not allowed'}
@@ -0,0 +1,57 @@
+"""a fake static file server, with HEAD, ETag, Range and If-Range, enough for
+download_binary"""
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeCDN:
+    """serves self.files, {path: bytes}, every request is recorded in
+    self.requests as (method, path, Range header)"""
+
+    def __init__(self, files, ranges=True):
+        self.files = files
+        self.ranges = ranges
+        self.requests = []
+        cdn = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def reply(self, send_body):
+                range_ = self.headers.get('Range')
+                cdn.requests.append((self.command, self.path, range_))
+                content = cdn.files.get(self.path)
+                if content is None:
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                etag = f'"{hashlib.md5(content).hexdigest()}"'
+                if_range = self.headers.get('If-Range')
+                status = 200
+                if cdn.ranges and range_ and if_range in {None, etag}:
+                    start, end = (int(n) for n in range_.split('=')[1].split('-'))
+                    content = content[start:end + 1]
+                    status = 206
+                self.send_response(status)
+                self.send_header('ETag', etag)
+                if cdn.ranges:
+                    self.send_header('Accept-Ranges', 'bytes')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                if send_body:
+                    self.wfile.write(content)
+
+            def do_HEAD(self):
+                self.reply(send_body=False)
+
+            def do_GET(self):
+                self.reply(send_body=True)
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.httpd.server_port}'
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
@@ -0,0 +1,55 @@
+"""a fake docker registry, just enough for Registry.tags_list and
+Registry.has_tag"""
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class FakeRegistry:
+    """serves /v2/<repo>/tags/list with n/last pagination and ETag, and HEAD
+    /v2/<repo>/manifests/<tag>, which answers manifest_status if set"""
+
+    def __init__(self, tags):
+        self.tags = sorted(tags)
+        self.requests = []
+        self.manifest_status = None
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_HEAD(self):
+                tag = urlparse(self.path).path.rsplit('/', 1)[-1]
+                self.send_response(registry.manifest_status or (200 if tag in registry.tags else 404))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+                registry.requests.append(params)
+                n = int(params.get('n', 100))
+                last = params.get('last', '')
+                page = [t for t in registry.tags if t > last][:n]
+                etag = f'"{hash((tuple(page), last))}"'
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                payload = json.dumps({'name': url.path.split('/')[2], 'tags': page}).encode('utf-8')
+                self.send_response(200)
+                self.send_header('ETag', etag)
+                if page and page[-1] != registry.tags[-1]:
+                    self.send_header('Link', f'<{url.path}?n={n}&last={page[-1]}>; rel="next"')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.host = f'127.0.0.1:{self.httpd.server_port}'
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
@@ -0,0 +1,101 @@
+from future_lain_cli import build, utils
+from future_lain_cli.build import build_images
+from tests.conftest import DUMMY_APPNAME, run_under_click_context
+from tests.fake_registry import FakeRegistry
+
+META_VERSION = '1574411941-f4fca3bd2bf90691491c2280ef399f5dfa3b4daa'
+VALUES = {
+    'appname': DUMMY_APPNAME,
+    'build': {
+        'base': 'python:3.7',
+        'prepare': {'version': 2, 'script': ['pip install -r requirements.txt']},
+        'script': ['make'],
+    },
+}
+
+
+def install_fake_docker(path):
+    """records its arguments in calls, and prints buildkit progress for the
+    target it's asked to build, every step but the last one is cached"""
+    calls = path / 'calls'
+    docker = path / 'docker'
+    docker.write_text(f'''#!/bin/sh
+echo "$@" >> {calls}
+[ "$2" = "version" ] && echo "github.com/docker/buildx v0.10.4" && exit 0
+while [ "$1" != "--target" ]; do shift; done
+target=$2
+echo "#1 [internal] load build definition from Dockerfile"
+echo "#1 DONE 0.0s"
+echo "#2 [$target 1/2] FROM docker.io/library/python:3.7"
+echo "#2 CACHED"
+echo "#3 [$target 2/2] RUN make"
+echo "#3 0.1 making $target"
+echo "#3 DONE 1.5s"
+echo "#4 exporting to image"
+echo "#4 DONE 0.2s"
+''')
+    docker.chmod(0o755)
+    return docker, calls
+
+
+def test_build_images(tmp_path, monkeypatch):
+    docker, calls = install_fake_docker(tmp_path)
+    registry = FakeRegistry([])
+    monkeypatch.setattr(build, 'DOCKER', str(docker))
+    monkeypatch.setattr(build, 'tell_meta_version', lambda: META_VERSION)
+    monkeypatch.setattr(utils, 'FUTURE_CLUSTERS', {'bei': {**utils.FUTURE_CLUSTERS['bei'], 'registry': registry.host}})
+
+    dockerfiles = []
+    original_tell_dockerfile = build.tell_dockerfile
+
+    def recording_tell_dockerfile(*args, **kwargs):
+        dockerfiles.append(original_tell_dockerfile(*args, **kwargs))
+        return dockerfiles[-1]
+
+    monkeypatch.setattr(build, 'tell_dockerfile', recording_tell_dockerfile)
+
+    def build_dummy(push):
+        ctx = utils.context()
+        ctx.obj.update(appname=DUMMY_APPNAME, values=VALUES, cluster='bei')
+        return build_images(push=push)
+
+    res, images = run_under_click_context(build_dummy, args=(True,))
+    assert res.exit_code == 0, res.output
+    assert images == {
+        'release': f'{registry.host}/{DUMMY_APPNAME}:release-{META_VERSION}',
+        'meta': f'{registry.host}/{DUMMY_APPNAME}:meta-{META_VERSION}',
+    }
+    builds = [line.split() for line in calls.read_text().splitlines() if ' build ' in line]
+    targets = [cmd[cmd.index('--target') + 1] for cmd in builds]
+    # prepare comes first, release and meta after, in whatever order
+    assert targets[0] == 'prepare' and set(targets[1:]) == {'release', 'meta'}
+    for cmd in builds:
+        assert '--push' in cmd
+        assert f'type=registry,ref={registry.host}/{DUMMY_APPNAME}:buildcache-{cmd[cmd.index("--target") + 1]},mode=max' in cmd
+    assert '[meta] #3 0.1 making meta' in res.output
+    assert 'cache hit ratio 3/6 (50%)' in res.output
+    # prepare image is already there, and no pushing this time
+    registry.tags.append('prepare-2')
+    calls.write_text('')
+    res, _ = run_under_click_context(build_dummy, args=(False,))
+    assert res.exit_code == 0, res.output
+    assert 'prepare-2 already exists' in res.output
+    builds = [line.split() for line in calls.read_text().splitlines() if ' build ' in line]
+    assert len(builds) == 2
+    assert all('--load' in cmd and '--cache-to' not in cmd for cmd in builds)
+    # a new prepare version, without --push, is built along with the rest,
+    # rather than pushed
+    registry.tags.remove('prepare-2')
+    calls.write_text('')
+    res, _ = run_under_click_context(build_dummy, args=(False,))
+    assert res.exit_code == 0, res.output
+    builds = [line.split() for line in calls.read_text().splitlines() if ' build ' in line]
+    assert {cmd[cmd.index('--target') + 1] for cmd in builds} == {'release', 'meta'}
+    assert all('--push' not in cmd and '--cache-to' not in cmd for cmd in builds)
+    assert 'FROM prepare AS build' in dockerfiles[-1]
+    # registry errors are reported, rather than a traceback
+    registry.manifest_status = 401
+    res, _ = run_under_click_context(build_dummy, args=(True,))
+    assert res.exit_code == 1
+    assert f'cannot tell if {registry.host}/{DUMMY_APPNAME}:prepare-2 exists: 401' in res.output
+    registry.httpd.shutdown()
@@ -0,0 +1,56 @@
+import os
+import stat
+
+from future_lain_cli import utils
+from future_lain_cli.lain import lain
+from future_lain_cli.utils import CHART_DIR_NAME, tell_chart_manifest_file
+from tests.conftest import run
+
+
+def install_fake_binaries(path):
+    lints = path / 'lints'
+    for name, script in {
+        'kubectl': 'echo "Client Version: v1.17.0"',
+        'helm': f'[ "$1" = "version" ] && echo "v3.0.2+g19e47ee" && exit 0\necho "$@" >> {lints}',
+    }.items():
+        binary = path / name
+        binary.write_text(f'#!/bin/sh\n{script}\n')
+        binary.chmod(binary.stat().st_mode | stat.S_IEXEC)
+
+    return lints
+
+
+def test_init_incremental(tmp_path, monkeypatch):
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    lints = install_fake_binaries(bin_dir)
+    monkeypatch.setenv('PATH', f'{bin_dir}:{os.environ["PATH"]}')
+    monkeypatch.setattr(utils, 'TOOLCHAIN_CACHE_FILE', str(tmp_path / 'toolchain.json'))
+    monkeypatch.setattr(utils, 'toolchain_memo', {})
+    monkeypatch.setattr(utils, 'LAIN_CACHE_DIR', str(tmp_path / 'cache'))
+    app_dir = tmp_path / 'dummy'
+    app_dir.mkdir()
+    monkeypatch.chdir(app_dir)
+    run(lain, args=['init'])
+    assert lints.read_text().count('lint') == 1
+    deployment = app_dir / CHART_DIR_NAME / 'templates' / 'deployment.yaml'
+    mtime = deployment.stat().st_mtime_ns
+    # nothing changed, nothing written, lint skipped
+    res = run(lain, args=['init', '--template-only'])
+    assert 'already up to date' in res.output
+    assert lints.read_text().count('lint') == 1
+    assert deployment.stat().st_mtime_ns == mtime
+    # values changed, lint again
+    values = app_dir / CHART_DIR_NAME / 'values.yaml'
+    values.write_text(values.read_text() + '\n# changed\n')
+    run(lain, args=['init', '--template-only'])
+    assert lints.read_text().count('lint') == 2
+    # a template edited by hand is restored to what was already linted
+    deployment.write_text('oops')
+    run(lain, args=['init', '--template-only'])
+    assert lints.read_text().count('lint') == 2
+    assert deployment.read_text() != 'oops'
+    # the manifest lives in the cache, not in the chart that gets committed
+    assert tell_chart_manifest_file().startswith(str(tmp_path / 'cache'))
+    assert os.path.exists(tell_chart_manifest_file())
+    assert not any(f.name.startswith('.') for f in (app_dir / CHART_DIR_NAME).iterdir())
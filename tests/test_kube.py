@@ -0,0 +1,274 @@
+import base64
+import threading
+import time
+from copy import deepcopy
+
+import pytest
+
+from future_lain_cli import utils
+from future_lain_cli.kube import (Informer, KubeClient, KubeError, Pod,
+                                  pods_table, tell_kube_client)
+from future_lain_cli.utils import (edit_secret, import_secret, pick_pod,
+                                   rollback_release, set_images, tell_secret,
+                                   track_rollouts, watch_helm_upgrade, yadu,
+                                   yalo)
+from tests.conftest import DUMMY_APPNAME, run_under_click_context
+from tests.fake_apiserver import make_deployment, make_event, make_pod
+
+WEB_LABELS = {
+    'app.kubernetes.io/name': DUMMY_APPNAME,
+    'app.kubernetes.io/instance': f'{DUMMY_APPNAME}-web',
+}
+WORKER_LABELS = {
+    'app.kubernetes.io/name': DUMMY_APPNAME,
+    'app.kubernetes.io/instance': f'{DUMMY_APPNAME}-worker',
+}
+
+
+def test_kube_client(apiserver):
+    apiserver.add('pods', make_pod('dummy-web-1', labels=WEB_LABELS))
+    apiserver.add('pods', make_pod('dummy-worker-1', phase='Pending', labels=WORKER_LABELS))
+    apiserver.add('events', make_event('dummy-worker-1', 'FailedScheduling', '0/3 nodes are available'))
+    client = tell_kube_client()
+    pods = client.list_pods(label_selector=f'app.kubernetes.io/name={DUMMY_APPNAME}')
+    assert {p.name for p in pods} == {'dummy-web-1', 'dummy-worker-1'}
+    pending = client.list_pods(field_selector='status.phase=Pending')
+    assert [p.name for p in pending] == ['dummy-worker-1']
+    assert 'dummy-worker-1   0/1     Pending' in pods_table(pending)
+    events = client.list_events(field_selector='involvedObject.name=dummy-worker-1')
+    assert events[0].reason == 'FailedScheduling'
+    assert client.read_secret('nope') is None
+    with pytest.raises(KubeError):
+        client.get('/api/v1/namespaces/default/nothing')
+
+    # one client, one pooled session
+    assert tell_kube_client() is client
+
+
+def test_read_paths(apiserver):
+    apiserver.add('pods', make_pod('dummy-web-1', labels=WEB_LABELS))
+    apiserver.add('pods', make_pod('dummy-worker-1', labels=WORKER_LABELS))
+
+    def read_paths():
+        from future_lain_cli.utils import context
+        context().obj['appname'] = DUMMY_APPNAME
+        secret_dic = tell_secret(f'{DUMMY_APPNAME}-secret', init='secret')
+        return pick_pod(deploy_name='worker'), secret_dic
+
+    _, (podname, secret_dic) = run_under_click_context(read_paths)
+    assert podname == 'dummy-worker-1'
+    # secret didn't exist, tell_secret should create one with example content
+    assert secret_dic['data'] == {'topsecret.txt': 'I\nAM\nBATMAN'}
+    assert 'resourceVersion' not in secret_dic['metadata']
+    assert ('POST', '/api/v1/namespaces/default/secrets') in apiserver.requests
+
+
+def test_informer(apiserver):
+    apiserver.add('pods', make_pod('dummy-web-1', labels=WEB_LABELS))
+    apiserver.add('pods', make_pod('other-web-1'))
+    changed = threading.Event()
+    informer = Informer(
+        tell_kube_client(), 'pods', Pod.from_manifest,
+        label_selector=f'app.kubernetes.io/name={DUMMY_APPNAME}',
+        on_change=changed.set,
+    ).start()
+    assert informer.synced.wait(5)
+    assert [p.name for p in informer.items()] == ['dummy-web-1']
+    list_requests = len(apiserver.requests)
+
+    def wait_for(condition):
+        for _ in range(50):
+            changed.wait(0.1)
+            changed.clear()
+            if condition():
+                return True
+
+    apiserver.add('pods', make_pod('dummy-web-2', phase='Pending', labels=WEB_LABELS))
+    assert wait_for(lambda: {p.name for p in informer.items()} == {'dummy-web-1', 'dummy-web-2'})
+    apiserver.delete('pods', 'dummy-web-1')
+    assert wait_for(lambda: [p.name for p in informer.items()] == ['dummy-web-2'])
+    # changes arrive through the watch, no more list requests
+    assert len(apiserver.requests) == list_requests + 1
+    informer.stop()
+
+
+def test_update_image_rollouts(apiserver):
+    labels = {'app.kubernetes.io/name': DUMMY_APPNAME}
+    for name in ['dummy-web', 'dummy-worker']:
+        apiserver.add('deployments', make_deployment(name, replicas=2, labels=labels))
+
+    client = tell_kube_client()
+    images = {'dummy-web': ('web', 'dummy:2'), 'dummy-worker': ('worker', 'dummy:2'), 'dummy-ghost': ('ghost', 'dummy:2')}
+    failures = set_images(client, images)
+    assert set(failures) == {'dummy-ghost'}
+    assert failures['dummy-ghost'].status_code == 404
+    # a container that isn't there must not be added to the deployment
+    with pytest.raises(KubeError) as e:
+        client.set_image('dummy-web', 'ghost', 'dummy:2')
+
+    assert e.value.status_code == 422
+    web = apiserver.objects['deployments']['dummy-web']
+    assert web['spec']['template']['spec']['containers'] == [{'name': 'web', 'image': 'dummy:2'}]
+    assert web['metadata']['generation'] == 2
+
+    def roll(name, stall=False):
+        """play the deployment controller, worker gets stuck half way"""
+        for updated in range(3):
+            if stall and updated == 2:
+                return
+            obj = deepcopy(apiserver.objects['deployments'][name])
+            obj['status'].update(observedGeneration=2, replicas=2, updatedReplicas=updated, availableReplicas=updated)
+            apiserver.add('deployments', obj)
+            time.sleep(0.05)
+
+    threads = [threading.Thread(target=roll, args=('dummy-web',)), threading.Thread(target=roll, args=('dummy-worker', True))]
+    for thread in threads:
+        thread.start()
+
+    start = time.perf_counter()
+    failure = track_rollouts(client, ['dummy-web', 'dummy-worker'], deadline=0.5, interval=0.1)
+    assert failure[0] == 'dummy-worker'
+    assert 'no progress in 0.5s' in failure[1]
+    assert time.perf_counter() - start < 3
+    # once the worker catches up, everything is rolled out
+    roll('dummy-worker')
+    assert track_rollouts(client, ['dummy-web', 'dummy-worker'], deadline=1, interval=0.1) is None
+
+
+def test_edit_secret(apiserver, monkeypatch):
+    certificate = 'CERTIFICATE\n' * 1000
+    apiserver.add_secret(f'{DUMMY_APPNAME}-secret', {'tls.crt': certificate, 'config.json': '{}', 'old.txt': 'bye'})
+    patches = []
+    original_patch = KubeClient.patch
+
+    def recording_patch(self, resource, name, patch):
+        patches.append(patch)
+        return original_patch(self, resource, name, patch)
+
+    monkeypatch.setattr(KubeClient, 'patch', recording_patch)
+
+    def fake_editor(f):
+        dic = yalo(f)
+        dic['data']['config.json'] = '{"debug": false}'
+        del dic['data']['old.txt']
+        yadu(dic, f.name)
+
+    monkeypatch.setattr(utils, 'edit_file', fake_editor)
+    res, _ = run_under_click_context(edit_secret, args=[f'{DUMMY_APPNAME}-secret'], kwargs={'init': 'secret'})
+    assert res.exit_code == 0, res.output
+    # only changed keys are sent, with the resourceVersion as precondition
+    assert patches[0]['data'] == {'config.json': 'eyJkZWJ1ZyI6IGZhbHNlfQ==', 'old.txt': None}
+    assert patches[0]['metadata']['resourceVersion']
+    stored = apiserver.objects['secrets'][f'{DUMMY_APPNAME}-secret']['data']
+    assert set(stored) == {'tls.crt', 'config.json'}
+    assert base64.b64decode(stored['tls.crt']).decode('utf-8') == certificate
+
+    def racing_editor(f):
+        # someone else writes while we're still editing
+        apiserver.add_secret(f'{DUMMY_APPNAME}-secret', {'config.json': '{"theirs": true}'})
+        dic = yalo(f)
+        dic['data']['config.json'] = '{"mine": true}'
+        yadu(dic, f.name)
+
+    monkeypatch.setattr(utils, 'edit_file', racing_editor)
+    res, _ = run_under_click_context(edit_secret, args=[f'{DUMMY_APPNAME}-secret'], kwargs={'init': 'secret'})
+    assert res.exit_code == 1
+    assert 'changed by someone else' in res.output
+    stored = apiserver.objects['secrets'][f'{DUMMY_APPNAME}-secret']['data']
+    assert base64.b64decode(stored['config.json']) == b'{"theirs": true}'
+
+
+def test_import_secret(apiserver):
+    env_name = f'{DUMMY_APPNAME}-env'
+    res, diff = run_under_click_context(import_secret, args=[env_name, {'A': '1', 'B': '2'}])
+    assert res.exit_code == 0, res.output
+    assert diff == (['A', 'B'], [], [])
+    assert ('POST', '/api/v1/namespaces/default/secrets') in apiserver.requests
+
+    apiserver.requests.clear()
+    data = {'B': '3', 'C': 'multi\nline'}
+    res, diff = run_under_click_context(import_secret, args=[env_name, data], kwargs={'dry_run': True})
+    assert diff == (['C'], ['B'], [])
+    assert [m for m, _ in apiserver.requests] == ['GET']
+
+    apiserver.requests.clear()
+    res, diff = run_under_click_context(import_secret, args=[env_name, data], kwargs={'prune': True})
+    assert diff == (['C'], ['B'], ['A'])
+    # one read, one write
+    assert [m for m, _ in apiserver.requests] == ['GET', 'PATCH']
+    stored = apiserver.objects['secrets'][env_name]['data']
+    assert {k: base64.b64decode(v).decode('utf-8') for k, v in stored.items()} == data
+
+
+def install_fake_helm(path):
+    """records its arguments in calls, helm upgrade hangs like --wait"""
+    calls = path / 'calls'
+    helm = path / 'helm'
+    helm.write_text(f'''#!/bin/sh
+echo "$@" >> {calls}
+case "$*" in
+  *history*) echo '[{{"revision": 1, "status": "superseded"}}, {{"revision": 2, "status": "pending-upgrade"}}]';;
+  *upgrade*) exec sleep ${{HELM_SLEEP:-30}};;
+esac
+''')
+    helm.chmod(0o755)
+    return helm, calls
+
+
+def test_watch_helm_upgrade(apiserver, tmp_path, monkeypatch):
+    helm, calls = install_fake_helm(tmp_path)
+    monkeypatch.setattr(utils, 'tell_binary', lambda name: str(helm))
+    crashing = {'state': {'waiting': {'reason': 'CrashLoopBackOff'}}}
+    # a pod from the previous release is none of this deploy's business
+    apiserver.add('pods', make_pod('dummy-web-old', labels=WEB_LABELS, containerStatuses=[crashing]))
+    apiserver.add('deployments', make_deployment('dummy-web', labels=WEB_LABELS))
+    client = tell_kube_client()
+
+    def create_doomed_pod():
+        time.sleep(0.3)
+        pulling = {'state': {'waiting': {'reason': 'ImagePullBackOff', 'message': 'image not found'}}}
+        apiserver.add('pods', make_pod('dummy-web-new', phase='Pending', labels=WEB_LABELS, containerStatuses=[pulling]))
+
+    threading.Thread(target=create_doomed_pod).start()
+    start = time.perf_counter()
+    returncode, failure = watch_helm_upgrade(client, ['upgrade', 'dummy', './chart'], DUMMY_APPNAME, interval=0.1)
+    assert time.perf_counter() - start < 5
+    assert returncode != 0
+    pod, reason = failure
+    assert (pod.name, reason) == ('dummy-web-new', 'ImagePullBackOff')
+    rollback_release(DUMMY_APPNAME)
+    assert calls.read_text().splitlines()[-1].endswith('rollback dummy 1')
+
+    apiserver.delete('pods', 'dummy-web-new')
+    monkeypatch.setenv('HELM_SLEEP', '0.2')
+    assert watch_helm_upgrade(client, ['upgrade', 'dummy', './chart'], DUMMY_APPNAME, interval=0.1) == (0, None)
+
+
+def test_pod_events(apiserver):
+    from future_lain_cli.app_status import PodEvents, events_text
+    apiserver.add('pods', make_pod('dummy-web-1', phase='Pending', labels=WEB_LABELS))
+    apiserver.add('events', make_event('dummy-web-1', 'FailedScheduling', 'no nodes available'))
+    apiserver.add('events', make_event('dummy-web-2', 'Pulled', 'image pulled'))
+    apiserver.add('events', make_event('other-web-1', 'BackOff', 'someone else\'s problem'))
+    client = tell_kube_client()
+    pod_informer = Informer(client, 'pods', Pod.from_manifest, label_selector=f'app.kubernetes.io/name={DUMMY_APPNAME}').start()
+    assert pod_informer.synced.wait(5)
+    pod_events = PodEvents(client)
+    informer = pod_events.informer_for('dummy-web-1')
+    assert informer.synced.wait(5)
+    # only events of the pod being shown are ever listed or watched
+    assert [e.object_name for e in informer.items()] == ['dummy-web-1']
+    assert 'no nodes available' in events_text(pod_informer, pod_events, read_log=None)
+    # same pod, same watch
+    assert pod_events.informer_for('dummy-web-1') is informer
+    apiserver.add('pods', make_pod('dummy-web-2', phase='Pending', labels=WEB_LABELS))
+    for _ in range(50):
+        if len(pod_informer.items()) == 2:
+            break
+        time.sleep(0.1)
+    events_text(pod_informer, pod_events, read_log=None)
+    assert informer.stopped.is_set()
+    assert pod_events.informer.synced.wait(5)
+    assert [e.object_name for e in pod_events.informer.items()] == ['dummy-web-2']
+    pod_informer.stop()
+    pod_events.stop()
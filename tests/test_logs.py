@@ -0,0 +1,90 @@
+import json
+import threading
+import time
+
+import click
+
+from future_lain_cli.kube import tell_kube_client
+from future_lain_cli.logs import LogFilter, LogStreamer, RateLimiter
+from tests.conftest import DUMMY_APPNAME
+from tests.fake_apiserver import make_pod
+
+LABELS = {'app.kubernetes.io/name': DUMMY_APPNAME}
+
+
+def wait_for(condition):
+    for _ in range(50):
+        if condition():
+            return True
+        time.sleep(0.1)
+
+
+def test_log_streamer(apiserver):
+    # more than the 8 streams kubectl logs -f -l can handle
+    for i in range(10):
+        apiserver.add('pods', make_pod(f'dummy-web-{i}', labels=LABELS))
+        apiserver.append_log(f'dummy-web-{i}', *[f'old line {n}' for n in range(5)])
+
+    apiserver.add('pods', make_pod('dummy-web-pending', phase='Pending', labels=LABELS))
+    streamer = LogStreamer(
+        tell_kube_client(), f'app.kubernetes.io/name={DUMMY_APPNAME}', tail_lines=2, buffer_size=4, batch=2,
+    ).start()
+    lines = []
+    thread = threading.Thread(target=streamer.run, args=(lambda s: lines.append(click.unstyle(s)),), daemon=True)
+    thread.start()
+
+    assert wait_for(lambda: len(lines) == 20)
+    assert '[dummy-web-0] old line 3' in lines
+    assert '[dummy-web-0] old line 2' not in lines
+    for i in range(10):
+        apiserver.append_log(f'dummy-web-{i}', 'new line')
+
+    assert wait_for(lambda: len(lines) == 30)
+    # a pod created during rollout is picked up, and shown from its first line
+    apiserver.add('pods', make_pod('dummy-web-10', labels=LABELS))
+    apiserver.append_log('dummy-web-10', *[f'fresh {n}' for n in range(20)])
+    assert wait_for(lambda: '[dummy-web-10] fresh 19' in lines)
+    fresh = [line for line in lines if line.startswith('[dummy-web-10]')]
+    # order within a stream is preserved, even with tiny buffers
+    assert fresh == [f'[dummy-web-10] fresh {n}' for n in range(20)]
+    assert not any('pending' in line for line in lines)
+    # deleted pods end their streams
+    apiserver.delete('pods', 'dummy-web-0')
+    assert wait_for(lambda: all(key[0] != 'dummy-web-0' for key in streamer.streams))
+    streamer.stop()
+    thread.join(2)
+    assert not thread.is_alive()
+
+
+def test_log_filters(apiserver):
+    apiserver.add('pods', make_pod('dummy-web-0', labels=LABELS))
+    apiserver.append_log('dummy-web-0', *[
+        json.dumps({'level': 'error' if n % 2 else 'info', 'path': f'/api/{n % 3}', 'n': n}) for n in range(60)
+    ])
+    apiserver.append_log('dummy-web-0', 'Traceback (most recent call last):', 'INFO plain text')
+    log_filter = LogFilter(fields=[('path', '/api/1')], level='error')
+    streamer = LogStreamer(
+        tell_kube_client(), f'app.kubernetes.io/name={DUMMY_APPNAME}', log_filter=log_filter, sample=2,
+    ).start()
+    lines = []
+    thread = threading.Thread(target=streamer.run, args=(lambda s: lines.append(click.unstyle(s)),), daemon=True)
+    thread.start()
+    # odd n with n % 3 == 1: 1, 7, 13, ..., 55, that's 10 lines, sampled to 5
+    assert wait_for(lambda: len(lines) == 5)
+    assert [json.loads(line.split(' ', 1)[1])['n'] for line in lines] == [1, 13, 25, 37, 49]
+    stream = next(iter(streamer.streams.values()))
+    assert wait_for(lambda: stream.seen == 62)
+    assert stream.matched == 10
+    streamer.stop()
+    summary = streamer.summarize()
+    assert summary.splitlines()[0].split() == ['POD', 'MATCHED/S', 'MATCHED', 'LINES/S', 'LINES']
+    assert summary.splitlines()[1].split()[::2] == ['dummy-web-0', '10', '62']
+
+
+def test_rate_limiter():
+    now = [0]
+    limiter = RateLimiter(10, clock=lambda: now[0])
+    assert sum(limiter.allow() for _ in range(100)) == 10
+    assert limiter.dropped == 90
+    now[0] += 0.5
+    assert sum(limiter.allow() for _ in range(100)) == 5
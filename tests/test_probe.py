@@ -0,0 +1,59 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from future_lain_cli.probe import IngressProber
+from future_lain_cli.trace import start_tracing, stop_tracing
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        code = 503 if self.path == '/down' else 200
+        payload = b'hello'
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def test_ingress_prober():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    base = f'http://127.0.0.1:{httpd.server_port}'
+    urls = [f'{base}/', f'{base}/down']
+    probed = threading.Semaphore(0)
+    prober = IngressProber(urls, interval=0.01, on_change=probed.release).start()
+    for _ in range(10):
+        assert probed.acquire(timeout=5)
+
+    prober.stop()
+    httpd.shutdown()
+    up, down = prober.reports()
+    assert up['status'] == 200 and up['error_rate'] == 0
+    assert up['p50'] <= up['p95'] <= up['p99']
+    assert down['status'] == 503 and down['error_rate'] == 100
+    # both urls share one pooled session
+    assert len(prober.sessions) == 1
+
+
+def test_ingress_prober_trace(tmp_path):
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    base = f'http://127.0.0.1:{httpd.server_port}'
+    out = tmp_path / 'trace.json'
+    start_tracing('lain status', argv=['lain', 'status'])
+    prober = IngressProber([f'{base}/down', 'http://127.0.0.1:1/'])
+    assert prober.probe(f'{base}/down').status == 503
+    assert not prober.probe('http://127.0.0.1:1/').ok
+    stop_tracing(str(out))
+    httpd.shutdown()
+    events = json.loads(out.read_text())['traceEvents']
+    spans = {e['args']['url']: e for e in events if e['ph'] == 'X' and e.get('cat') == 'http'}
+    assert spans[f'{base}/down']['args']['status'] == 503
+    assert spans[f'{base}/down']['args']['bytes_in'] == 5
+    assert 'ConnectionError' in spans['http://127.0.0.1:1/']['args']['error']
@@ -0,0 +1,55 @@
+from future_lain_cli import utils
+from future_lain_cli.utils import Registry
+from tests.conftest import DUMMY_APPNAME
+from tests.fake_registry import FakeRegistry
+
+
+def test_tags_list(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, 'LAIN_CACHE_DIR', str(tmp_path))
+    monkeypatch.setattr(Registry, 'page_size', 2)
+    fake = FakeRegistry(['latest', 'release-1500000000-a', 'release-1550000000-b', 'release-1600000000-c', 'meta-1600000000-c'])
+    registry = Registry(fake.host)
+    # latest first, legacy stuff filtered out
+    assert registry.tags_list(DUMMY_APPNAME) == ['release-1600000000-c', 'release-1550000000-b', 'release-1500000000-a']
+    assert len(fake.requests) == 3
+    # nothing changed, a single request for tags after the latest one
+    fake.requests.clear()
+    assert registry.tags_list(DUMMY_APPNAME)[0] == 'release-1600000000-c'
+    assert fake.requests == [{'n': '2', 'last': 'release-1600000000-c'}]
+    fake.requests.clear()
+    sent = []
+    original_get = registry.get
+
+    def recording_get(*args, **kwargs):
+        res = original_get(*args, **kwargs)
+        sent.append(res.status_code)
+        return res
+
+    monkeypatch.setattr(registry, 'get', recording_get)
+    assert registry.tags_list(DUMMY_APPNAME)[0] == 'release-1600000000-c'
+    assert sent == [304]
+    # only new tags are fetched
+    fake.tags.append('release-1700000000-d')
+    fake.requests.clear()
+    assert registry.tags_list(DUMMY_APPNAME)[:2] == ['release-1700000000-d', 'release-1600000000-c']
+    assert fake.requests == [{'n': '2', 'last': 'release-1600000000-c'}]
+    fake.httpd.shutdown()
+
+
+def test_tags_list_non_release_tags(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, 'LAIN_CACHE_DIR', str(tmp_path))
+    monkeypatch.setattr(Registry, 'page_size', 2)
+    # sorts after every release tag
+    fake = FakeRegistry(['release-1500000000-a', 'stable'])
+    registry = Registry(fake.host)
+    assert registry.tags_list(DUMMY_APPNAME) == ['release-1500000000-a']
+    fake.tags = sorted([*fake.tags, 'release-1600000000-b'])
+    fake.requests.clear()
+    assert registry.tags_list(DUMMY_APPNAME) == ['release-1600000000-b', 'release-1500000000-a']
+    assert fake.requests == [{'n': '2', 'last': 'release-1500000000-a'}]
+    # deleted tags are pruned once the index expires
+    fake.tags.remove('release-1600000000-b')
+    assert registry.tags_list(DUMMY_APPNAME)[0] == 'release-1600000000-b'
+    monkeypatch.setattr(Registry, 'index_ttl', -1)
+    assert registry.tags_list(DUMMY_APPNAME) == ['release-1500000000-a']
+    fake.httpd.shutdown()
@@ -0,0 +1,11 @@
+import subprocess
+import sys
+
+HEAVY_MODULES = ('prompt_toolkit', 'jinja2', 'requests', 'yaml', 'humanfriendly')
+
+
+def test_lazy_imports():
+    """heavy modules should only be imported by the commands that need them"""
+    code = f'import sys, future_lain_cli.lain; print(*[m for m in {HEAVY_MODULES!r} if m in sys.modules])'
+    res = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+    assert not res.stdout.strip()
@@ -0,0 +1,56 @@
+import json
+import threading
+
+from future_lain_cli import trace
+from future_lain_cli.kube import tell_kube_client
+from future_lain_cli.lain import lain
+from future_lain_cli.trace import span, start_tracing, stop_tracing
+from future_lain_cli.utils import run_dag, subprocess_run
+from tests.conftest import run
+
+
+def test_trace(apiserver, tmp_path):
+    out = tmp_path / 'trace.json'
+    start_tracing('lain deploy', argv=['lain', 'deploy'])
+    subprocess_run(['sh', '-c', 'printf hello; exit 3'], input=b'hi', capture_output=True)
+    client = tell_kube_client()
+    client.list_pods()
+    # only the headers of a streamed response are in when its span ends
+    client.get(client.namespaced('deployments'), stream=True).close()
+    run_dag({'status': (lambda: None, ()), 'meta': (lambda: None, ())})
+    stop_tracing(str(out))
+    assert trace.tracer is None
+    events = json.loads(out.read_text())['traceEvents']
+    spans = {e['name']: e for e in events if e['ph'] == 'X'}
+    root = spans['lain deploy']
+    sh = spans['sh']
+    assert sh['args']['argv'] == ['sh', '-c', 'printf hello; exit 3']
+    assert (sh['args']['returncode'], sh['args']['bytes_in'], sh['args']['bytes_out']) == (3, 5, 2)
+    # spans fall within the command
+    assert root['ts'] <= sh['ts'] and sh['ts'] + sh['dur'] <= root['dur']
+    pods = spans['GET /api/v1/namespaces/default/pods']
+    assert pods['cat'] == 'http' and pods['args']['status'] == 200
+    assert pods['args']['bytes_in'] > 0
+    deployments = spans['GET /apis/apps/v1/namespaces/default/deployments']
+    assert isinstance(deployments['args']['bytes_in'], int)
+    # dag steps run in their own threads, which are named in metadata
+    assert spans['meta']['cat'] == 'step'
+    threads = {e['tid']: e['args']['name'] for e in events if e['ph'] == 'M'}
+    assert threads[threading.main_thread().ident] == 'MainThread'
+    assert spans['meta']['tid'] in threads
+
+
+def test_trace_disabled():
+    assert trace.tracer is None
+    with span('sh', 'subprocess') as args:
+        args['returncode'] = 0
+
+
+def test_trace_option(tmp_path):
+    out = tmp_path / 'trace.json'
+    run(lain, args=['--trace', str(out), 'version'])
+    events = json.loads(out.read_text())['traceEvents']
+    assert 'lain version' in {e['name'] for e in events}
+    out.unlink()
+    run(lain, args=['version'], env={'LAIN_TRACE': str(out)})
+    assert out.exists()
@@ -0,0 +1,107 @@
+import base64
+import json
+
+import pytest
+
+from future_lain_cli import kube, transport, utils
+from future_lain_cli.kube import KubeError, tell_kube_client
+from future_lain_cli.lain import lain
+from future_lain_cli.transport import (CassetteMiss, RecordingTransport,
+                                       ReplayingTransport, stop_transport,
+                                       use_transport)
+from future_lain_cli.utils import Registry, run_concurrently, subprocess_run
+from tests.conftest import DUMMY_APPNAME, run, run_under_click_context
+from tests.fake_apiserver import make_pod
+from tests.fake_registry import FakeRegistry
+
+TAGS = ['release-1500000000-a', 'release-1600000000-c']
+
+
+def session(registry_host):
+    """the calls a typical lain command makes, through every kind of transport"""
+    res = subprocess_run(['sh', '-c', 'printf hello; printf oops >&2; exit 3'], capture_output=True)
+    outcomes = run_concurrently({'a': ['sh', '-c', 'echo from a'], 'b': ['sh', '-c', 'exit 2']})
+    pods = [pod.name for pod in tell_kube_client().list_pods()]
+    tags = Registry(registry_host).tags_list(DUMMY_APPNAME)
+    return (res.returncode, res.stdout, res.stderr), {k: v[0] for k, v in outcomes.items()}, pods, tags
+
+
+@pytest.mark.parametrize('cassette_name', ['session.json', 'session.json.gz'])
+def test_record_replay(apiserver, tmp_path, monkeypatch, capfd, cassette_name):
+    cassette = str(tmp_path / cassette_name)
+    apiserver.add('pods', make_pod('dummy-web-7557696ddf-52cc6'))
+    registry = FakeRegistry(TAGS)
+    monkeypatch.setattr(utils, 'LAIN_CACHE_DIR', str(tmp_path / 'cache-record'))
+    use_transport(RecordingTransport(cassette))
+    recorded = session(registry.host)
+    stop_transport()
+    assert recorded == ((3, b'hello', b'oops'), {'a': 0, 'b': 2}, ['dummy-web-7557696ddf-52cc6'], TAGS[::-1])
+    assert 'from a' in capfd.readouterr().err
+    # nothing out there anymore, the cassette has it all
+    registry.httpd.shutdown()
+    apiserver.objects['pods'].clear()
+    requests_made = len(apiserver.requests)
+    monkeypatch.setattr(utils, 'LAIN_CACHE_DIR', str(tmp_path / 'cache-replay'))
+    monkeypatch.setattr(kube, 'kube_clients', {})
+    use_transport(ReplayingTransport(cassette))
+    try:
+        assert session(registry.host) == recorded
+    finally:
+        stop_transport()
+
+    assert len(apiserver.requests) == requests_made
+    assert 'from a' in capfd.readouterr().err
+
+
+def test_cassette_miss(apiserver, tmp_path):
+    cassette = tmp_path / 'empty.json'
+    cassette.write_text(json.dumps({'version': 1, 'calls': []}))
+    use_transport(ReplayingTransport(str(cassette)))
+    try:
+        res, _ = run_under_click_context(subprocess_run, args=(['helm', 'status', DUMMY_APPNAME],))
+        assert res.exit_code == 1
+        assert 'not in the cassette: helm status dummy' in res.output
+        with pytest.raises(KubeError, match='not in the cassette: GET /api/v1/namespaces/default/pods'):
+            tell_kube_client().list_pods()
+        with pytest.raises(CassetteMiss):
+            transport.run(['true'])
+        # nothing is actually run, so binaries needn't be installed
+        assert utils.tell_binary('kubectl') == 'kubectl'
+    finally:
+        stop_transport()
+
+
+def test_record_replay_options(tmp_path):
+    cassette = tmp_path / 'version.json'
+    run(lain, args=['--record', str(cassette), 'version'])
+    assert json.loads(cassette.read_text())['version'] == 1
+    assert not transport.is_offline()
+    res = run(lain, args=['--record', str(cassette), '--replay', str(cassette), 'version'], returncode=1)
+    assert 'at the same time' in res.output
+
+
+def test_record_redacts_secrets(apiserver, tmp_path, capsys):
+    cassette = tmp_path / 'secret.json'
+    apiserver.add_secret(f'{DUMMY_APPNAME}-env', {'PASSWORD': 'hunter2'})
+    kubectl_output = tmp_path / 'kubectl-output.json'
+    kubectl_output.write_text(json.dumps({'kind': 'Secret', 'metadata': {'name': 'x'}, 'stringData': {'PASSWORD': 'hunter2'}}))
+    use_transport(RecordingTransport(str(cassette)))
+    try:
+        secret = tell_kube_client().read_secret(f'{DUMMY_APPNAME}-env')
+        res = subprocess_run(['cat', str(kubectl_output)], capture_output=True)
+    finally:
+        stop_transport()
+
+    # the real thing is untouched, only the cassette is redacted
+    assert secret.decoded() == {'PASSWORD': 'hunter2'}
+    assert b'hunter2' in res.stdout
+    content = cassette.read_text()
+    assert 'hunter2' not in content
+    assert base64.b64encode(b'hunter2').decode('utf-8') not in content
+    assert 'with their data redacted' in capsys.readouterr().err
+    # and can still be replayed
+    use_transport(ReplayingTransport(str(cassette)))
+    try:
+        assert tell_kube_client().read_secret(f'{DUMMY_APPNAME}-env').decoded() == {'PASSWORD': 'redacted'}
+    finally:
+        stop_transport()
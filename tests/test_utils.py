@@ -1,7 +1,26 @@
+import hashlib
+import json
+import os
+import signal
+import stat
+import subprocess
+import sys
+import threading
+import time
 from tempfile import NamedTemporaryFile
+from types import SimpleNamespace
 
-from future_lain_cli.utils import subprocess_run, tell_cluster, yadu, yalo
+import pytest
+
+from future_lain_cli import utils
+from future_lain_cli.utils import (CHART_DIR_NAME, download_binary,
+                                   exec_in_pods, explain_values, file_lock,
+                                   group_outputs, legacy_lain, literal,
+                                   resolve_helm_values, run_concurrently,
+                                   run_dag, subprocess_run, tell_binary,
+                                   tell_cluster, tell_meta_version, yadu, yalo)
 from tests.conftest import TEST_CLUSTER, run_under_click_context
+from tests.fake_cdn import FakeCDN
 
 BULLSHIT = '人民有信仰民族有希望国家有力量'
 
@@ -29,3 +48,353 @@ def test_tell_cluster(dummy):
     cmd_result, func_result = run_under_click_context(tell_cluster)
     assert func_result == TEST_CLUSTER
 
+
+def test_tell_binary(tmp_path, monkeypatch):
+    fake_kubectl = tmp_path / 'kubectl'
+    probes = tmp_path / 'probes'
+    fake_kubectl.write_text(f'''#!/bin/sh
+echo probed >> {probes}
+echo "Client Version: v1.17.0"
+''')
+    fake_kubectl.chmod(fake_kubectl.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv('PATH', f'{tmp_path}:{os.environ["PATH"]}')
+    monkeypatch.setattr(utils, 'TOOLCHAIN_CACHE_FILE', str(tmp_path / 'toolchain.json'))
+    monkeypatch.setattr(utils, 'toolchain_memo', {})
+    assert tell_binary('kubectl') == str(fake_kubectl)
+    # new process, same binary: answered by the on-disk cache
+    utils.toolchain_memo.clear()
+    assert tell_binary('kubectl') == str(fake_kubectl)
+    assert probes.read_text().count('probed') == 1
+    # binary replaced in place, should probe again
+    fake_kubectl.write_text(fake_kubectl.read_text() + '\n')
+    os.utime(fake_kubectl, ns=(0, 0))
+    assert tell_binary('kubectl') == str(fake_kubectl)
+    assert probes.read_text().count('probed') == 2
+
+
+def test_download_binary(tmp_path, monkeypatch):
+    helm = b'#!/bin/sh\necho v3.0.2+g19e47ee\n'
+    cdn = FakeCDN({'/lain4/helm-linux': helm})
+    cache_dir = tmp_path / 'cache'
+    dest = tmp_path / 'helm'
+    monkeypatch.setattr(utils, 'CDN', cdn.url)
+    monkeypatch.setattr(utils, 'BINARY_CACHE_DIR', str(cache_dir))
+    monkeypatch.setattr(utils, 'BINARY_CHUNK_SIZE', 8)
+    monkeypatch.setattr(utils, 'tell_platform', lambda: 'linux')
+    res, _ = run_under_click_context(download_binary, args=('helm', str(dest)))
+    assert res.exit_code == 0
+    blob = cache_dir / hashlib.sha256(helm).hexdigest()
+    assert os.readlink(dest) == str(blob)
+    assert dest.read_bytes() == helm and os.access(dest, os.X_OK)
+    # fetched in chunks
+    assert {r for m, _, r in cdn.requests if m == 'GET'} == {'bytes=0-7', 'bytes=8-15', 'bytes=16-23', 'bytes=24-30'}
+    # already in the cache, just checking that it's still the same thing
+    cdn.requests.clear()
+    dest.unlink()
+    res, _ = run_under_click_context(download_binary, args=('helm', str(dest)))
+    assert res.exit_code == 0
+    assert [m for m, _, _ in cdn.requests] == ['HEAD']
+    assert os.readlink(dest) == str(blob)
+    # an interrupted download resumes from the chunks it already got
+    blob.unlink()
+    partial_file = cache_dir / 'partial' / 'helm-linux'
+    partial_file.write_bytes(helm[:8] + b'\0' * (len(helm) - 8))
+    etag = f'"{hashlib.md5(helm).hexdigest()}"'
+    state = {'url': f'{cdn.url}/lain4/helm-linux', 'etag': etag, 'size': len(helm), 'done': [0]}
+    with open(f'{partial_file}.json', 'w') as f:
+        json.dump(state, f)
+
+    cdn.requests.clear()
+    res, _ = run_under_click_context(download_binary, args=('helm', str(dest)))
+    assert res.exit_code == 0
+    assert 'resuming download' in res.output
+    assert 'bytes=0-7' not in {r for _, _, r in cdn.requests}
+    assert dest.read_bytes() == helm
+    assert not os.path.exists(f'{partial_file}.json')
+    # same ETag, different content, doesn't match the recorded checksum
+    blob.unlink()
+    cdn.files['/lain4/helm-linux'] = helm.replace(b'3.0.2', b'6.6.6')
+    index_file = cache_dir / 'index.json'
+    index = json.loads(index_file.read_text())
+    index[state['url']]['etag'] = f'"{hashlib.md5(cdn.files["/lain4/helm-linux"]).hexdigest()}"'
+    index_file.write_text(json.dumps(index))
+    res, _ = run_under_click_context(download_binary, args=('helm', str(dest)))
+    assert res.exit_code == 1
+    assert 'does not match its recorded checksum' in res.output
+    cdn.httpd.shutdown()
+    # servers without range support get a plain download
+    cdn = FakeCDN({'/lain4/kubectl-linux': b'kubectl'}, ranges=False)
+    monkeypatch.setattr(utils, 'CDN', cdn.url)
+    res, _ = run_under_click_context(download_binary, args=('kubectl', str(tmp_path / 'kubectl')))
+    assert res.exit_code == 0
+    assert (tmp_path / 'kubectl').read_bytes() == b'kubectl'
+    assert [r for _, _, r in cdn.requests] == [None, None]
+    cdn.httpd.shutdown()
+
+
+def test_download_binary_concurrently(tmp_path, monkeypatch):
+    helm = b'#!/bin/sh\necho v3.0.2+g19e47ee\n'
+    cdn = FakeCDN({'/lain4/helm-linux': helm})
+    cache_dir = tmp_path / 'cache'
+    (cache_dir / 'partial').mkdir(parents=True)
+    dest = tmp_path / 'helm'
+    monkeypatch.setattr(utils, 'CDN', cdn.url)
+    monkeypatch.setattr(utils, 'BINARY_CACHE_DIR', str(cache_dir))
+    monkeypatch.setattr(utils, 'tell_platform', lambda: 'linux')
+    url = f'{cdn.url}/lain4/helm-linux'
+    digest = hashlib.sha256(helm).hexdigest()
+    kubectl_entry = {'sha256': 'whatever', 'etag': '"whatever"', 'size': 1}
+    results = []
+    # another runner is downloading helm right now
+    with file_lock(str(cache_dir / 'partial' / 'helm-linux.lock')):
+        thread = threading.Thread(
+            target=lambda: results.append(run_under_click_context(download_binary, args=('helm', str(dest)))),
+        )
+        thread.start()
+        time.sleep(0.2)
+        assert thread.is_alive()
+        # and is done with it
+        (cache_dir / digest).write_bytes(helm)
+        etag = f'"{hashlib.md5(helm).hexdigest()}"'
+        (cache_dir / 'index.json').write_text(json.dumps({
+            url: {'sha256': digest, 'etag': etag, 'size': len(helm)},
+            'kubectl': kubectl_entry,
+        }))
+
+    thread.join()
+    res, _ = results[0]
+    assert res.exit_code == 0, res.output
+    # whoever comes second finds it in the cache
+    assert [m for m, _, _ in cdn.requests] == ['HEAD']
+    assert os.readlink(dest) == str(cache_dir / digest)
+    # a download doesn't lose entries of other binaries
+    (cache_dir / digest).unlink()
+    res, _ = run_under_click_context(download_binary, args=('helm', str(dest)))
+    assert res.exit_code == 0, res.output
+    index = json.loads((cache_dir / 'index.json').read_text())
+    assert index['kubectl'] == kubectl_entry and index[url]['sha256'] == digest
+    cdn.httpd.shutdown()
+
+
+def test_tell_meta_version(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, 'META_VERSION_CACHE_FILE', str(tmp_path / 'meta.json'))
+    repo = tmp_path / 'repo'
+    (repo / 'chart').mkdir(parents=True)
+    monkeypatch.chdir(repo / 'chart')
+
+    def git(*args):
+        cmd = ['git', '-c', 'user.name=lain', '-c', 'user.email=lain@ein.plus', *args]
+        return subprocess_run(cmd, cwd=repo, capture_output=True, check=True).stdout.decode('utf-8').strip()
+
+    git('init')
+    git('commit', '--allow-empty', '-m', 'init')
+    expected = git('log', '-1', '--format=%ct-%H')
+    assert tell_meta_version() == expected
+    # cached by HEAD
+    monkeypatch.setattr(utils, 'read_commit_time', None)
+    assert tell_meta_version() == expected
+    monkeypatch.undo()
+    # packed refs and objects, in a worktree
+    monkeypatch.setattr(utils, 'META_VERSION_CACHE_FILE', str(tmp_path / 'meta-packed.json'))
+    git('gc', '-q')
+    git('worktree', 'add', '-q', '--detach', str(tmp_path / 'worktree'))
+    monkeypatch.chdir(tmp_path / 'worktree')
+    assert not os.listdir(repo / '.git' / 'refs' / 'heads')
+    assert tell_meta_version() == expected
+
+
+def test_legacy_lain_in_process(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / CHART_DIR_NAME).mkdir()
+    (tmp_path / CHART_DIR_NAME / 'values.yaml').write_text('appname: dummy\n')
+
+    def exit_gracefully(signal, frame):
+        sys.exit(130)
+
+    legacy_utils = SimpleNamespace(LAIN_YAML_PATH='./lain.yaml', exit_gracefully=exit_gracefully)
+    seen = []
+
+    class Parser:
+        """stands in for the argh parser of lain_cli"""
+
+        def dispatch(self, argv, output_file):
+            path = legacy_utils.LAIN_YAML_PATH
+            seen.append(path)
+            # right next to the build context, with legacy_lain's own SIGINT handler
+            assert os.path.dirname(path) == str(tmp_path)
+            assert signal.getsignal(signal.SIGINT) is exit_gracefully
+            with open(path) as f:
+                print(f.read().strip(), file=output_file)
+            if argv == ['build']:
+                # children of legacy_lain are captured too
+                subprocess.run(['sh', '-c', 'echo docker says no >&2'])
+                sys.exit('build failed')
+            if argv == ['run']:
+                subprocess.check_call(['sh', '-c', 'exit 3'])
+            if argv == ['stop']:
+                raise Exception('no cluster name')
+
+    monkeypatch.setattr(utils, 'load_legacy_lain', lambda: (Parser(), legacy_utils))
+    sigint_handler = signal.getsignal(signal.SIGINT)
+    res = legacy_lain('meta', capture_output=True)
+    assert (res.returncode, res.stdout) == (0, b'appname: dummy\n')
+    res = legacy_lain('build', capture_output=True)
+    assert (res.returncode, res.stderr) == (1, b'docker says no\nbuild failed\n')
+    # any other exception is an exit code, just like it was for the subprocess
+    res = legacy_lain('run', capture_output=True)
+    assert res.returncode == 3
+    assert b'CalledProcessError' in res.stderr
+    res = legacy_lain('stop')
+    assert res.returncode == 1
+    # no leftovers
+    assert signal.getsignal(signal.SIGINT) is sigint_handler
+    assert legacy_utils.LAIN_YAML_PATH == './lain.yaml'
+    assert 'LAIN_YAML' not in os.environ
+    assert not os.path.exists(seen[0])
+    assert os.listdir(tmp_path) == [CHART_DIR_NAME]
+
+
+def test_legacy_lain_in_process_real(tmp_path, monkeypatch):
+    pytest.importorskip('argh')
+    pytest.importorskip('lain_sdk')
+    monkeypatch.chdir(tmp_path)
+    utils.load_legacy_lain.cache_clear()
+    assert utils.load_legacy_lain()[0]
+    res = legacy_lain('config', 'show', capture_output=True)
+    assert res.returncode == 0
+    assert isinstance(json.loads(res.stdout), dict)
+
+
+def test_run_concurrently(capsys):
+    cmds = {
+        'future': ['sh', '-c', 'sleep 0.5; echo deployed; exit 0'],
+        'bei': ['sh', '-c', 'sleep 0.5; echo oops; exit 3'],
+    }
+    start = time.perf_counter()
+    results = run_concurrently(cmds)
+    # parallel, not sequential
+    assert time.perf_counter() - start < 0.9
+    assert results['future'][0] == 0
+    assert results['bei'][0] == 3
+    err = capsys.readouterr().err
+    assert '[future] deployed' in err
+    assert '[bei] oops' in err
+
+
+def test_run_dag():
+
+    def step(value, seconds=0.3):
+        def run(*deps):
+            time.sleep(seconds)
+            # click context is available in every step
+            return [utils.context().info_name, value, *deps]
+        return run
+
+    steps = {
+        'secret': (step('secret'), ()),
+        'status': (step('status'), ()),
+        'meta': (step('meta'), ()),
+        'tags': (step('tags'), ()),
+        'image': (step('image', 0), ('meta', 'tags')),
+    }
+    start = time.perf_counter()
+    res, (results, timings) = run_under_click_context(run_dag, args=[steps])
+    assert res.exit_code == 0, res.output
+    # as slow as the longest path, not the sum of all steps
+    assert time.perf_counter() - start < 0.9
+    assert results['image'] == ['wrapper-command', 'image', ['wrapper-command', 'meta'], ['wrapper-command', 'tags']]
+    assert timings['secret'] >= 0.3
+
+    started = []
+
+    def fail():
+        raise ValueError('registry down')
+
+    steps = {'tags': (fail, ()), 'image': (lambda tags: started.append('image'), ('tags',))}
+    with pytest.raises(ValueError, match='registry down'):
+        run_dag(steps)
+    assert not started
+    with pytest.raises(ValueError, match='check their deps'):
+        run_dag({'image': (lambda tags: tags, ('tagz',))})
+
+
+def test_exec_in_pods():
+    # 20 pods, a 0.3s exec each, 10 at a time
+    cmds = {
+        f'dummy-web-{i}': ['sh', '-c', f'sleep 0.3; echo {"stale" if i == 7 else "fresh"}; exit {int(i == 7)}']
+        for i in range(20)
+    }
+    start = time.perf_counter()
+    results = exec_in_pods(cmds, concurrency=10)
+    assert time.perf_counter() - start < 1.5
+    assert results['dummy-web-0'][:2] == (0, 'fresh\n')
+    assert results['dummy-web-7'][:2] == (1, 'stale\n')
+    (common, podnames), (odd, odd_podnames) = group_outputs(results)
+    assert common == (0, 'fresh\n')
+    assert len(podnames) == 19
+    assert odd_podnames == ['dummy-web-7']
+
+
+def test_ya_libyaml_fallback(monkeypatch):
+    yaml = utils.tell_yaml()
+    dic = {'slogan': BULLSHIT, 'config.py': literal('DEBUG = False\nTIMEOUT = 3\n')}
+    accelerated = yadu(dic)
+    assert 'config.py: |\n  DEBUG = False' in accelerated
+    monkeypatch.setattr(utils, 'tell_yaml_loader', lambda: yaml.FullLoader)
+    monkeypatch.setattr(utils, 'tell_yaml_dumper', lambda: yaml.Dumper)
+    assert yadu(dic) == accelerated
+    assert yalo(accelerated) == dic
+
+
+def test_yalo_reads_from_disk(tmp_path):
+    """editors may replace the file altogether, what's on disk wins"""
+    path = tmp_path / 'secret.yaml'
+    path.write_text('slogan: old\n')
+    with open(path) as f:
+        replacement = tmp_path / 'replacement.yaml'
+        replacement.write_text(f'slogan: {BULLSHIT}\n')
+        os.replace(replacement, path)
+        assert yalo(f) == {'slogan': BULLSHIT}
+
+
+def test_resolve_helm_values(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(utils, 'LAIN_CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setattr(utils, 'values_memo', {})
+    chart = tmp_path / CHART_DIR_NAME
+    chart.mkdir()
+    yadu({'appname': 'dummy', 'deployments': {'web': {'replicaCount': 1, 'memory': '80Mi'}}}, str(chart / 'values.yaml'))
+    yadu({'deployments': {'web': {'replicaCount': 3}}}, str(chart / f'values-{TEST_CLUSTER}.yaml'))
+    parsed = []
+    original_yalo = utils.yalo
+
+    def counting_yalo(f):
+        parsed.append(f.name)
+        return original_yalo(f)
+
+    monkeypatch.setattr(utils, 'yalo', counting_yalo)
+    values, provenance = resolve_helm_values(TEST_CLUSTER)
+    assert values['deployments']['web'] == {'replicaCount': 3, 'memory': '80Mi'}
+    assert provenance['deployments.web.replicaCount'] == f'{CHART_DIR_NAME}/values-{TEST_CLUSTER}.yaml'
+    assert provenance['deployments.web.memory'] == f'{CHART_DIR_NAME}/values.yaml'
+    assert len(parsed) == 2
+    # same process, then a new process: nothing is parsed again
+    values['appname'] = 'mutated'
+    assert resolve_helm_values(TEST_CLUSTER)[0]['appname'] == 'dummy'
+    utils.values_memo.clear()
+    assert resolve_helm_values(TEST_CLUSTER)[0] == {**values, 'appname': 'dummy'}
+    assert len(parsed) == 2
+    # values changed, parse again
+    cluster_values = chart / f'values-{TEST_CLUSTER}.yaml'
+    mtime = cluster_values.stat().st_mtime_ns
+    yadu({'deployments': {'web': {'replicaCount': 5}}}, str(cluster_values))
+    # same size, make sure mtime moves even on coarse filesystems
+    os.utime(cluster_values, ns=(mtime + 10 ** 9, mtime + 10 ** 9))
+    assert resolve_helm_values(TEST_CLUSTER)[0]['deployments']['web']['replicaCount'] == 5
+    assert len(parsed) == 4
+    rows = explain_values('deployments.web', cluster=TEST_CLUSTER, pairs=[('deployments.web.memory', '1Gi')])
+    assert rows == [
+        ('deployments.web.memory', '1Gi', '--set', [f'{CHART_DIR_NAME}/values.yaml']),
+        ('deployments.web.replicaCount', 5, f'{CHART_DIR_NAME}/values-{TEST_CLUSTER}.yaml', [f'{CHART_DIR_NAME}/values.yaml']),
+    ]
+    assert explain_values('imageTag', cluster=TEST_CLUSTER) == [('imageTag', '<lain meta>', 'lain deploy', [])]